@@ -2,20 +2,186 @@
 __copyright__ = "(C) 2016-2017 Guido U. Draheim, for free use (CC-BY, GPL, BSD)"
 __version__ = "0.5.1128"
 
+# the init process keeps a status board of fixed records in a shared file - the
+# is-active / is-failed / is-system-running checks of a health probe do read it
+# before the rest of the module is imported (and fall back to the unit files).
+import os
+import sys
+import mmap
+import struct
+import zlib
+
+_board_folder = "/var/run/systemctl"
+_board_slots = 1024
+_board_header = struct.Struct("<8sIIIdI4x") # magic, slots, record size, manager pid, boot time, system state
+_board_name = 36 # the unit name is truncated (the hash does tell them apart)
+_board_record = struct.Struct("<IIB3xidi%ds" % _board_name) # seq, name hash, unit state, pid, since, exitcode, name
+_board_seq = struct.Struct("<I")
+_board_magic = "SCTLBRD1"
+_board_states = [ "", "inactive", "activating", "active", "reloading", "deactivating", "failed" ]
+_board_system = [ "offline", "starting", "running", "stopping" ]
+
+def board_hash(unit): # -> nonzero int
+    return (zlib.crc32(unit) & 0xffffffff) or 1
+
+def board_pid_exists(pid): # -> bool
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == 1 # EPERM
+    return True
+
+def board_open(folder = None): # -> mmap?
+    """ the board of a living init process (else None) """
+    path = os.path.join(folder or _board_folder, "status.board")
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return None
+    try:
+        try:
+            board = mmap.mmap(fd, 0, mmap.MAP_SHARED, mmap.PROT_READ)
+        except (mmap.error, ValueError):
+            return None
+    finally:
+        os.close(fd)
+    if len(board) < _board_header.size:
+        return None
+    magic, slots, size, manager, boot, state = _board_header.unpack_from(board, 0)
+    if magic != _board_magic or size != _board_record.size:
+        return None
+    if len(board) < _board_header.size + slots * size:
+        return None
+    if not board_pid_exists(manager):
+        return None
+    return board
+
+def board_read(board, pos): # -> record tuple?
+    """ a consistent copy of a record - the writer makes the seq odd while it
+        does change the fields and even again when it is done, so the seq is
+        read again after the copy and it must not have changed in between """
+    for attempt in xrange(10000):
+        seq, = _board_seq.unpack_from(board, pos)
+        if seq & 1:
+            continue
+        record = _board_record.unpack_from(board, pos)
+        again, = _board_seq.unpack_from(board, pos)
+        if again == seq:
+            return record
+    return None # a writer died in between
+
+def board_slot(board, unit, insert = False): # -> offset?
+    """ open addressing by the name hash - an empty slot ends the probing """
+    key = board_hash(unit)
+    slots = _board_header.unpack_from(board, 0)[1]
+    for n in xrange(slots):
+        pos = _board_header.size + ((key + n) % slots) * _board_record.size
+        record = board_read(board, pos)
+        if record is None:
+            return None
+        if not record[1]:
+            if insert: return pos
+            return None
+        if record[1] == key and record[6].rstrip("\0") == unit[:_board_name]:
+            return pos
+    return None
+
+def board_units(board): # -> [ (name, state, pid) ]
+    slots = _board_header.unpack_from(board, 0)[1]
+    for n in xrange(slots):
+        record = board_read(board, _board_header.size + n * _board_record.size)
+        if record and record[1]:
+            yield record[6].rstrip("\0"), _board_states[record[2]], record[3]
+
+def board_system_state(board): # -> text
+    state = _board_system[_board_header.unpack_from(board, 0)[5]]
+    if state == "running":
+        for name, unit_state, pid in board_units(board):
+            if unit_state == "failed":
+                return "degraded"
+    return state
+
+def board_unit_state(board, unit): # -> text?
+    """ the state of an active unit is only believed while its pid is alive """
+    pos = board_slot(board, unit)
+    if pos is None:
+        return None
+    record = board_read(board, pos)
+    if record is None:
+        return None
+    state = _board_states[record[2]]
+    if state in [ "active", "reloading" ] and record[3] and not board_pid_exists(record[3]):
+        return None
+    return state
+
+def board_command(command, args): # -> exitcode?
+    """ None when the board can not answer (then the unit files are checked) """
+    for arg in args:
+        if arg.startswith("-") or "*" in arg or "?" in arg or "[" in arg:
+            return None
+    if command == "is-system-running":
+        if args: return None
+        board = board_open()
+        if board is None: return None
+        state = board_system_state(board)
+        print state
+        return int(state != "running")
+    if not args:
+        return None
+    board = board_open()
+    if board is None:
+        return None
+    states = []
+    for unit in args:
+        if "." not in unit:
+            unit += ".service"
+        state = board_unit_state(board, unit)
+        if state is None:
+            return None
+        states.append(state)
+    if command == "is-active":
+        return int("active" not in states and "reloading" not in states)
+    if command == "is-failed":
+        return int("failed" not in states)
+    return None
+
+if __name__ == "__main__" and len(sys.argv) > 1 and sys.argv[1] in [ "is-active", "is-failed", "is-system-running" ]:
+    _board_exitcode = board_command(sys.argv[1], sys.argv[2:])
+    if _board_exitcode is not None:
+        sys.exit(_board_exitcode)
+
 import logging
 logg = logging.getLogger("systemctl")
 
 import re
 import fnmatch
 import shlex
+import pipes
+import StringIO
+import glob
 import collections
 import ConfigParser
 import errno
-import os
-import sys
+import pwd
+import grp
 import subprocess
 import signal
 import time
+import socket
+import select
+import fcntl
+import heapq
+import bisect
+import calendar
+import datetime
+import gc
+import json
+import resource
+import platform
+try:
+    import ctypes, ctypes.util
+except ImportError: # pragma: no cover
+    ctypes = None
 
 
 # http://stackoverflow.com/questions/568271/how-to-check-if-there-exists-a-process-with-a-given-pid
@@ -61,6 +227,119 @@ def ignore_signals_and_raise_keyboard_interrupt(signame):
     signal.signal(signal.SIGINT, signal.SIG_IGN)
     raise KeyboardInterrupt(signame)
 
+def time_to_seconds(text, default = None): # -> float?
+    """ a time span like "90", "5min", "1h 30min" or "100ms" as
+        being used in the *Sec= settings (a plain number is seconds) """
+    if not text: return default
+    units = { "us": 0.000001, "usec": 0.000001, "ms": 0.001, "msec": 0.001,
+              "s": 1, "sec": 1, "second": 1, "seconds": 1,
+              "m": 60, "min": 60, "minute": 60, "minutes": 60,
+              "h": 3600, "hr": 3600, "hour": 3600, "hours": 3600,
+              "d": 86400, "day": 86400, "days": 86400,
+              "w": 604800, "week": 604800, "weeks": 604800,
+              "M": 2629800, "month": 2629800, "months": 2629800,
+              "y": 31557600, "year": 31557600, "years": 31557600 }
+    if text.strip() == "infinity": return None
+    seconds = 0.0
+    found = False
+    for m in re.finditer(r"(\d+(?:[.]\d*)?)\s*([a-zA-Z]*)", text):
+        if m.group(2) not in units and m.group(2):
+            logg.warning("bad time span '%s'", text)
+            return default
+        seconds += float(m.group(1)) * units.get(m.group(2), 1)
+        found = True
+    if not found: return default
+    return seconds
+
+_calendar_shorthands = {
+    "minutely": "*-*-* *:*:00",
+    "hourly": "*-*-* *:00:00",
+    "daily": "*-*-* 00:00:00",
+    "weekly": "Mon *-*-* 00:00:00",
+    "monthly": "*-*-01 00:00:00",
+    "quarterly": "*-01,04,07,10-01 00:00:00",
+    "semiannually": "*-01,07-01 00:00:00",
+    "yearly": "*-01-01 00:00:00",
+    "annually": "*-01-01 00:00:00" }
+_calendar_weekdays = [ "mon", "tue", "wed", "thu", "fri", "sat", "sun" ]
+
+def calendar_field(text, lo, hi, names = None): # -> [ values,.. ] | None
+    """ one field of an OnCalendar= spec with "*", "a,b", "a..b" and "a/step" """
+    if text == "*": return None
+    values = set()
+    for part in text.split(","):
+        step = None
+        if "/" in part:
+            part, step = part.split("/", 1)
+            step = int(step)
+        if names:
+            part = part.lower()
+            for n, name in enumerate(names):
+                part = re.sub(name + "[a-z]*", str(n), part)
+        if part == "*":
+            first, last = lo, hi
+        elif ".." in part:
+            first, last = [ int(x) for x in part.split("..", 1) ]
+        elif "-" in part and names:
+            first, last = [ int(x) for x in part.split("-", 1) ]
+        else:
+            first = int(float(part))
+            last = step and hi or first
+        values.update(range(first, last + 1, step or 1))
+    return sorted(values)
+
+def parse_calendar(text): # -> (weekdays, years, months, days, hours, minutes, seconds)
+    """ OnCalendar= as "[DOW] [YYYY-MM-DD] [HH:MM[:SS]]" or a shorthand like "daily" """
+    text = _calendar_shorthands.get(text.strip().lower(), text.strip())
+    weekdays = None
+    date, clock = "*-*-*", "00:00:00"
+    for token in text.split():
+        if token[0].isalpha():
+            weekdays = calendar_field(token, 0, 6, _calendar_weekdays)
+        elif ":" in token:
+            clock = token
+        else:
+            date = token
+    parts = date.split("-")
+    if len(parts) == 2:
+        parts = [ "*" ] + parts
+    if len(parts) != 3:
+        raise ValueError("bad calendar date '%s'" % date)
+    years = calendar_field(parts[0], 1970, 2199)
+    months = calendar_field(parts[1], 1, 12)
+    days = calendar_field(parts[2], 1, 31)
+    parts = clock.split(":")
+    if len(parts) == 2:
+        parts = parts + [ "00" ]
+    if len(parts) != 3:
+        raise ValueError("bad calendar time '%s'" % clock)
+    hours = calendar_field(parts[0], 0, 23)
+    minutes = calendar_field(parts[1], 0, 59)
+    seconds = calendar_field(parts[2], 0, 59)
+    return weekdays, years, months, days, hours, minutes, seconds
+
+def next_calendar_time(spec, after): # -> timestamp?
+    """ the first point in (local) time after the given one matching the spec """
+    weekdays, years, months, days, hours, minutes, seconds = spec
+    start = int(after) + 1
+    now = time.localtime(start)
+    today = datetime.date(now.tm_year, now.tm_mon, now.tm_mday)
+    for n in xrange(366 * 5):
+        day = today + datetime.timedelta(n)
+        if years and day.year not in years: continue
+        if months and day.month not in months: continue
+        if days and day.day not in days: continue
+        if weekdays and day.weekday() not in weekdays: continue
+        for hour in hours or xrange(24):
+            if not n and hour < now.tm_hour: continue
+            for minute in minutes or xrange(60):
+                if not n and hour == now.tm_hour and minute < now.tm_min: continue
+                for second in seconds or xrange(60):
+                    ts = time.mktime((day.year, day.month, day.day, hour, minute, second, 0, 0, -1))
+                    if ts >= start:
+                        return ts
+    return None
+
 class UnitConfigParser:
     """ A *.service files has a structure similar to an *.ini file but it is
         actually not like it. Settings may occur multiple times in each section
@@ -74,6 +353,7 @@ class UnitConfigParser:
         self._allow_no_value = allow_no_value
         self._dict = self._dict_type()
         self._files = []
+        self._name = None
     def defaults(self):
         return self.defaults
     def sections(self):
@@ -138,10 +418,24 @@ class UnitConfigParser:
     def loaded(self):
         return len(self._files)
     def filename(self):
-        """ returns the last filename that was parsed """
+        """ returns the unit file that was parsed (not a drop-in *.conf) """
         if self._files:
-            return self._files[-1]
+            return self._files[0]
         return None
+    def name(self):
+        """ the unit name - for a template instance it is not the filename """
+        if self._name:
+            return self._name
+        if self._files:
+            return os.path.basename(self._files[0])
+        return self.get("Unit", "Id", "")
+    def expand_specifiers(self, specifiers):
+        """ replace %i and friends in all the settings (unknown ones stay) """
+        def expand(m):
+            return specifiers.get(m.group(1), m.group(0))
+        for section in self._dict.values():
+            for option, values in section.items():
+                section[option] = [ re.sub(r"%(.)", expand, value) for value in values ]
     def read(self, filename):
         return self.read_sysd(filename)
     def read_sysd(self, filename):
@@ -171,7 +465,7 @@ class UnitConfigParser:
                     section = line[1:x]
                     self.add_section(section)
                 continue
-            m = re.match(r"(\w+)=(.*)", line)
+            m = re.match(r"([\w-]+)=(.*)", line)
             if not m:
                 logg.warning("bad ini line: %s", line)
                 raise Exception("bad ini line")
@@ -228,12 +522,12 @@ class UnitConfigParser:
 UnitParser = ConfigParser.RawConfigParser
 UnitParser = UnitConfigParser
 
-def subprocess_nowait(cmd, env=None):
-    run = subprocess.Popen(cmd, shell=True, env=env)
+def subprocess_nowait(cmd, env=None, preexec=None):
+    run = subprocess.Popen(cmd, shell=True, env=env, preexec_fn=preexec)
     return run
 
-def subprocess_wait(cmd, env=None, check = False):
-    run = subprocess.Popen(cmd, shell=True, env=env)
+def subprocess_wait(cmd, env=None, check = False, preexec=None):
+    run = subprocess.Popen(cmd, shell=True, env=env, preexec_fn=preexec)
     run.wait()
     if check and run.returncode: 
         logg.error("returncode %i\n %s", run.returncode, cmd)
@@ -248,33 +542,609 @@ def subprocess_output(cmd, env=None, check = False):
         raise Exception("command failed")
     return run
 
+def listen_fds_passing(fds, env):
+    """ returns a preexec function that moves the listening sockets
+        to fd 3... in the child and sets LISTEN_PID to the child pid """
+    def preexec():
+        moved = [ fcntl.fcntl(fd, fcntl.F_DUPFD, 3 + len(fds)) for fd in fds ]
+        for n, fd in enumerate(moved):
+            os.dup2(fd, 3 + n)
+            os.close(fd)
+        env["LISTEN_PID"] = str(os.getpid())
+    return preexec
+
+def new_session(preexec = None):
+    """ returns a preexec function that puts the child into a process group
+        of its own (so that a stop can signal all of its processes) """
+    def setsid():
+        os.setsid()
+        if preexec: preexec()
+    return setsid
+
+def unit_template(unit): # -> (name@.service, instance) | None
+    """ an instance name like "worker@3.service" refers to "worker@.service" """
+    m = re.match(r"^([^@]+)@([^/]*)(\.\w+)$", unit or "")
+    if not m: return None
+    return m.group(1) + "@" + m.group(3), m.group(2)
+
+def unit_unescape(text):
+    """ the %I specifier is the instance with "-" as "/" and \\xNN decoded """
+    text = text.replace("-", "/")
+    return re.sub(r"\\x([0-9a-fA-F]{2})", lambda m: chr(int(m.group(1), 16)), text)
+
+def expand_braces(text): # -> [ text,.. ]
+    """ "worker@{1..4}" and "{db,app}.service" as in a shell """
+    m = re.search(r"\{([^{}]*)\}", text)
+    if not m: return [ text ]
+    m2 = re.match(r"^(-?\d+)\.\.(-?\d+)$", m.group(1))
+    if m2:
+        first, last = int(m2.group(1)), int(m2.group(2))
+        step = first <= last and 1 or -1
+        items = [ str(n) for n in xrange(first, last + step, step) ]
+    elif "," in m.group(1):
+        items = m.group(1).split(",")
+    else:
+        return [ text ]
+    result = []
+    for item in items:
+        result += expand_braces(text[:m.start()] + item + text[m.end():])
+    return result
+
+def available_cpus(): # -> [ cpu,.. ]
+    """ the cpu ids in the affinity mask of this process """
+    try:
+        for line in open("/proc/self/status"):
+            if line.startswith("Cpus_allowed_list:"):
+                return parse_cpu_list(line.split(":", 1)[1].strip())
+    except Exception, e:
+        logg.debug("no affinity mask: %s", e)
+    return range(os.sysconf("SC_NPROCESSORS_ONLN"))
+
+_syslog_months = [ "Jan", "Feb", "Mar", "Apr", "May", "Jun",
+                   "Jul", "Aug", "Sep", "Oct", "Nov", "Dec" ]
+_syslog_rfc3164 = re.compile(r"^(?:(\w{3}) +\d+ \d\d:\d\d:\d\d +)?(?:([^\s:\[]+) +(?=\S+?(?:\[\d+\])?: ))?([^\s:\[]+)(?:\[(\d+)\])?: ?(.*)$", re.S)
+_syslog_rfc5424 = re.compile(r"^1 +(\S+) +(\S+) +(\S+) +(\S+) +(\S+) +(-|(?:\[.*?\])+) ?(.*)$", re.S)
+
+def parse_syslog(text): # -> (priority, tag, pid, message)
+    """ an RFC3164 "<PRI>Mmm dd hh:mm:ss [host] tag[pid]: message" as sent
+        by the libc syslog() or an RFC5424 "<PRI>1 TIME HOST APP PROCID MSGID SD message" """
+    priority = 13 # user.notice
+    m = re.match(r"^<(\d{1,3})>", text)
+    if m:
+        priority = int(m.group(1))
+        text = text[m.end():]
+    m = _syslog_rfc5424.match(text)
+    if m:
+        tag = m.group(3) != "-" and m.group(3) or ""
+        pid = m.group(4).isdigit() and int(m.group(4)) or None
+        message = m.group(7)
+        if message.startswith("\xef\xbb\xbf"): message = message[3:] # BOM
+        return priority, tag, pid, message
+    m = _syslog_rfc3164.match(text)
+    if m and (not m.group(1) or m.group(1) in _syslog_months):
+        return priority, m.group(3), m.group(4) and int(m.group(4)) or None, m.group(5)
+    return priority, "", None, text
+
+_journal_block = 65536 # bytes of a UNIT.log between two entries of its UNIT.idx
+_journal_index = struct.Struct("<dQ") # (time, offset)
+
+def journal_timestamp(when): # -> text
+    """ the local time of a journal line as it is shown """
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(when)) + ".%06i" % int((when % 1) * 1000000)
+
+def journal_stamp(when): # -> text
+    """ the sortable UTC time at the start of each line of a UNIT.log - the
+        local time would go back for an hour at the end of daylight saving """
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(when)) + ".%06iZ" % int((when % 1) * 1000000)
+
+def journal_time(line, cache = None): # -> timestamp?
+    """ the time of a UNIT.log line (one without the "Z" is in local time) """
+    key = line[:19] + line[26:27]
+    seconds = None
+    if cache is not None:
+        seconds = cache.get(key)
+    if seconds is None:
+        try:
+            clock = time.strptime(line[:19], "%Y-%m-%d %H:%M:%S")
+        except ValueError:
+            return None
+        if line[26:27] == "Z":
+            seconds = calendar.timegm(clock)
+        else:
+            seconds = time.mktime(clock[:8] + (-1,))
+        if cache is not None:
+            if len(cache) > 1000: cache.clear()
+            cache[key] = seconds
+    try:
+        return seconds + float(line[19:26])
+    except ValueError:
+        return float(seconds)
+
+def journal_local(line, cache = None): # -> text
+    """ a UNIT.log line as it is shown - with the local time in front """
+    if line[26:27] != "Z":
+        return line
+    when = journal_time(line, cache)
+    if when is None:
+        return line
+    return journal_timestamp(when) + line[27:]
+
+def parse_journal_time(text, now = None): # -> timestamp?
+    """ --since/--until as "2024-01-31 12:00:00", "2024-01-31", "12:00",
+        "now", "today", "yesterday", "tomorrow" or "-5min" / "5min ago" """
+    now = now or time.time()
+    text = text.strip()
+    today = time.localtime(now)
+    days = { "yesterday": -1, "today": 0, "tomorrow": 1 }
+    if text == "now":
+        return now
+    if text in days:
+        return time.mktime(today[:2] + (today.tm_mday + days[text], 0, 0, 0, 0, 0, -1))
+    if text.startswith("-") or text.endswith(" ago"):
+        seconds = time_to_seconds(text.lstrip("-").replace(" ago", ""))
+        if seconds is None: return None
+        return now - seconds
+    for fmt in [ "%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d" ]:
+        try: return time.mktime(time.strptime(text, fmt))
+        except ValueError: pass
+    for fmt in [ "%H:%M:%S", "%H:%M" ]:
+        try: clock = time.strptime(text, fmt)
+        except ValueError: continue
+        return time.mktime(today[:3] + (clock.tm_hour, clock.tm_min, clock.tm_sec, 0, 0, -1))
+    return None
+
+def json_list(records): # -> generate[ text ]
+    """ stream a json array of objects, each given as (name, value) pairs """
+    yield "["
+    sep = "\n"
+    for record in records:
+        yield sep + "{" + ", ".join([ "%s: %s" % (json.dumps(name), json.dumps(value))
+                                      for name, value in record ]) + "}"
+        sep = ",\n"
+    yield "\n]\n"
+
+def metrics_label(text): # -> text
+    """ a label value in the prometheus text format has the backslash,
+        the double quote and the newline escaped """
+    return text.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def size_to_bytes(text, total = None): # -> int | None(infinity)
+    """ "512M", "2G", "1024" as used by Limit*= and MemoryMax= - and
+        "50%" for a share of the given total (of a MemoryMax=) """
+    text = text.strip()
+    if text in [ "infinity", "max" ]: return None
+    if text.endswith("%"):
+        if total is None: raise ValueError("no percentage allowed '%s'" % text)
+        return int(total * float(text[:-1]) / 100)
+    m = re.match(r"^(\d+)\s*([KMGTP]?)i?B?$", text, re.I)
+    if not m: raise ValueError("bad size '%s'" % text)
+    return int(m.group(1)) * 1024 ** "_KMGTP".index(m.group(2).upper() or "_")
+
+def rlimit_value(name, text): # -> int | None(infinity)
+    """ LimitCPU= is in seconds and LimitRTTIME= in microseconds where
+        both may be given as a time span like "1h" - the others are sizes """
+    text = text.strip()
+    if name in [ "LimitCPU", "LimitRTTIME" ] and not text.isdigit() and text != "infinity":
+        seconds = time_to_seconds(text, -1)
+        if seconds < 0: raise ValueError("bad time span '%s'" % text)
+        if name == "LimitRTTIME": return int(seconds * 1000000)
+        return int(seconds)
+    return size_to_bytes(text)
+
+def memory_total(): # -> int
+    """ the MemTotal of /proc/meminfo in bytes """
+    for line in open("/proc/meminfo"):
+        if line.startswith("MemTotal:"):
+            return int(line.split()[1]) * 1024
+    raise ValueError("no MemTotal in /proc/meminfo")
+
+def nofile_maximum(): # -> int
+    """ setrlimit rejects an unlimited RLIMIT_NOFILE - the kernel maximum is
+        fs.nr_open (or the current hard limit where it can not be read) """
+    try:
+        return int(open("/proc/sys/fs/nr_open").read())
+    except (IOError, OSError, ValueError):
+        return resource.getrlimit(resource.RLIMIT_NOFILE)[1]
+
+_libc = None
+def libc(): # -> ctypes.CDLL
+    global _libc
+    if _libc is None:
+        if ctypes is None:
+            raise OSError(errno.ENOSYS, "no ctypes")
+        _libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    return _libc
+
+def set_cpu_affinity(cpus):
+    """ sched_setaffinity for the current process """
+    bits = 8 * ctypes.sizeof(ctypes.c_ulong)
+    mask = (ctypes.c_ulong * (max(cpus) // bits + 1))()
+    for cpu in cpus:
+        mask[cpu // bits] |= 1 << (cpu % bits)
+    if libc().sched_setaffinity(0, ctypes.sizeof(mask), ctypes.byref(mask)) != 0:
+        raise OSError(ctypes.get_errno(), "sched_setaffinity")
+
+_ioprio_set_syscall = { "x86_64": 251, "i386": 289, "i686": 289, "aarch64": 30,
+                        "armv7l": 314, "ppc64le": 273, "ppc64": 273, "s390x": 282 }
+def set_io_priority(ioclass, level):
+    """ ioprio_set for the current process (IOPRIO_WHO_PROCESS) """
+    nr = _ioprio_set_syscall.get(platform.machine())
+    if nr is None:
+        raise OSError(errno.ENOSYS, "ioprio_set on %s" % platform.machine())
+    if libc().syscall(nr, 1, 0, (ioclass << 13) | level) != 0:
+        raise OSError(ctypes.get_errno(), "ioprio_set")
+
+def set_cpu_scheduling(policy, priority):
+    """ sched_setscheduler for the current process """
+    param = ctypes.c_int(priority)
+    if libc().sched_setscheduler(0, policy, ctypes.byref(param)) != 0:
+        raise OSError(ctypes.get_errno(), "sched_setscheduler")
+
+IN_MODIFY, IN_ATTRIB, IN_CLOSE_WRITE = 0x2, 0x4, 0x8
+IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE = 0x40, 0x80, 0x100, 0x200
+IN_DELETE_SELF, IN_MOVE_SELF, IN_IGNORED, IN_MASK_ADD = 0x400, 0x800, 0x8000, 0x20000000
+_inotify_event = struct.Struct("iIII") # wd, mask, cookie, len (of the name)
+
+def inotify_init(): # -> fd
+    fd = libc().inotify_init1(os.O_NONBLOCK | 02000000) # IN_CLOEXEC
+    if fd < 0:
+        raise OSError(ctypes.get_errno(), "inotify_init1")
+    return fd
+
+def inotify_add_watch(fd, path, mask): # -> wd
+    wd = libc().inotify_add_watch(fd, path, mask)
+    if wd < 0:
+        raise OSError(ctypes.get_errno(), "inotify_add_watch %s" % path)
+    return wd
+
+def inotify_rm_watch(fd, wd):
+    libc().inotify_rm_watch(fd, wd)
+
+def inotify_events(data): # -> generate[ (wd, mask, name) ]
+    pos = 0
+    while pos + _inotify_event.size <= len(data):
+        wd, mask, cookie, size = _inotify_event.unpack_from(data, pos)
+        pos += _inotify_event.size
+        name = data[pos:pos+size].rstrip("\0")
+        pos += size
+        yield wd, mask, name
+
+def parse_cpu_list(text): # -> [ cpu,.. ]
+    """ CPUAffinity= as "0 1 4-7" or "0,2" """
+    cpus = []
+    for part in text.replace(",", " ").split():
+        if "-" in part:
+            first, last = part.split("-", 1)
+            cpus += range(int(first), int(last) + 1)
+        else:
+            cpus.append(int(part))
+    return cpus
+
+class Processes:
+    """ the clock and the process table as used by the Systemctl class
+        for starting, signalling and waiting - see SimulatedProcesses """
+    def time(self):
+        return time.time()
+    def sleep(self, seconds):
+        time.sleep(seconds)
+    def spawn(self, cmd, env = None, preexec = None): # -> Popen
+        return subprocess_nowait(cmd, env, preexec)
+    def run(self, cmd, env = None, check = False, preexec = None): # -> Popen (finished)
+        return subprocess_wait(cmd, env, check, preexec)
+    def kill(self, pid, signum):
+        os.kill(pid, signum)
+    def killpg(self, pgid, signum):
+        os.killpg(pgid, signum)
+    def exists(self, pid): # -> bool
+        return pid_exists(pid)
+    def zombie(self, pid): # -> bool
+        """ a zombie does still exist for kill(0) """
+        try:
+            for line in open("/proc/%s/status" % pid):
+                if line.startswith("State:"):
+                    return "Z" in line
+        except IOError:
+            pass
+        return False
+    def group_leader(self, pid): # -> bool
+        try:
+            return os.getpgid(pid) == pid
+        except OSError:
+            return False
+    def group_running(self, pgid): # -> bool
+        """ any process of the group that is not a zombie """
+        for pid in os.listdir("/proc"):
+            if not pid.isdigit(): continue
+            try:
+                stat = open("/proc/%s/stat" % pid).read()
+            except IOError:
+                continue
+            fields = stat[stat.rfind(")")+2:].split()
+            if fields[0] != "Z" and int(fields[2]) == pgid:
+                return True
+        return False
+    def fork(self, func, atfork = None): # -> ForkedCall
+        """ run func() in a child process - exitcode 0 unless it returns False.
+            The child gets the default signal handlers back and atfork() may
+            drop what else belongs to the parent process. """
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if not pid:
+            exitcode = 1
+            try:
+                signal.set_wakeup_fd(-1)
+                for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGCHLD, signal.SIGUSR1):
+                    signal.signal(signum, signal.SIG_DFL)
+                if atfork: atfork()
+                exitcode = func() is False and 1 or 0
+            except Exception, e:
+                logg.error("forked call: %s", e)
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(exitcode)
+        return ForkedCall(pid)
+    def reap(self): # -> [ (pid, status) ]
+        """ waitpid() for any child that has exited """
+        reaped = []
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError:
+                break
+            if not pid:
+                break
+            reaped.append((pid, status))
+        return reaped
+
+class ForkedCall:
+    """ the Popen-like handle of a Processes.fork() """
+    def __init__(self, pid):
+        self.pid = pid
+        self.returncode = None
+    def poll(self):
+        if self.returncode is None:
+            try:
+                pid, status = os.waitpid(self.pid, os.WNOHANG)
+            except OSError, e:
+                logg.debug("forked call %s: %s", self.pid, e)
+                pid, status = self.pid, 255 << 8
+            if pid and os.WIFSIGNALED(status):
+                self.returncode = - os.WTERMSIG(status)
+            elif pid:
+                self.returncode = os.WEXITSTATUS(status)
+        return self.returncode
+    def wait(self):
+        while self.poll() is None:
+            time.sleep(0.01)
+        return self.returncode
+
+class SimulatedRun:
+    """ the Popen object of a SimulatedProcesses command """
+    def __init__(self, processes, pid):
+        self.processes = processes
+        self.pid = pid
+        self.returncode = None
+    def poll(self):
+        proc = self.processes.procs[self.pid]
+        if proc["exit"] is not None and proc["exit"] <= self.processes.now:
+            self.returncode = proc["exitcode"]
+        return self.returncode
+    def wait(self):
+        proc = self.processes.procs[self.pid]
+        if proc["exit"] is None:
+            raise Exception("simulated command runs forever: %s" % proc["cmd"])
+        if proc["exit"] > self.processes.now:
+            self.processes.sleep(proc["exit"] - self.processes.now)
+        return self.poll()
+    def kill(self):
+        self.processes.kill(self.pid, signal.SIGKILL)
+
+class SimulatedProcesses(Processes):
+    """ a virtual clock and a fake process table - sleep() does only
+        advance the clock, so that thousands of start/stop scenarios
+        can be run per second. Each command is matched (fnmatch) to a
+        behavior like { "runtime": 2.0, "exitcode": 0, "term": 0.5,
+        "daemon": { "runtime": None, "term": 3.0 }, "pid_file": PATH }
+        where runtime None is forever, term None ignores a SIGTERM and a
+        daemon is forked at the end of the runtime and written to pid_file. """
+    def __init__(self, behaviors = None, now = 0.0):
+        self.now = now
+        self.behaviors = behaviors or [] # [ (pattern, behavior),.. ]
+        self.procs = {} # pid => { "cmd", "pgid", "exit", "exitcode", "term", .. }
+        self.events = [] # [ (time, what, pid, detail) ] for the test to check
+        self.next_pid = 1000
+    def behavior(self, cmd): # -> behavior
+        for pattern, behavior in self.behaviors:
+            if fnmatch.fnmatchcase(cmd, pattern):
+                return behavior
+        return { "runtime": 0.0 }
+    def start(self, cmd, behavior, pgid = None): # -> pid
+        self.next_pid += 1
+        pid = self.next_pid
+        runtime = behavior.get("runtime", 0.0)
+        exit = None # runs forever
+        if runtime is not None:
+            exit = self.now + runtime
+        self.procs[pid] = { "cmd": cmd, "pgid": pgid or pid, "behavior": behavior, "exit": exit,
+            "exitcode": behavior.get("exitcode", 0), "term": behavior.get("term", 0.0),
+            "forked": False }
+        self.events.append((self.now, "spawn", pid, cmd))
+        return pid
+    def update(self):
+        """ fork the daemons whose starter has finished (writing their pid file) """
+        for pid, proc in self.procs.items():
+            daemon = proc["behavior"].get("daemon")
+            if daemon and not proc["forked"] and proc["exit"] is not None and proc["exit"] <= self.now:
+                proc["forked"] = True
+                child = self.start(proc["cmd"] + " (daemon)", daemon)
+                pid_file = proc["behavior"].get("pid_file")
+                if pid_file:
+                    with open(pid_file, "w") as f:
+                        f.write("%s\n" % child)
+    def time(self):
+        return self.now
+    def sleep(self, seconds):
+        self.now += seconds or 0
+        self.update()
+    def spawn(self, cmd, env = None, preexec = None):
+        return SimulatedRun(self, self.start(cmd, self.behavior(cmd)))
+    def run(self, cmd, env = None, check = False, preexec = None):
+        run = self.spawn(cmd, env, preexec)
+        run.wait()
+        if check and run.returncode:
+            raise Exception("command failed")
+        return run
+    def fork(self, func, atfork = None):
+        exitcode = func() is False and 1 or 0
+        return SimulatedRun(self, self.start("fork", { "runtime": 0.0, "exitcode": exitcode }))
+    def running(self, pid): # -> bool
+        proc = self.procs.get(pid)
+        return proc is not None and (proc["exit"] is None or proc["exit"] > self.now)
+    def kill(self, pid, signum):
+        if not self.running(pid):
+            raise OSError(errno.ESRCH, "No such process")
+        if not signum:
+            return
+        self.events.append((self.now, "kill", pid, signum))
+        proc = self.procs[pid]
+        if signum == signal.SIGKILL:
+            proc["exit"], proc["exitcode"] = self.now, -signum
+        elif proc["term"] is not None:
+            if proc["exit"] is None or proc["exit"] > self.now + proc["term"]:
+                proc["exit"], proc["exitcode"] = self.now + proc["term"], -signum
+    def killpg(self, pgid, signum):
+        members = [ pid for pid, proc in self.procs.items() if proc["pgid"] == pgid and self.running(pid) ]
+        if not members:
+            raise OSError(errno.ESRCH, "No such process")
+        for pid in members:
+            self.kill(pid, signum)
+    def exists(self, pid):
+        return self.running(pid)
+    def zombie(self, pid):
+        return False
+    def group_leader(self, pid):
+        return pid in self.procs and self.procs[pid]["pgid"] == pid
+    def group_running(self, pgid):
+        return bool([ pid for pid, proc in self.procs.items() if proc["pgid"] == pgid and self.running(pid) ])
+    def reap(self):
+        return []
+
 _sysd_default = "multi-user.target"
 _sysd_folder1 = "/usr/lib/systemd/system"
 _sysd_folder2 = "/etc/systemd/system"
 _sysv_folder1 = "/etc/init.d"
 _sysv_folder2 = "/var/run/init.d"
+_lock_folder = "/var/run/systemctl"
+_lib_folder = "/var/lib/systemctl"
 _waitprocfile = 100
 _waitkillproc = 10
+_stop_timeout = 8 # docker stop does SIGKILL after 10 seconds
 _force = False
 _quiet = False
 _full = False
 _property = None
+_output = None
+_metrics = None # /run/systemctl.prom or unix:/run/systemctl.metrics.sock
+_metrics_interval = 15
+_instances = None # "auto" or a number (for starting a template unit)
+_syslog = None # /dev/log or stream:/dev/log (bound by the init process)
+_syslog_queue = 1000
+_memory_pressure = None # "60%" of the time some task is stalled on memory (in a 2s window)
+_log_folder = "/var/log/journal"
+_no_block = False # start/stop/restart are queued as jobs for a worker
+_max_unavailable = "1" # units of a rolling-restart wave (or "25%")
+_jobs = 1 # units started in parallel at boot (or "auto" by the cpus)
+_connect_timeout = 5 # for the control sockets of -H/-M
+_reply_timeout = 300 # for the answers of -H/-M
+_journal_units = None # journal -u UNIT
+_journal_follow = False
+_since = None
+_until = None
+_lines = None
 
 class Systemctl:
-    def __init__(self):
+    def __init__(self, processes = None):
+        self._proc = processes or Processes()
         self._sysd_folder1 = _sysd_folder1
         self._sysd_folder2 = _sysd_folder2
         self._sysv_folder1 = _sysv_folder1
         self._sysv_folder2 = _sysv_folder2
+        self._lock_folder = _lock_folder
+        self._lib_folder = _lib_folder
         self._waitprocfile = _waitprocfile
         self._waitkillproc = _waitkillproc
+        self._stop_timeout = _stop_timeout
         self._force = _force
         self._quiet = _quiet
         self._full = _full
+        self._output = _output
+        self._exitcode = 0 # of a streamed result
+        self._metrics = _metrics
+        self._metrics_interval = _metrics_interval
+        self._instances = _instances
+        self._syslog = _syslog
+        self._memory_pressure = _memory_pressure
+        self._log_folder = _log_folder
+        self._no_block = _no_block
+        self._max_unavailable = _max_unavailable
+        self._jobs = _jobs
+        self._journal_units = _journal_units
+        self._journal_follow = _journal_follow
+        self._since = _since
+        self._until = _until
+        self._lines = _lines
         self._loaded_file_sysv = {} # /etc/init.d/name => config data
+        self._cache_units = True
         self._loaded_file_sysd = {} # /etc/systemd/system/name.service => config data
         self._file_for_unit_sysv = None # name.service => /etc/init.d/name
         self._file_for_unit_sysd = None # name.service => /etc/systemd/system/name.service
+        self._enabled_links = None # name.service => set(*.wants/ links), initname => set(rc links)
+        self._sockets = {} # name.socket => (name.service, [ listening sockets ])
+        self._sockets_activated = {} # name.socket => service conf (not listened to)
+        self._boot_time = time.time()
+        self._timers = {} # name.timer => (conf, activation time)
+        self._timers_heap = [] # [ (wakeup, deadline, name.timer) ]
+        self._timers_deadline = {} # name.timer/name.path => deadline (drop other heap entries)
+        self._timers_elapsed = {} # name.timer => last time it has fired
+        self._timers_triggered = {} # name.service => last time a timer started it
+        self._paths = {} # name.path => conf
+        self._path_triggers = {} # name.path => [ start of the TriggerLimitIntervalSec, triggers ]
+        self._path_watches = {} # wd => [ (name.path, setting, path, name in the folder?) ]
+        self._inotify = None
+        self._loop_readers = {} # fileno => handler (of the 'wait' loop)
+        self._unit_stats = {} # name.service => { "starts": n, "start_seconds": x, .. }
+        self._unit_pids = {} # pid => name.service (of the last metrics sample)
+        self._loop_stats = { "wakeups": 0, "loop_seconds": 0.0, "loop_seconds_max": 0.0 }
+        self._metrics_next = None
+        self._locks = {} # name => [ fd, count ] (of lock files held)
+        self._runtime = {} # name.service => { "pid_file": .., "pid": .. } (compact records)
+        self._syslog_socket = None
+        self._syslog_conns = {} # fileno => (socket, pid by SO_PEERCRED, buffered text)
+        self._syslog_queue = collections.deque(maxlen = _syslog_queue) # (time, pid, text)
+        self._syslog_dropped = 0
+        self._pid_units = {} # pid => name.service (attribution of syslog messages)
+        self._unit_states = {} # name.service => the last published state (in the init process)
+        self._stopping_pids = {} # pid => name.service of a published "deactivating"
+        self._loop_exceptions = {} # fileno => handler (a POLLPRI for select)
+        self._pressure_file = None
+        self._pressure_next = 0 # no action before (a cooldown)
+        self._metrics_text = ""
+        self._job_worker = False # the 'wait' loop runs the queued jobs
+        self._job_workers = {} # job id => (job, forked call)
+        self._follow = False # flush each line of a streamed result
+        self._notify_sockets = {} # name.service => NOTIFY_SOCKET (of a rolling-restart)
+        self._board = None # mmap of the status board (of the init process)
+        self._boot_id = None # start time of the init process (of this container run)
+        self._events_socket = None # bound by the init process
+        self._events_client = None # the sender in any other process
+        self._monitor_socket = None
+        self._monitor_conns = {} # fileno => [ socket, [ patterns ]?, pending text ]
+        self._control_socket = None
+        self._control_conns = {} # fileno => [ socket, partial line, accept time ]
+        self._init_loop = False # this is the 'wait' loop (or its boot)
+        self._journal_index = {} # name.service => offset of the last UNIT.idx entry
     def unit_file(self, module = None): # -> filename?
         """ file path for the given module (sysv or systemd) """
         path = self.unit_sysd_file(module)
@@ -282,7 +1152,7 @@ class Systemctl:
         path = self.unit_sysv_file(module)
         if path is not None: return path
         return None
-    def scan_unit_sysd_files(self, module = None): # -> [ unit-names,... ]
+    def scan_unit_sysd_files(self, module = None): # -> generate[ unit-names,... ]
         """ reads all unit files, returns the last filename for the unit given """
         if self._file_for_unit_sysd is None:
             self._file_for_unit_sysd = {}
@@ -293,7 +1163,7 @@ class Systemctl:
                     path = os.path.join(folder, name)
                     self._file_for_unit_sysd[name] = path
             logg.debug("found %s sysd files", len(self._file_for_unit_sysd))
-        return self._file_for_unit_sysd.keys()
+        return self._file_for_unit_sysd.iterkeys()
     def unit_sysd_file(self, module = None): # -> filename?
         """ file path for the given module (systemd) """
         self.scan_unit_sysd_files()
@@ -301,8 +1171,24 @@ class Systemctl:
             return self._file_for_unit_sysd[module]
         if module and module+".service" in self._file_for_unit_sysd:
             return self._file_for_unit_sysd[module+".service"]
+        for name in (module, (module or "")+".service"):
+            template = unit_template(name)
+            if template and template[1] and template[0] in self._file_for_unit_sysd:
+                return self._file_for_unit_sysd[template[0]]
         return None
-    def scan_unit_sysv_files(self, module = None): # -> [ unit-names,... ]
+    def unit_name(self, module): # -> name.service
+        """ the full unit name of an instance (or the known unit) """
+        self.scan_unit_sysd_files()
+        if module in self._file_for_unit_sysd:
+            return module
+        if module+".service" in self._file_for_unit_sysd:
+            return module+".service"
+        if unit_template(module):
+            return module
+        if unit_template(module+".service"):
+            return module+".service"
+        return module
+    def scan_unit_sysv_files(self, module = None): # -> generate[ unit-names,... ]
         """ reads all init.d files, returns the last filename when unit is a '.service' """
         if self._file_for_unit_sysv is None:
             self._file_for_unit_sysv = {}
@@ -313,7 +1199,7 @@ class Systemctl:
                     path = os.path.join(folder, name)
                     self._file_for_unit_sysv[name+".service"] = path
             logg.debug("found %s sysv files", len(self._file_for_unit_sysv))
-        return self._file_for_unit_sysv.keys()
+        return self._file_for_unit_sysv.iterkeys()
     def unit_sysv_file(self, module = None): # -> filename?
         """ file path for the given module (sysv) """
         self.scan_unit_sysv_files()
@@ -322,6 +1208,12 @@ class Systemctl:
         if module and module+".service" in self._file_for_unit_sysv:
             return self._file_for_unit_sysv[module+".service"]
         return None
+    def get_unit_type(self, module): # -> text?
+        """ the unit type is the suffix of the unit name (".service", ".socket") """
+        if not module: return None
+        name = os.path.basename(module)
+        if "." not in name: return None
+        return name[name.rfind("."):]
     def is_sysv_unit(self, module): # -> bool?
         """ for routines that have a special treatment for init.d services """
         self.unit_file() # scan all
@@ -333,8 +1225,11 @@ class Systemctl:
         """ for routines that have a special treatment for init.d services """
         self.unit_file() # scan all
         if not filename: return None
-        if filename in self._file_for_unit_sysd.values(): return False
-        if filename in self._file_for_unit_sysv.values(): return True
+        folder, name = os.path.split(filename)
+        if folder in (self._sysd_folder1, self._sysd_folder2):
+            if self._file_for_unit_sysd.get(name) == filename: return False
+        if folder in (self._sysv_folder1, self._sysv_folder2):
+            if self._file_for_unit_sysv.get(name+".service") == filename: return True
         return None # not True
     def read_unit(self, module): # -> conf | not-found
         """ read the unit file with a UnitParser (sysv or systemd) """
@@ -350,21 +1245,39 @@ class Systemctl:
         """ read the unit file with a UnitParser (systemd) """
         path = self.unit_sysd_file(module)
         if not path: return None
-        return self.read_sysd_file(path)
-    def read_sysd_file(self, path): # -> conf?
-        """ read the unit file with a UnitParser (systemd) """
+        return self.read_sysd_file(path, self.unit_name(module))
+    def read_sysd_file(self, path, name = None): # -> conf?
+        """ read the unit file with a UnitParser (systemd) - a template
+            is read for each instance with its own specifier values """
         if path is None: return None
-        if path in self._loaded_file_sysd:
-            return self._loaded_file_sysd[path]
+        name = name or os.path.basename(path)
+        key = os.path.join(os.path.dirname(path), name)
+        if key in self._loaded_file_sysd:
+            return self._loaded_file_sysd[key]
         unit = UnitParser()
         unit.read_sysd(path)
         override_d = path + ".d"
         if os.path.isdir(override_d):
-            for name in os.listdir(override_d):
-                if name.endswith(".conf"):
-                    unit.read_sysd(os.path.join(override_d, name))
-        self._loaded_file_sysd[path] = unit
+            for conf in os.listdir(override_d):
+                if conf.endswith(".conf"):
+                    unit.read_sysd(os.path.join(override_d, conf))
+        unit._name = name
+        unit.expand_specifiers(self.specifiers(name))
+        if self._cache_units:
+            self._loaded_file_sysd[key] = unit
         return unit
+    def specifiers(self, unit): # -> { "i": instance, .. }
+        """ the %-specifiers of a unit (name@instance.service) """
+        name, prefix, instance = unit, unit, ""
+        if "." in unit:
+            name = prefix = unit[:unit.rfind(".")]
+        template = unit_template(unit)
+        if template:
+            prefix, instance = template[0][:template[0].rfind("@")], template[1]
+        return { "n": unit, "N": name, "p": prefix,
+                 "i": instance, "I": unit_unescape(instance),
+                 "t": os.path.isdir("/run") and "/run" or "/var/run",
+                 "H": socket.gethostname(), "%": "%" }
     def read_sysv_unit(self, module): # -> conf?
         """ read the unit file with a UnitParser (sysv) """
         path = self.unit_sysv_file(module)
@@ -377,7 +1290,8 @@ class Systemctl:
             return self._loaded_file_sysv[path]
         unit = UnitParser()
         unit.read_sysv(path)
-        self._loaded_file_sysv[path] = unit
+        if self._cache_units:
+            self._loaded_file_sysv[path] = unit
         return unit
     def default_unit(self, module): # -> conf
         """ a unit conf that can be printed to the user where
@@ -398,26 +1312,65 @@ class Systemctl:
     def match_units(self, modules, suffix=".service"): # -> [ units,.. ]
         """ call for about any command with multiple units which can
             actually be glob patterns on their respective filename. """
-        found = []
-        for unit in self.match_sysd_units(modules, suffix):
-            if unit not in found:
-                found.append(unit)
-        for unit in self.match_sysv_units(modules, suffix):
-            if unit not in found:
-                found.append(unit)
-        return found
+        return list(self.iter_units(modules, suffix))
+    def iter_units(self, modules, suffix=".service"): # -> generate[ unit ]
+        """ the sysd matches before the sysv matches (each of them sorted) """
+        if isinstance(modules, basestring):
+            modules = [ modules ]
+        modules = [ expanded for module in modules for expanded in self.expand_instances(module) ]
+        found = set()
+        for units in (self.match_sysd_units(modules, suffix), self.match_sysv_units(modules, suffix)):
+            for unit in units:
+                if unit not in found:
+                    found.add(unit)
+                    yield unit
+    def expand_instances(self, module): # -> [ module,.. ]
+        """ brace expansion and "name@" with --instances (1..N or 'auto' cpus) """
+        if module.endswith("@") and self._instances:
+            if self._instances == "auto":
+                return [ module + str(cpu) for cpu in available_cpus() ]
+            return [ module + str(n) for n in xrange(1, int(self._instances) + 1) ]
+        if module.endswith("@.service") and self._instances:
+            return [ name + ".service" for name in self.expand_instances(module[:-len(".service")]) ]
+        return expand_braces(module)
     def match_sysd_units(self, modules, suffix=".service"): # -> generate[ unit ]
         """ make a file glob on all known units (systemd areas) """
         if isinstance(modules, basestring):
             modules = [ modules ]
         self.scan_unit_sysd_files()
-        for item in sorted(self._file_for_unit_sysd.keys()):
+        instances = set()
+        for module in modules:
+            for name in (module, module+suffix):
+                template = unit_template(name)
+                if template and template[1] and template[0] in self._file_for_unit_sysd:
+                    if re.search(r"[*?\[]", template[1]):
+                        # "worker@*" are the instances that have been started
+                        for unit in self.started_instances():
+                            if fnmatch.fnmatchcase(unit, name):
+                                instances.add(unit)
+                    else:
+                        instances.add(name)
+                    break
+        for item in heapq.merge(sorted(self._file_for_unit_sysd.keys()), sorted(instances)):
             if not modules:
                 yield item
+            elif item in instances:
+                yield item
             elif [ module for module in modules if fnmatch.fnmatchcase(item, module) ]:
                 yield item
             elif [ module for module in modules if module+suffix == item ]:
                 yield item
+    def started_instances(self): # -> generate[ name@instance.service ]
+        """ the instances of the template units with a pid file (in the default place) """
+        folder = os.path.dirname(self.default_pid_file("unit"))
+        if not os.path.isdir(folder):
+            return
+        for name in os.listdir(folder):
+            if not name.endswith(".pid"):
+                continue
+            template = unit_template(name[:-len(".pid")])
+            if template and template[1] and template[0] in self._file_for_unit_sysd:
+                yield name[:-len(".pid")]
     def match_sysv_units(self, modules, suffix=".service"): # -> generate[ unit ]
         """ make a file glob on all known units (sysv areas) """
         if isinstance(modules, basestring):
@@ -433,26 +1386,37 @@ class Systemctl:
     def system_list_services(self):
         """ show all the services """
         filename = self.unit_file() # scan all
-        result = ""
-        for name, value in self._file_for_unit_sysd.items():
-            result += "\nSysD {name} = {value}".format(**locals())
-        for name, value in self._file_for_unit_sysv.items():
-            result += "\nSysV {name} = {value}".format(**locals())
-        return result
-    def show_list_units(self, *modules): # -> [ (unit,loaded,description) ]
+        for name in sorted(self._file_for_unit_sysd):
+            value = self._file_for_unit_sysd[name]
+            yield "SysD {name} = {value}\n".format(**locals())
+        for name in sorted(self._file_for_unit_sysv):
+            value = self._file_for_unit_sysv[name]
+            yield "SysV {name} = {value}\n".format(**locals())
+    def each_unit_conf(self, modules): # -> generate[ (unit, conf) ]
+        """ the parsed units in sorted order - they are not kept in the
+            cache, so that a listing of all units runs in constant memory """
+        for unit in self.iter_units(modules):
+            yield unit, self.try_read_unit_once(unit)
+    def try_read_unit_once(self, module): # -> conf
+        """ like try_read_unit but a unit not cached yet is not added """
+        cache, self._cache_units = self._cache_units, False
+        try:
+            return self.try_read_unit(module)
+        finally:
+            self._cache_units = cache
+    def show_list_units(self, *modules): # -> generate[ text ]
         """ show all the units """
-        result = {}
-        description = {}
-        for unit in self.match_units(modules):
-            result[unit] = None
-            description[unit] = ""
-            try: 
-                conf = self.try_read_unit(unit)
-                result[unit] = conf
-                description[unit] = self.get_description_from(conf)
+        if self._output == "json":
+            return json_list([ ("unit", unit), ("load", load), ("description", description) ]
+                             for unit, load, description in self.each_list_units(modules))
+        return ("\t".join(item) + "\n" for item in self.each_list_units(modules))
+    def each_list_units(self, modules): # -> generate[ (unit,loaded,description) ]
+        for unit, conf in self.each_unit_conf(modules):
+            try:
+                yield unit, conf.loaded() and "loaded" or "", self.get_description_from(conf)
             except Exception, e:
                 logg.warning("list-units: %s", e)
-        return [ (unit, result[unit] and "loaded" or "", description[unit]) for unit in sorted(result) ]
+                yield unit, "", ""
     def get_description_from(self, conf, default = None): # -> text
         """ Unit.Description could be empty sometimes """
         if not conf: return default or ""
@@ -472,7 +1436,7 @@ class Systemctl:
     def pid_exists(self, pid): # -> bool
         """ check if a pid does still exist (unix standard) """
         # return os.path.isdir("/proc/%s" % pid) # (linux standard) 
-        return pid_exists(pid)
+        return self._proc.exists(pid)
     def wait_pid_file(self, pid_file): # -> pid?
         """ wait some seconds for the pid file to appear and return the pid """
         dirpath = os.path.dirname(os.path.abspath(pid_file))
@@ -483,7 +1447,7 @@ class Systemctl:
             pid = self.read_pid_file(pid_file)
             if not pid:
                 continue
-            if not pid_exists(pid):
+            if not self.pid_exists(pid):
                 continue
             return pid
         return None
@@ -539,7 +1503,7 @@ class Systemctl:
     def sleep(self, seconds = None): 
         """ just sleep """
         seconds = seconds or 1
-        time.sleep(seconds)
+        self._proc.sleep(seconds)
     def sudo_from(self, conf):
         """ calls runuser with a (non-priviledged) user """
         runuser = conf.get("Service", "User", "")
@@ -553,6 +1517,8 @@ class Systemctl:
             sudo = "/usr/sbin/runuser -g %s -- " % (rungroup)
         return sudo
     def start_of_units(self, *modules):
+        if self._no_block:
+            return self.enqueue_jobs("start", modules)
         done = True
         for unit in self.match_units(modules):
             if not self.start_unit(unit):
@@ -561,38 +1527,175 @@ class Systemctl:
     def start_unit(self, unit):
         conf = self.read_unit(unit)
         return self.start_unit_from(conf)
-    def start_unit_from(self, conf):
+    def start_unit_from(self, conf, listen = None):
         if not conf: return
+        if self.lives_in_manager(conf):
+            return self.manager_command("start", conf)
+        locks = self.lock_unit_from(conf)
+        try:
+            if self.is_started_from(conf):
+                logg.info("%s is already active", conf.name())
+                return True
+            started = self._proc.time()
+            done = self.transition_from(conf, "starting", self.do_start_unit_from, listen)
+            if done and self.get_unit_type(conf.filename()) in [ ".service", None ]:
+                self.record_start_from(conf, self._proc.time() - started)
+            return done
+        finally:
+            self.unlock(*locks)
+    def lives_in_manager(self, conf): # -> bool
+        """ the sockets, timers and path watches are held by the init loop - a
+            systemctl call outside of it has to send the command there """
+        if self._init_loop:
+            return False
+        return self.get_unit_type(conf.filename()) in [ ".socket", ".timer", ".path" ]
+    def manager_command(self, command, conf): # -> bool
+        path = self.control_path()
+        if not os.path.exists(path):
+            logg.error("%s: needs the init loop of systemctl.py (no %s)", conf.name(), path)
+            return False
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(_reply_timeout)
+            sock.connect(path)
+            sock.sendall("%s %s\n" % (command, pipes.quote(conf.name())))
+            answer = json.loads(sock.makefile("r").readline())
+        except (socket.error, ValueError), e:
+            logg.error("%s: %s %s: %s", path, command, conf.name(), e)
+            return False
+        finally:
+            sock.close()
+        sys.stdout.write(answer.get("output") or "")
+        return answer.get("exitcode") == 0
+    def transition_from(self, conf, state, func, *args): # -> result of func
+        """ publish the state before and after a start/stop/reload/restart
+            for the subscribers of the 'monitor' socket """
+        self.publish_from(conf, state)
+        done = False
+        try:
+            done = func(conf, *args)
+        finally:
+            if done is False:
+                self.publish_from(conf, "failed")
+            elif state == "deactivating":
+                self.publish_from(conf, "inactive")
+            elif self.is_oneshot_from(conf) and not self.is_active_from(conf):
+                self.publish_from(conf, "inactive")
+            else:
+                self.publish_from(conf, "active")
+        return done
+    def is_started_from(self, conf):
+        """ a parallel 'start' may have won the race on the unit lock """
+        if self.get_unit_type(conf.filename()) not in [ ".service", None ]:
+            return False
+        if conf.get("Service", "Type", "simple").lower() not in [ "simple", "notify", "forking", "oneshot" ]:
+            return False
+        return self.is_active_from(conf)
+    def lock_unit_from(self, conf): # -> [ names ]
+        """ state-changing commands hold the manager lock shared
+            and the unit lock exclusively while they are running """
+        return [ self.lock("manager", exclusive = False), self.lock(conf.name()) ]
+    def lock(self, name, exclusive = True): # -> name
+        """ an advisory fcntl.flock on /var/run/systemctl/NAME.lock which is
+            reentrant - a lock held already is only counted up again """
+        if name in self._locks:
+            self._locks[name][1] += 1
+            return name
+        fd = None
+        try:
+            if not os.path.isdir(self._lock_folder):
+                os.makedirs(self._lock_folder)
+            fd = os.open(os.path.join(self._lock_folder, name + ".lock"), os.O_RDWR | os.O_CREAT, 0600)
+            fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+            mode = exclusive and fcntl.LOCK_EX or fcntl.LOCK_SH
+            try:
+                fcntl.flock(fd, mode | fcntl.LOCK_NB)
+            except IOError:
+                logg.info("waiting for the %s lock on %s", exclusive and "exclusive" or "shared", name)
+                fcntl.flock(fd, mode)
+        except (IOError, OSError), e:
+            logg.debug("no lock on %s: %s", name, e)
+        self._locks[name] = [ fd, 1 ]
+        return name
+    def unlock(self, *names):
+        for name in reversed(names):
+            if name not in self._locks:
+                continue
+            self._locks[name][1] -= 1
+            if self._locks[name][1] > 0:
+                continue
+            fd, count = self._locks.pop(name)
+            if fd is not None:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+                os.close(fd)
+    def record_start_from(self, conf, seconds):
+        """ the start latency and the number of (re)starts for the metrics """
+        unit = conf.name()
+        if unit in self._runtime:
+            self._runtime[unit]["pid_file"] = self.get_pid_file_from(conf)
+        stats = self._unit_stats.setdefault(unit, { "starts": 0, "reaped_cpu_seconds": 0.0 })
+        stats["starts"] += 1
+        stats["start_seconds"] = seconds
+        stats["started"] = self._proc.time()
+    def do_start_unit_from(self, conf, listen = None):
+        if self.get_unit_type(conf.filename()) == ".socket":
+            return self.start_socket_from(conf)
+        if self.get_unit_type(conf.filename()) == ".timer":
+            return self.start_timer_from(conf)
+        if self.get_unit_type(conf.filename()) == ".path":
+            return self.start_path_from(conf)
         runs = conf.get("Service", "Type", "simple").lower()
         sudo = self.sudo_from(conf)
         env = self.get_env(conf)
+        preexec = None
+        if listen:
+            env["LISTEN_FDS"] = str(len(listen))
+            preexec = listen_fds_passing([ sock.fileno() for sock in listen ], env)
+            sudo = "exec " + sudo # LISTEN_PID is the pid of the shell otherwise
+        preexec = self.exec_settings_from(conf, preexec)
         logg.info("env = %s", env)
         if True:
             for cmd in conf.getlist("Service", "ExecStartPre", []):
                 check, cmd = checkstatus(cmd)
                 logg.info("ExecStartPre:%s:%s", check, cmd)
-                subprocess_wait(cmd, env, check=check)
+                self._proc.run(cmd, env, check=check)
         if runs in [ "sysv" ]:
             if True:
                  exe = conf.filename()
                  cmd = "'%s' start" % exe
                  env["SYSTEMCTL_SKIP_REDIRECT"] = "yes"
                  logg.info("(start) %s", cmd)
-                 run = subprocess_wait(cmd, env)
-        elif runs in [ "simple", "oneshot", "notify" ]: 
+                 run = self._proc.run(cmd, env, preexec=preexec)
+        elif runs in [ "oneshot" ]:
+            exitcode = 0
+            for cmd in conf.getlist("Service", "ExecStart", []):
+                 check, cmd = checkstatus(cmd)
+                 logg.info("[start] %s", sudo+cmd)
+                 run = self._proc.run(sudo+cmd, env, preexec=self.session_from(conf, preexec))
+                 exitcode = run.returncode
+                 if check and run.returncode:
+                     logg.error("%s: ExecStart exited with %s", conf.name(), run.returncode)
+                     self.write_status_from(conf, "failed", run.returncode)
+                     return False
+            if self.remain_after_exit_from(conf):
+                self.write_status_from(conf, "active", exitcode)
+            else:
+                self.write_status_from(conf, "inactive", exitcode)
+        elif runs in [ "simple", "notify" ]: 
+            if runs in [ "notify" ] and conf.name() in self._notify_sockets:
+                env["NOTIFY_SOCKET"] = self._notify_sockets[conf.name()].getsockname()
             for cmd in conf.getlist("Service", "ExecStart", []):
                  pid_file = self.get_pid_file_from(conf)
                  pid = self.read_pid_file(pid_file, "")
                  env["MAINPID"] = str(pid)
                  logg.info("[start] %s", sudo+cmd)
-                 run = subprocess_nowait(sudo+cmd, env)
+                 run = self._proc.spawn(sudo+cmd, env, self.session_from(conf, preexec))
                  self.write_pid_file(pid_file, run.pid)
-                 if runs in [ "oneshot" ]: run.wait()
         elif runs in [ "forking" ]:
             for cmd in conf.getlist("Service", "ExecStart", []):
                  check, cmd = checkstatus(cmd)
                  logg.info("{start} %s", sudo+cmd)
-                 run = subprocess_wait(sudo+cmd, env)
+                 run = self._proc.run(sudo+cmd, env, preexec=preexec)
                  if check and run.returncode: raise Exception("ExecStart")
                  pid_file = self.get_pid_file_from(conf)
                  self.wait_pid_file(pid_file)
@@ -603,8 +1706,151 @@ class Systemctl:
             for cmd in conf.getlist("Service", "ExecStartPost", []):
                 check, cmd = checkstatus(cmd)
                 logg.info("ExecStartPost:%s:%s", check, cmd)
-                subprocess_wait(cmd, env, check=check)
+                self._proc.run(cmd, env, check=check)
         return True
+    rlimits = { "LimitCPU": "RLIMIT_CPU", "LimitFSIZE": "RLIMIT_FSIZE",
+        "LimitDATA": "RLIMIT_DATA", "LimitSTACK": "RLIMIT_STACK", "LimitCORE": "RLIMIT_CORE",
+        "LimitRSS": "RLIMIT_RSS", "LimitNOFILE": "RLIMIT_NOFILE", "LimitAS": "RLIMIT_AS",
+        "LimitNPROC": "RLIMIT_NPROC", "LimitMEMLOCK": "RLIMIT_MEMLOCK",
+        "LimitLOCKS": "RLIMIT_LOCKS", "LimitSIGPENDING": "RLIMIT_SIGPENDING",
+        "LimitMSGQUEUE": "RLIMIT_MSGQUEUE", "LimitNICE": "RLIMIT_NICE",
+        "LimitRTPRIO": "RLIMIT_RTPRIO", "LimitRTTIME": "RLIMIT_RTTIME" }
+    io_classes = { "none": 0, "realtime": 1, "best-effort": 2, "idle": 3 }
+    cpu_policies = { "other": 0, "fifo": 1, "rr": 2, "batch": 3, "idle": 5 }
+    def exec_settings_from(self, conf, preexec = None): # -> preexec function?
+        """ the resource settings (Nice=, CPUAffinity=, IOScheduling*=,
+            CPUScheduling*=, Limit*=, OOMScoreAdjust= and the cgroup limits)
+            are applied in the child before exec - no wrapper processes """
+        settings = []
+        nice = conf.get("Service", "Nice", "")
+        if nice:
+            settings.append(lambda: os.nice(int(nice) - os.nice(0)))
+        cpus = conf.get("Service", "CPUAffinity", "")
+        if cpus:
+            cpu_list = parse_cpu_list(cpus)
+            settings.append(lambda: set_cpu_affinity(cpu_list))
+        ioclass = conf.get("Service", "IOSchedulingClass", "")
+        iolevel = conf.get("Service", "IOSchedulingPriority", "")
+        if ioclass or iolevel:
+            ioclass_nr = self.io_classes.get(ioclass.lower())
+            if ioclass_nr is None and ioclass.isdigit():
+                ioclass_nr = int(ioclass)
+            if ioclass_nr is None:
+                ioclass_nr = 2 # best-effort
+            iolevel_nr = int(iolevel or "4")
+            settings.append(lambda: set_io_priority(ioclass_nr, iolevel_nr))
+        policy = conf.get("Service", "CPUSchedulingPolicy", "")
+        if policy:
+            policy_nr = self.cpu_policies[policy.lower()]
+            priority = int(conf.get("Service", "CPUSchedulingPriority", policy_nr in [1, 2] and "1" or "0"))
+            settings.append(lambda: set_cpu_scheduling(policy_nr, priority))
+        for name, rlimit in sorted(self.rlimits.items()):
+            text = conf.get("Service", name, "")
+            if not text or not hasattr(resource, rlimit): continue
+            soft, hard = (text.split(":", 1) + [ text ])[:2]
+            try:
+                limit = [ rlimit_value(name, soft), rlimit_value(name, hard) ]
+            except ValueError, e:
+                logg.warning("%s: ignoring %s=%s: %s", conf.name(), name, text, e)
+                continue
+            infinity = resource.RLIM_INFINITY
+            if rlimit == "RLIMIT_NOFILE":
+                infinity = nofile_maximum()
+            limit = tuple([ x is None and infinity or x for x in limit ])
+            resource_nr = getattr(resource, rlimit)
+            settings.append(lambda resource_nr=resource_nr, limit=limit: resource.setrlimit(resource_nr, limit))
+        oom = conf.get("Service", "OOMScoreAdjust", "")
+        if oom:
+            settings.append(lambda: open("/proc/self/oom_score_adj", "w").write(oom))
+        cgroup = self.cgroup_from(conf)
+        if cgroup:
+            settings.append(lambda: open(os.path.join(cgroup, "cgroup.procs"), "w").write("0"))
+        if not settings:
+            return preexec
+        def apply_settings():
+            for setting in settings:
+                setting()
+            if preexec: preexec()
+        return apply_settings
+    _cgroup_root = "/sys/fs/cgroup"
+    def cgroup_from(self, conf): # -> folder?
+        """ CPUQuota=, MemoryMax= and IOWeight= need a writable cgroup v2 where
+            the unit gets a subgroup below the cgroup of this manager """
+        limits = {}
+        quota = conf.get("Service", "CPUQuota", "")
+        if quota:
+            try:
+                limits["cpu.max"] = "%i 100000" % (float(quota.rstrip("%")) * 1000)
+            except ValueError, e:
+                logg.warning("%s: ignoring CPUQuota=%s: %s", conf.name(), quota, e)
+        memory = conf.get("Service", "MemoryMax", "") or conf.get("Service", "MemoryLimit", "")
+        if memory:
+            try:
+                total = memory.strip().endswith("%") and self.memory_total() or None
+                limits["memory.max"] = str(size_to_bytes(memory, total) or "max")
+            except (IOError, OSError, ValueError), e:
+                logg.warning("%s: ignoring MemoryMax=%s: %s", conf.name(), memory, e)
+        weight = conf.get("Service", "IOWeight", "")
+        if weight:
+            limits["io.weight"] = "default %s" % weight
+        if not limits:
+            return None
+        unit = conf.name()
+        if not os.path.isfile(os.path.join(self._cgroup_root, "cgroup.controllers")):
+            logg.warning("%s: no cgroup v2 - ignoring %s", unit, " ".join(sorted(limits)))
+            return None
+        try:
+            parent = self.manager_cgroup()
+            self.enable_cgroup_controllers(parent, [ name.split(".")[0] for name in limits ])
+            folder = os.path.join(parent, unit)
+            if not os.path.isdir(folder):
+                os.mkdir(folder)
+            for name, value in sorted(limits.items()):
+                open(os.path.join(folder, name), "w").write(value)
+            return folder
+        except (IOError, OSError), e:
+            logg.warning("%s: can not set up the cgroup limits: %s", unit, e)
+            return None
+    def memory_total(self): # -> int
+        """ a MemoryMax=N% is relative to the memory.max of the manager's
+            cgroup where that one is limited - otherwise to the MemTotal """
+        try:
+            limit = open(os.path.join(self.manager_cgroup(), "memory.max")).read().strip()
+            if limit.isdigit():
+                return int(limit)
+        except (IOError, OSError):
+            pass
+        return memory_total()
+    def manager_cgroup(self): # -> folder
+        """ the cgroup v2 folder of this process (above its init.scope leaf) """
+        parent = self._cgroup_root
+        for line in open("/proc/self/cgroup"):
+            if line.startswith("0::"):
+                parent = os.path.join(self._cgroup_root, line[3:].strip().lstrip("/"))
+        if os.path.basename(parent) == "init.scope":
+            parent = os.path.dirname(parent)
+        return parent
+    def enable_cgroup_controllers(self, parent, controllers):
+        """ a cgroup v2 with processes of its own can not enable controllers
+            for its subgroups (EBUSY) - so the processes of the manager's
+            cgroup are moved into a leaf init.scope first """
+        subtree_control = os.path.join(parent, "cgroup.subtree_control")
+        subtree = open(subtree_control).read().split()
+        missing = [ controller for controller in controllers if controller not in subtree ]
+        if not missing:
+            return
+        members = open(os.path.join(parent, "cgroup.procs")).read().split()
+        if members:
+            leaf = os.path.join(parent, "init.scope")
+            if not os.path.isdir(leaf):
+                os.mkdir(leaf)
+            for pid in members:
+                try:
+                    open(os.path.join(leaf, "cgroup.procs"), "w").write(pid)
+                except (IOError, OSError), e: # a kernel thread or already gone
+                    logg.debug("can not move %s to %s: %s", pid, leaf, e)
+        for controller in missing:
+            open(subtree_control, "w").write("+" + controller)
     def read_pid_file(self, pid_file, default = None):
         pid = default
         if not pid_file:
@@ -619,20 +1865,41 @@ class Systemctl:
         except:
             logg.warning("bad read of pid file '%s'", pid_file)
         return pid
+    def session_from(self, conf, preexec = None):
+        """ with KillMode=control-group (the default) or process-group the
+            ExecStart runs in a session of its own, so that a stop signal
+            reaches the processes behind the shell - KillMode=process and
+            KillMode=none leave it in the process group of systemctl """
+        mode = conf.get("Service", "KillMode", "control-group").lower()
+        if mode in [ "control-group", "process-group" ]:
+            return new_session(preexec)
+        return preexec
     def kill_pid(self, pid):
+        """ SIGTERM and later SIGKILL - to the process group if the pid is its
+            leader (a simple service runs in its own session of the shell) """
         if not pid:
             return
+        group = self.pid_group_leader(pid)
+        def running():
+            if group: return self._proc.group_running(pid)
+            return self.pid_exists(pid) and not self.pid_zombie(pid)
+        def kill(signum):
+            try:
+                if group: self._proc.killpg(pid, signum)
+                else: self._proc.kill(pid, signum)
+            except OSError, e:
+                logg.debug("kill %s: %s", pid, e)
         for x in xrange(self._waitkillproc):
-            os.kill(pid, signal.SIGTERM)
-            if not self.pid_exists(pid):
+            kill(signal.SIGTERM)
+            if not running():
                 break
             self.sleep(1)
-            if not self.pid_exists(pid):
+            if not running():
                 break
         for x in xrange(self._waitkillproc):
-            if not self.pid_exists(pid):
+            if not running():
                 break
-            os.kill(pid, signal.SIGKILL)
+            kill(signal.SIGKILL)
             self.sleep(1)
     def environment_of_unit(self, unit):
         conf = self.read_unit(unit)
@@ -647,6 +1914,8 @@ class Systemctl:
                 env[name] = value
         return env
     def stop_of_units(self, *modules):
+        if self._no_block:
+            return self.enqueue_jobs("stop", modules)
         done = True
         for unit in self.match_units(modules):
             if not self.stop_unit(unit):
@@ -657,6 +1926,20 @@ class Systemctl:
         return self.stop_unit_from(conf)
     def stop_unit_from(self, conf):
         if not conf: return
+        if self.lives_in_manager(conf):
+            return self.manager_command("stop", conf)
+        locks = self.lock_unit_from(conf)
+        try:
+            return self.transition_from(conf, "deactivating", self.do_stop_unit_from)
+        finally:
+            self.unlock(*locks)
+    def do_stop_unit_from(self, conf):
+        if self.get_unit_type(conf.filename()) == ".socket":
+            return self.stop_socket_from(conf)
+        if self.get_unit_type(conf.filename()) == ".timer":
+            return self.stop_timer_from(conf)
+        if self.get_unit_type(conf.filename()) == ".path":
+            return self.stop_path_from(conf)
         runs = conf.get("Service", "Type", "simple").lower()
         sudo = self.sudo_from(conf)
         env = self.get_env(conf)
@@ -664,14 +1947,14 @@ class Systemctl:
             for cmd in conf.getlist("Service", "ExecStopPre", []):
                 check, cmd = checkstatus(cmd)
                 logg.info("ExecStopPre:%s:%s", check, cmd)
-                subprocess_wait(cmd, env, check=check)
+                self._proc.run(cmd, env, check=check)
         if runs in [ "sysv" ]:
             if True:
                  exe = conf.filename()
                  cmd = "'%s' stop" % exe
                  env["SYSTEMCTL_SKIP_REDIRECT"] = "yes"
                  logg.info("(stop) %s", cmd)
-                 run = subprocess_wait(cmd, env)
+                 run = self._proc.run(cmd, env)
         elif not conf.getlist("Service", "ExecStop", []):
             if True:
                  pid_file = self.get_pid_file_from(conf)
@@ -686,7 +1969,7 @@ class Systemctl:
                  pid = self.read_pid_file(pid_file, "")
                  env["MAINPID"] = str(pid)
                  logg.info("[stop] %s", sudo+cmd)
-                 run = subprocess_nowait(sudo+cmd, env)
+                 run = self._proc.spawn(sudo+cmd, env)
                  # self.write_pid_file(pid_file, run.pid)
                  if runs in [ "oneshot" ]: run.wait()
         elif runs in [ "forking" ]:
@@ -698,7 +1981,7 @@ class Systemctl:
                  check, cmd = checkstatus(cmd)
                  logg.info(" {env} %s", env)
                  logg.info("{stop} %s", sudo+cmd)
-                 run = subprocess_wait(sudo+cmd, env)
+                 run = self._proc.run(sudo+cmd, env)
                  if active:
                      if check and run.returncode: raise Exception("ExecStop")
                  pid_file = self.get_pid_file_from(conf)
@@ -706,11 +1989,13 @@ class Systemctl:
         else:
             logg.error("unsupported run type '%s'", runs)
             raise Exception("unsupported run type")
+        if runs in [ "oneshot" ]:
+            self.write_status_from(conf, "inactive")
         if True:
             for cmd in conf.getlist("Service", "ExecStopPost", []):
                 check, cmd = checkstatus(cmd)
                 logg.info("ExecStopPost:%s:%s", check, cmd)
-                subprocess_wait(cmd, env, check=check)
+                self._proc.run(cmd, env, check=check)
         return True
     def reload_of_units(self, *modules):
         done = True
@@ -723,6 +2008,12 @@ class Systemctl:
         return self.reload_unit_from(conf)
     def reload_unit_from(self, conf):
         if not conf: return
+        locks = self.lock_unit_from(conf)
+        try:
+            return self.transition_from(conf, "reloading", self.do_reload_unit_from)
+        finally:
+            self.unlock(*locks)
+    def do_reload_unit_from(self, conf):
         runs = conf.get("Service", "Type", "simple").lower()
         sudo = self.sudo_from(conf)
         env = self.get_env(conf)
@@ -730,21 +2021,21 @@ class Systemctl:
             for cmd in conf.getlist("Service", "ExecReloadPre", []):
                 check, cmd = checkstatus(cmd)
                 logg.info("ExecReloadPre:%s:%s", check, cmd)
-                subprocess_wait(cmd, env, check=check)
+                self._proc.run(cmd, env, check=check)
         if runs in [ "sysv" ]:
             if True:
                  exe = conf.filename()
                  cmd = "'%s' reload" % exe
                  env["SYSTEMCTL_SKIP_REDIRECT"] = "yes"
                  logg.info("(reload) %s", cmd)
-                 run = subprocess_wait(cmd, env)
+                 run = self._proc.run(cmd, env)
         elif runs in [ "simple", "oneshot", "notify" ]:
             for cmd in conf.getlist("Service", "ExecReload", []):
                  pid_file = self.get_pid_file_from(conf)
                  pid = self.read_pid_file(pid_file, "")
                  env["MAINPID"] = str(pid)
                  logg.info("[reload] %s", sudo+cmd)
-                 run = subprocess_nowait(sudo+cmd, env)
+                 run = self._proc.spawn(sudo+cmd, env)
                  # self.write_pid_file(pid_file, run.pid)
                  if runs in [ "oneshot" ]: run.wait()
         elif runs in [ "forking" ]:
@@ -754,7 +2045,7 @@ class Systemctl:
                  env["MAINPID"] = str(pid)
                  check, cmd = checkstatus(cmd)
                  logg.info("{reload} %s", sudo+cmd)
-                 run = subprocess_nowait(sudo+cmd, env)
+                 run = self._proc.spawn(sudo+cmd, env)
                  if check and run.returncode: raise Exception("ExecReload")
                  pid_file = self.get_pid_file_from(conf)
                  self.wait_pid_file(pid_file)
@@ -765,9 +2056,11 @@ class Systemctl:
             for cmd in conf.getlist("Service", "ExecReloadPost", []):
                 check, cmd = checkstatus(cmd)
                 logg.info("ExecReloadPost:%s:%s", check, cmd)
-                subprocess_wait(cmd, env, check=check)
+                self._proc.run(cmd, env, check=check)
         return True
     def restart_of_units(self, *modules):
+        if self._no_block:
+            return self.enqueue_jobs("restart", modules)
         done = True
         for unit in self.match_units(modules):
             if not self.restart_unit(unit):
@@ -778,6 +2071,151 @@ class Systemctl:
         return self.restart_unit_from(conf)
     def restart_unit_from(self, conf):
         if not conf: return
+        if self.lives_in_manager(conf):
+            return self.manager_command("restart", conf)
+        locks = self.lock_unit_from(conf)
+        try:
+            return self.transition_from(conf, "starting", self.do_restart_unit_from)
+        finally:
+            self.unlock(*locks)
+    def rolling_restart_of_units(self, *modules):
+        """ restart the units in waves of --max-unavailable units where each
+            wave has to be ready before the next one is restarted - the
+            first unit that does not get ready aborts the rolling restart """
+        units = [ unit for unit in self.match_units(modules) if unit_template(unit) != (unit, "") ]
+        if not units:
+            logg.error("no units for %s", " ".join(modules))
+            return False
+        size = self.max_unavailable_of(len(units))
+        for n in xrange(0, len(units), size):
+            confs = [ self.read_unit(unit) for unit in units[n:n+size] ]
+            logg.info("rolling restart %s", " ".join([ conf.name() for conf in confs ]))
+            try:
+                for conf in confs:
+                    self.open_notify_socket_from(conf)
+                    if self.restart_unit_from(conf) is False:
+                        logg.error("rolling restart aborted: %s has failed", conf.name())
+                        return False
+                missing = self.wait_ready_from(confs)
+            finally:
+                for conf in confs:
+                    self.close_notify_socket_from(conf)
+            if missing:
+                logg.error("rolling restart aborted: %s not ready", " ".join(missing))
+                return False
+        return True
+    def max_unavailable_of(self, count): # -> int
+        """ --max-unavailable=N or a percentage of the units (at least one) """
+        text = str(self._max_unavailable or "1").strip()
+        try:
+            if text.endswith("%"):
+                return max(1, int(count * float(text[:-1]) / 100))
+            return max(1, int(text))
+        except ValueError:
+            logg.error("bad --max-unavailable=%s", text)
+            return 1
+    def open_notify_socket_from(self, conf):
+        """ a Type=notify unit gets a NOTIFY_SOCKET for its READY=1 """
+        if conf.get("Service", "Type", "simple").lower() != "notify":
+            return
+        path = os.path.join(self._lock_folder, "notify", conf.name() + ".sock")
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            if os.path.exists(path):
+                os.unlink(path)
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            sock.bind(path)
+            sock.setblocking(0)
+            fcntl.fcntl(sock.fileno(), fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+            os.chmod(os.path.dirname(path), 0755)
+            self.chown_from(conf, path)
+        except (socket.error, OSError), e:
+            logg.warning("notify socket %s: %s", path, e)
+            return
+        self._notify_sockets[conf.name()] = sock
+    def chown_from(self, conf, path):
+        """ a file of the init process handed to a service with User=/Group= """
+        runuser = conf.get("Service", "User", "")
+        rungroup = conf.get("Service", "Group", "")
+        if not runuser and not rungroup:
+            return
+        try:
+            uid, gid = -1, -1
+            if runuser:
+                entry = runuser.isdigit() and pwd.getpwuid(int(runuser)) or pwd.getpwnam(runuser)
+                uid, gid = entry.pw_uid, entry.pw_gid
+            if rungroup:
+                gid = rungroup.isdigit() and int(rungroup) or grp.getgrnam(rungroup).gr_gid
+            os.chown(path, uid, gid)
+        except KeyError, e:
+            logg.warning("%s: unknown user/group %s - %s is made world-writable", conf.name(), e, path)
+            os.chmod(path, 0666)
+    def close_notify_socket_from(self, conf):
+        sock = self._notify_sockets.pop(conf.name(), None)
+        if sock:
+            path = sock.getsockname()
+            sock.close()
+            if os.path.exists(path):
+                os.unlink(path)
+    def wait_ready_from(self, confs): # -> [ units not ready ]
+        """ poll the readiness of the units until their TimeoutStartSec """
+        deadlines, probes, pending = {}, {}, list(confs)
+        for conf in confs:
+            timeout = time_to_seconds(conf.get("Service", "TimeoutStartSec", ""), 90)
+            deadlines[conf.name()] = timeout is not None and self._proc.time() + timeout or None
+        while pending:
+            for conf in list(pending):
+                unit = conf.name()
+                ready = self.ready_from(conf, probes)
+                if ready:
+                    logg.info("%s is ready", unit)
+                    pending.remove(conf)
+                elif ready is False:
+                    return [ conf.name() for conf in pending ]
+                elif deadlines[unit] is not None and self._proc.time() > deadlines[unit]:
+                    logg.error("%s: TimeoutStartSec has passed", unit)
+                    return [ conf.name() for conf in pending ]
+            if pending:
+                self._proc.sleep(0.1)
+        return []
+    def ready_from(self, conf, probes): # -> True | None (not yet) | False (failed)
+        """ a unit is ready when its pid file names a running process, a
+            Type=notify unit after READY=1 and if there is an X-ReadinessProbe=
+            command then after it has returned exitcode 0 (once per second) """
+        unit = conf.name()
+        if self.is_oneshot_from(conf):
+            return not self.is_failed_from(conf)
+        if self.get_unit_type(conf.filename()) not in [ ".service", None ]:
+            return True
+        if conf.get("Service", "Type", "simple").lower() in [ "sysv" ]:
+            return True
+        if self.active_pid_from(conf) is None:
+            logg.error("%s: no running process", unit)
+            return False
+        if unit in self._notify_sockets:
+            while True:
+                try:
+                    text = self._notify_sockets[unit].recv(4096)
+                except socket.error:
+                    break
+                if "READY=1" in text.split("\n"):
+                    self.close_notify_socket_from(conf)
+                    break
+            if unit in self._notify_sockets:
+                return None
+        probe = conf.get("Service", "X-ReadinessProbe", "")
+        if probe:
+            if self._proc.time() < probes.get(unit, 0):
+                return None
+            probes[unit] = self._proc.time() + 1
+            check, cmd = checkstatus(probe)
+            run = self._proc.run(self.sudo_from(conf) + cmd, self.get_env(conf))
+            if run.returncode:
+                logg.debug("%s: X-ReadinessProbe exitcode %s", unit, run.returncode)
+                return None
+        return True
+    def do_restart_unit_from(self, conf):
         runs = conf.get("Service", "Type", "simple").lower()
         sudo = self.sudo_from(conf)
         env = self.get_env(conf)
@@ -785,14 +2223,14 @@ class Systemctl:
             for cmd in conf.getlist("Service", "ExecRestartPre", []):
                 check, cmd = checkstatus(cmd)
                 logg.info("ExecRestartPre:%s:%s", check, cmd)
-                subprocess_wait(cmd, env, check=check)
+                self._proc.run(cmd, env, check=check)
         if runs in [ "sysv" ]:
             if True:
                  exe = conf.filename()
                  cmd = "'%s' restart" % exe
                  env["SYSTEMCTL_SKIP_REDIRECT"] = "yes"
                  logg.info("(restart) %s", cmd)
-                 run = subprocess_wait(cmd, env)
+                 run = self._proc.run(cmd, env)
         elif not conf.getlist("Service", "ExceRestart", []):
             logg.info("(restart) => stop/start")
             self.stop_unit_from(conf)
@@ -803,14 +2241,14 @@ class Systemctl:
                  pid = self.read_pid_file(pid_file, "")
                  env["MAINPID"] = str(pid)
                  logg.info("[restart] %s", sudo+cmd)
-                 run = subprocess_nowait(sudo+cmd, env)
+                 run = self._proc.spawn(sudo+cmd, env)
                  # self.write_pid_file(pid_file, run.pid)
                  if runs in [ "oneshot" ]: run.wait()
         elif runs in [ "forking" ]:
             for cmd in conf.getlist("Service", "ExecRestart", []):
                  check, cmd = checkstatus(cmd)
                  logg.info("{restart} %s", sudo+cmd)
-                 run = subprocess_wait(sudo+cmd, env)
+                 run = self._proc.run(sudo+cmd, env)
                  if check and run.returncode: raise Exception("ExecRestart")
                  pid_file = self.get_pid_file_from(conf)
                  self.wait_pid_file(pid_file)
@@ -821,15 +2259,64 @@ class Systemctl:
             for cmd in conf.getlist("Service", "ExecRestartPost", []):
                 check, cmd = checkstatus(cmd)
                 logg.info("ExecRestartPost:%s:%s", check, cmd)
-                subprocess_wait(cmd, env, check=check)
+                self._proc.run(cmd, env, check=check)
         return True
+    def remain_after_exit_from(self, conf): # -> bool
+        return conf.get("Service", "RemainAfterExit", "no").lower() in [ "yes", "true", "1", "on" ]
+    def get_status_file_from(self, conf): # -> path
+        """ the result of a oneshot unit survives the systemctl call """
+        return os.path.join(self._lock_folder, conf.name() + ".status")
+    def read_status_from(self, conf): # -> { name : value }
+        status = {}
+        status_file = self.get_status_file_from(conf)
+        if not os.path.isfile(status_file):
+            return status
+        try:
+            for line in open(status_file):
+                if "=" in line:
+                    name, value = line.strip().split("=", 1)
+                    status[name] = value
+        except Exception, e:
+            logg.warning("bad status file %s: %s", status_file, e)
+        if status.get("BootId") != self.boot_id():
+            logg.debug("status file %s is from an earlier boot", status_file)
+            return {}
+        return status
+    def boot_id(self): # -> text
+        """ docker keeps /var/run of a restarted container - the start time of
+            its init process tells the status files of this boot apart """
+        if self._boot_id is None:
+            started = self.pid_start_time(1)
+            self._boot_id = started and "%.2f" % started or ""
+        return self._boot_id
+    def write_status_from(self, conf, state, exitcode = None):
+        """ ActiveState is one of active (exited with RemainAfterExit),
+            inactive or failed - the last exit code is kept on stop """
+        status_file = self.get_status_file_from(conf)
+        if exitcode is None:
+            exitcode = self.read_status_from(conf).get("ExecMainStatus", "0")
+        try:
+            if not os.path.isdir(os.path.dirname(status_file)):
+                os.makedirs(os.path.dirname(status_file))
+            with open(status_file + ".tmp", "w") as f:
+                f.write("BootId=%s\n" % self.boot_id())
+                f.write("ActiveState=%s\n" % state)
+                f.write("ExecMainStatus=%s\n" % exitcode)
+                f.write("ExecMainExitTimestamp=%i\n" % self._proc.time())
+            os.rename(status_file + ".tmp", status_file)
+        except (IOError, OSError), e:
+            logg.warning("can not write %s: %s", status_file, e)
+    def is_oneshot_from(self, conf): # -> bool
+        if self.get_unit_type(conf.filename()) not in [ ".service", None ]:
+            return False
+        return conf.get("Service", "Type", "simple").lower() in [ "oneshot" ]
     def get_pid_file(self, unit):
         conf = self.read_unit(unit)
         return self.get_pid_file_from(conf)
     def get_pid_file_from(self, conf, default = None):
         if not conf: return default
         if not conf.filename(): return default
-        unit = os.path.basename(conf.filename())
+        unit = conf.name()
         if default is None:
             default = self.default_pid_file(unit)
         return conf.get("Service", "PIDFile", default)
@@ -839,41 +2326,53 @@ class Systemctl:
             if not self.try_restart(unit):
                 done = False
         return done
-    def try_restart(unit):
+    def try_restart(self, unit):
         conf = self.read_unit(unit)
-        if self.is_active_from(conf):
-            return self.restart_unit_from(conf)
-        return True
+        locks = self.lock_unit_from(conf)
+        try:
+            if self.is_active_from(conf):
+                return self.restart_unit_from(conf)
+            return True
+        finally:
+            self.unlock(*locks)
     def reload_or_restart_of_units(self, *modules):
         done = True
         for unit in self.match_units(modules):
-            if not self.reload_or_start(unit):
+            if not self.reload_or_restart(unit):
                 done = False
         return done
     def reload_or_restart(self, unit):
         conf = self.read_unit(unit)
-        if not self.is_active_from(conf):
-            # try: self.stop_unit_from(conf)
-            # except Exception, e: pass
-            return self.start_unit_from(conf)
-        elif conf.getlist("Service", "ExecReload", []):
-            return self.reload_unit_from(conf)
-        else:
-            return self.restart_unit_from(conf)
+        locks = self.lock_unit_from(conf)
+        try:
+            if not self.is_active_from(conf):
+                # try: self.stop_unit_from(conf)
+                # except Exception, e: pass
+                return self.start_unit_from(conf)
+            elif conf.getlist("Service", "ExecReload", []):
+                return self.reload_unit_from(conf)
+            else:
+                return self.restart_unit_from(conf)
+        finally:
+            self.unlock(*locks)
     def reload_or_try_restart_of_units(self, *modules):
         done = True
         for unit in self.match_units(modules):
             if not self.reload_or_try_restart(unit):
                 done = False
         return done
-    def reload_or_try_restart(unit):
+    def reload_or_try_restart(self, unit):
         conf = self.read_unit(unit)
-        if conf.getlist("Service", "ExecReload", []):
-            return self.reload_unit_from(conf)
-        elif not self.is_active_from(conf):
-            return True
-        else:
-            return self.restart_unit_from(conf)
+        locks = self.lock_unit_from(conf)
+        try:
+            if conf.getlist("Service", "ExecReload", []):
+                return self.reload_unit_from(conf)
+            elif not self.is_active_from(conf):
+                return True
+            else:
+                return self.restart_unit_from(conf)
+        finally:
+            self.unlock(*locks)
     def kill_of_units(self, *modules):
         units = {}
         for unit in self.match_units(modules):
@@ -885,10 +2384,14 @@ class Systemctl:
         self.kill_unit_from(conf)
     def kill_unit_from(self, conf):
         if not conf: return
-        pid_file = self.get_pid_file_from(conf)
-        pid = self.read_pid_file(pid_file)
-        logg.debug("pid_file '%s' => PID %s", pid_file, pid)
-        self.kill_pid(pid)
+        locks = self.lock_unit_from(conf)
+        try:
+            pid_file = self.get_pid_file_from(conf)
+            pid = self.read_pid_file(pid_file)
+            logg.debug("pid_file '%s' => PID %s", pid_file, pid)
+            self.kill_pid(pid)
+        finally:
+            self.unlock(*locks)
     def is_active_of_units(self, *modules):
         """ implements True if any is-active = True """
         units = {}
@@ -915,11 +2418,18 @@ class Systemctl:
         return pid # string!!
     def is_active_from(self, conf):
         if not conf: return False
+        if self.is_oneshot_from(conf):
+           return self.read_status_from(conf).get("ActiveState") == "active"
         if self.active_pid_from(conf) is None:
            return False
         return True
     def active_from(self, conf):
         if not conf: return False
+        if self.is_oneshot_from(conf):
+            state = self.read_status_from(conf).get("ActiveState")
+            if state == "active": return "exited"
+            if state == "failed": return "failed"
+            return "dead"
         pid = self.active_pid_from(conf)
         if pid is None: return "dead"
         return "PID %s" % pid
@@ -936,20 +2446,26 @@ class Systemctl:
         return self.is_failed_from(conf)
     def is_failed_from(self, conf):
         if not conf: return True
+        if self.is_oneshot_from(conf):
+            return self.read_status_from(conf).get("ActiveState") == "failed"
         pid_file = self.get_pid_file_from(conf)
         pid = self.read_pid_file(pid_file)
         logg.debug("pid_file '%s' => PID %s", pid_file, pid)
         return not self.pid_exists(pid)
     def status_of_units(self, *modules):
-        status, result = 0, ""
-        for unit in self.match_units(modules):
-            status1, result1 = self.status_unit(unit)
-            if status1: status = status1
-            if result: result += "\n\n"
-            result += result1
-        return status, result
+        if self._output == "json":
+            return json_list(self.status_json_records(modules))
+        return self.each_status_text(modules)
+    def each_status_text(self, modules): # -> generate[ text ]
+        """ the status of one unit after the other - the exitcode is kept aside """
+        self._exitcode = 0
+        for n, unit in enumerate(self.iter_units(modules)):
+            status, result = self.status_unit(unit)
+            if status: self._exitcode = status
+            if n: yield "\n"
+            yield result + "\n"
     def status_unit(self, unit):
-        conf = self.try_read_unit(unit)
+        conf = self.try_read_unit_once(unit)
         result = "%s - %s" % (unit, self.get_description_from(conf))
         if conf.loaded():
             result += "\n    Loaded: loaded ({}, {})".format(conf.filename(), self.enabled_from(conf) )
@@ -962,6 +2478,24 @@ class Systemctl:
         else:
             result += "\n    Active: inactive ({})".format(self.active_from(conf))
             return 3, result
+    def status_json_records(self, modules): # -> generate[ [ (name, value),.. ] ]
+        """ the status of each unit as a record - the exitcode is kept aside """
+        self._exitcode = 0
+        for unit, conf in self.each_unit_conf(modules):
+            record = [ ("unit", unit), ("description", self.get_description_from(conf)) ]
+            if not conf.loaded():
+                record.append(("load", "failed"))
+                self._exitcode = 3
+                yield record
+                continue
+            record += [ ("load", "loaded"), ("file", conf.filename()), ("enabled", self.enabled_from(conf)) ]
+            if self.is_active_from(conf):
+                record.append(("active", "active"))
+            else:
+                record.append(("active", "inactive"))
+                self._exitcode = 3
+            record.append(("sub", self.active_from(conf)))
+            yield record
     def cat_of_units(self, *modules):
         done = True
         for unit in self.match_units(modules):
@@ -982,7 +2516,42 @@ class Systemctl:
         if not wanted: return None
         if not wanted.endswith(".wants"):
             wanted = wanted + ".wants"
-        return "/etc/systemd/system/" + wanted
+        return os.path.join(self._sysd_folder2, wanted)
+    _rc_link = re.compile(r"^([SK])(\d\d)(.+)$")
+    def enabled_links(self): # -> { name: set(links) }
+        """ the index of all *.wants/ and *.requires/ symlinks (by unit name)
+            and all rc3/rc5 S##/K## links (by init script name). It is built
+            in one pass and updated by enable/disable. """
+        if self._enabled_links is None:
+            self._enabled_links = {}
+            folder = self._sysd_folder2
+            if os.path.isdir(folder):
+                for wants in os.listdir(folder):
+                    if not wants.endswith(".wants") and not wants.endswith(".requires"):
+                        continue
+                    wants_folder = os.path.join(folder, wants)
+                    if not os.path.isdir(wants_folder):
+                        continue
+                    for name in os.listdir(wants_folder):
+                        self._enabled_links.setdefault(name, set()).add(os.path.join(wants_folder, name))
+            for rc_folder in (self.rc3_folder(), self.rc5_folder()):
+                if not os.path.isdir(rc_folder):
+                    continue
+                for name in os.listdir(rc_folder):
+                    m = self._rc_link.match(name)
+                    if m:
+                        self._enabled_links.setdefault(m.group(3), set()).add(os.path.join(rc_folder, name))
+            logg.debug("found %s enabled links", sum(map(len, self._enabled_links.values())))
+        return self._enabled_links
+    def enabled_links_of(self, name, folder = None): # -> [ links ]
+        links = self.enabled_links().get(name, set())
+        if folder:
+            return sorted([ link for link in links if os.path.dirname(link) == folder ])
+        return sorted(links)
+    def enabled_link_added(self, name, link):
+        self.enabled_links().setdefault(name, set()).add(link)
+    def enabled_link_removed(self, name, link):
+        self.enabled_links().get(name, set()).discard(link)
     def enable_of_units(self, *modules):
         done = True
         for unit in self.match_units(modules):
@@ -993,19 +2562,23 @@ class Systemctl:
         unit_file = self.unit_file(unit)
         if self.is_sysv_file(unit_file):
             return self.enable_unit_sysv(unit_file)
-        wanted = self.wanted_from(self.try_read_unit(unit))
+        conf = self.try_read_unit(unit)
+        wanted = self.wanted_from(conf)
         if not wanted: return False # wanted = "multi-user.target"
         folder = self.enablefolder(wanted)
         if not os.path.isdir(folder):
             os.makedirs(folder)
-        target = os.path.join(folder, os.path.basename(unit_file))
+        name = conf.name() # a template instance is linked by its own name
+        target = os.path.join(folder, name)
         if True:
             _f = self._force and "-f" or ""
             logg.info("ln -s {_f} '{unit_file}' '{target}'".format(**locals()))
         if self._force and os.path.islink(target):
             os.remove(target)
+            self.enabled_link_removed(name, target)
         if not os.path.islink(target):
             os.symlink(unit_file, target)
+        self.enabled_link_added(name, target)
         return True
     def rc3_folder(self):
         if os.path.isdir("/etc/rc3.d"): return "/etc/rc3.d"
@@ -1020,22 +2593,18 @@ class Systemctl:
         return rc3 and rc5
     def enable_unit_sysv_folder(self, unit_file, rc_folder):
         name = os.path.basename(unit_file)
-        nameS = "S50"+name
-        nameK = "K50"+name
-        # do not double existing entries
-        if found in os.listdir(rc_folder):
-            m = re.match("S\d\d(.*)", found)
-            if m and m.group(1) == name:
-                nameS = found
-            m = re.match("K\d\d(.*)", found)
-            if m and m.group(1) == name:
-                nameK = found
-        target = os.path.join(rc_folder, nameS)
-        if not os.path.exists(target):
+        # do not double existing entries (of any priority)
+        links = [ os.path.basename(link) for link in self.enabled_links_of(name, rc_folder) ]
+        if not [ link for link in links if link.startswith("S") ]:
+            target = os.path.join(rc_folder, "S50"+name)
+            if not os.path.isdir(rc_folder):
+                os.makedirs(rc_folder)
             os.symlink(unit_file, target)
-        target = os.path.join(rc_folder, nameK)
-        if not os.path.exists(target):
+            self.enabled_link_added(name, target)
+        if not [ link for link in links if link.startswith("K") ]:
+            target = os.path.join(rc_folder, "K50"+name)
             os.symlink(unit_file, target)
+            self.enabled_link_added(name, target)
         return True
     def disable_of_units(self, *modules):
         done = True
@@ -1047,15 +2616,18 @@ class Systemctl:
         unit_file = self.unit_file(unit)
         if self.is_sysv_file(unit_file):
             return self.disable_unit_sysv(unit_file)
-        wanted = self.wanted_from(self.try_read_unit(unit))
-        folder = self.enablefolder(wanted)
-        if not os.path.isdir(folder):
+        conf = self.try_read_unit(unit)
+        wanted = self.wanted_from(conf)
+        name = conf.name()
+        links = self.enabled_links_of(name)
+        if not links and not os.path.isdir(self.enablefolder(wanted) or ""):
             return False
-        target = os.path.join(folder, os.path.basename(unit_file))
-        if os.path.isfile(target):
+        for target in links:
             _f = self._force and "-f" or ""
             logg.info("rm {_f} '{target}'".format(**locals()))
-            os.remove(target)
+            if os.path.islink(target) or os.path.isfile(target):
+                os.remove(target)
+            self.enabled_link_removed(name, target)
         return True
     def disable_unit_sysv(self, unit_file):
         rc3 = self.disable_unit_sysv_folder(unit_file, self.rc3_folder())
@@ -1064,28 +2636,17 @@ class Systemctl:
     def disable_unit_sysv_folder(self, unit_file, rc_folder):
         # a "multi-user.target"/rc3 is also started in /rc5
         name = os.path.basename(unit_file)
-        nameS = "S50"+name
-        nameK = "K50"+name
-        # do not forget the existing entries
-        if found in os.listdir(rc_folder):
-            m = re.match("S\d\d(.*)", found)
-            if m and m.group(1) == name:
-                nameS = found
-            m = re.match("K\d\d(.*)", found)
-            if m and m.group(1) == name:
-                nameK = found
-        target = os.path.join(rc_folder, nameS)
-        if os.path.exists(target):
-           os.unlink(target)
-        target = os.path.join(rc_folder, nameK)
-        if os.path.exists(target):
-           os.unlink(target)
+        # do not forget the existing entries (of any priority)
+        for target in self.enabled_links_of(name, rc_folder):
+            if os.path.lexists(target):
+                os.unlink(target)
+            self.enabled_link_removed(name, target)
         return True
     def is_enabled_sysv(self, unit_file):
         name = os.path.basename(unit_file)
-        target = os.path.join(self.rc3_folder(), "S50%s" % name)
-        if os.path.exists(target):
-           return True
+        for link in self.enabled_links_of(name, self.rc3_folder()):
+            if os.path.basename(link).startswith("S"):
+                return True
         return False
     def is_enabled_of_units(self, *modules):
         result = True
@@ -1097,12 +2658,11 @@ class Systemctl:
         unit_file = self.unit_file(unit)
         if self.is_sysv_file(unit_file):
             return self.is_enabled_sysv(unit_file)
-        wanted = self.wanted_from(self.try_read_unit(unit))
-        folder = self.enablefolder(wanted)
+        conf = self.try_read_unit(unit)
+        wanted = self.wanted_from(conf)
         if not wanted:
             return True
-        target = os.path.join(folder, os.path.basename(unit_file))
-        if os.path.isfile(target):
+        if self.enabled_links_of(conf.name()):
             return True
         return False
     def enabled_from(self, conf):
@@ -1110,52 +2670,289 @@ class Systemctl:
         if self.is_sysv_file(unit_file):
             return self.is_enabled_sysv(unit_file)
         wanted = self.wanted_from(conf)
-        folder = self.enablefolder(wanted)
         if not wanted:
             return "static"
-        target = os.path.join(folder, os.path.basename(unit_file))
-        if os.path.isfile(target):
+        if self.enabled_links_of(conf.name()):
             return "enabled"
         return "disabled"
+    def show_list_unit_files(self, *modules): # -> [ (unit, enabled) ]
+        """ the enablement state of all the unit files """
+        result = []
+        for unit in self.match_units(modules):
+            conf = self.try_read_unit(unit)
+            if not conf.loaded():
+                continue
+            state = self.enabled_from(conf)
+            if state is True: state = "enabled"
+            if state is False: state = "disabled"
+            result.append((unit, state))
+        if self._output == "json":
+            return json_list([ [ ("unit", unit), ("state", state) ] for unit, state in result ])
+        return result
     def system_daemon_reload(self):
-        logg.info("ignored daemon-reload")
+        """ forget about the unit files scanned and parsed so far """
+        logg.info("daemon-reload drops the unit caches")
+        self._loaded_file_sysv = {}
+        self._loaded_file_sysd = {}
+        self._file_for_unit_sysv = None
+        self._file_for_unit_sysd = None
+        self._enabled_links = None
+        return True
+    def socket_service_from(self, conf): # -> name.service
+        """ Socket.Service or the service with the same name as the socket """
+        unit = conf.name()
+        default = unit[:-len(".socket")] + ".service"
+        return conf.get("Socket", "Service", default)
+    def listen_address(self, text): # -> (family, address)
+        """ ListenStream=/ListenDatagram= may be a port, an ip:port
+            or a unix socket path (with '@' for the abstract namespace) """
+        text = text.strip()
+        if text.startswith("/"):
+            return socket.AF_UNIX, text
+        if text.startswith("@"):
+            return socket.AF_UNIX, "\0" + text[1:]
+        if text.isdigit():
+            return socket.AF_INET, ("", int(text))
+        m = re.match(r"^\[([^\]]*)\]:(\d+)$", text)
+        if m:
+            return socket.AF_INET6, (m.group(1), int(m.group(2)))
+        m = re.match(r"^([^:]*):(\d+)$", text)
+        if m:
+            return socket.AF_INET, (m.group(1), int(m.group(2)))
+        logg.error("bad listen address '%s'", text)
+        raise Exception("bad listen address")
+    def bind_socket_from(self, conf, kind, text): # -> socket
+        """ create the listening socket for one Listen* setting """
+        family, address = self.listen_address(text)
+        sock = socket.socket(family, kind)
+        if family == socket.AF_UNIX:
+            if not address.startswith("\0"):
+                if os.path.exists(address):
+                    os.unlink(address)
+                dirpath = os.path.dirname(address)
+                if not os.path.isdir(dirpath):
+                    os.makedirs(dirpath)
+        else:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(address)
+        if family == socket.AF_UNIX and not address.startswith("\0"):
+            mode = conf.get("Socket", "SocketMode", "0666")
+            os.chmod(address, int(mode, 8))
+        if kind == socket.SOCK_STREAM:
+            sock.listen(int(conf.get("Socket", "Backlog", "128")))
+        # only the activated service shall inherit it
+        flags = fcntl.fcntl(sock.fileno(), fcntl.F_GETFD)
+        fcntl.fcntl(sock.fileno(), fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+        return sock
+    def start_socket_from(self, conf):
+        """ bind the sockets of a .socket unit - the service is started
+            lazily by the 'wait' loop upon the first connection """
+        unit = conf.name()
+        if unit in self._sockets:
+            return True
+        if conf.get("Socket", "Accept", "no").lower() in [ "yes", "true", "1" ]:
+            logg.error("%s: Accept=yes is not supported", unit)
+            return False
+        sockets = []
+        try:
+            for text in conf.getlist("Socket", "ListenStream", []):
+                sockets.append(self.bind_socket_from(conf, socket.SOCK_STREAM, text))
+            for text in conf.getlist("Socket", "ListenDatagram", []):
+                sockets.append(self.bind_socket_from(conf, socket.SOCK_DGRAM, text))
+        except Exception, e:
+            logg.error("%s: %s", unit, e)
+            for sock in sockets:
+                sock.close()
+            return False
+        service = self.socket_service_from(conf)
+        logg.info("%s: listening on %s sockets for %s", unit, len(sockets), service)
+        self._sockets[unit] = (service, sockets)
         return True
+    def stop_socket_from(self, conf):
+        """ close the sockets of a .socket unit and stop its service """
+        unit = conf.name()
+        if unit not in self._sockets:
+            return True
+        service, sockets = self._sockets.pop(unit)
+        service_conf = self._sockets_activated.pop(unit, None)
+        if service_conf and self.is_active_from(service_conf):
+            self.stop_unit_from(service_conf)
+        for sock in sockets:
+            address = sock.getsockname()
+            sock.close()
+            if isinstance(address, basestring) and address.startswith("/"):
+                if os.path.exists(address):
+                    os.unlink(address)
+        return True
+    def listening_sockets(self): # -> { fileno: name.socket }
+        """ the sockets to be watched - the ones of activated services are
+            handed back to listening when the service has gone away """
+        for unit, service_conf in self._sockets_activated.items():
+            if not self.is_active_from(service_conf):
+                logg.info("%s: service has stopped, listening again", unit)
+                del self._sockets_activated[unit]
+        listening = {}
+        for unit, (service, sockets) in self._sockets.items():
+            if unit in self._sockets_activated:
+                continue
+            for sock in sockets:
+                listening[sock.fileno()] = unit
+        return listening
+    def activate_socket(self, unit):
+        """ start the service of a socket unit passing its listening sockets """
+        service, sockets = self._sockets[unit]
+        logg.info("%s: activating %s", unit, service)
+        try:
+            conf = self.read_unit(service)
+            self._sockets_activated[unit] = conf
+            self.start_unit_from(conf, sockets)
+        except Exception, e:
+            logg.error("%s: failed to activate %s: %s", unit, service, e)
     def show_of_units(self, *modules):
-        result = ""
-        for unit in self.match_units(modules):
-            if result: result += "\n\n"
-            for var, value in self.show_unit_items(unit):
-               if not _property or _property == var:
-                   result += "%s=%s\n" % (var, value)
-        if not result and modules:
-            unit = modules[0]
+        if self._output == "json":
+            return json_list(self.show_json_records(modules))
+        return self.each_show_text(modules)
+    def each_show_text(self, modules): # -> generate[ text ]
+        self._exitcode = 0
+        units = self.iter_units(modules)
+        first = next(units, None)
+        if first is None:
+            if not modules: return
+            units, first = iter([]), modules[0]
+        for var, value in self.show_unit_items(first):
+            yield "%s=%s\n" % (var, value)
+        for unit in units:
+            yield "\n"
             for var, value in self.show_unit_items(unit):
-               if not _property or _property == var:
-                   result += "%s=%s\n" % (var, value)
-        return result
+                yield "%s=%s\n" % (var, value)
+    def show_json_records(self, modules): # -> generate[ [ (name, value),.. ] ]
+        units = self.iter_units(modules)
+        first = next(units, None)
+        if first is None:
+            if not modules: return
+            units, first = iter([]), modules[0]
+        yield list(self.show_unit_items(first))
+        for unit in units:
+            yield list(self.show_unit_items(unit))
     def show_unit_items(self, unit):
         logg.info("try read unit %s", unit)
-        conf = self.try_read_unit(unit)
+        conf = self.try_read_unit_once(unit)
         for entry in self.each_unit_items(unit, conf):
             yield entry
-    def each_unit_items(self, unit, conf):
-        yield "Id", unit
-        yield "Names", unit
-        yield "Description", self.get_description_from(conf) # conf.get("Unit", "Description")
-        yield "MainPID", self.active_pid_from(conf) or "0"
-        yield "SubState", self.active_from(conf)
-        yield "ActiveState", self.is_active_from(conf) and "active" or "dead"
-        yield "LoadState", conf.loaded() and "loaded" or "not-loaded"
-        env_parts = []
-        for env_part in conf.getlist("Service", "Environment", []):
-            env_parts.append(env_part)
-        if env_parts: 
-            yield "Environment", " ".join(env_parts)
-        env_files = []
-        for env_file in conf.getlist("Service", "EnvironmentFile", []):
-            env_files.append(env_file)
-        if env_files:
-            yield "EnvironmentFile", " ".join(env_files)
+    show_property_names = [ "Id", "Names", "Description", "LoadState", "ActiveState",
+        "SubState", "MainPID", "ExecMainPID", "ExecMainStatus", "ActiveEnterTimestamp", "UnitFileState",
+        "FragmentPath", "SourcePath", "Type", "User", "Group", "PIDFile",
+        "Requires", "Wants", "After", "Before", "WantedBy",
+        "ExecStart", "ExecStop", "ExecReload", "Environment", "EnvironmentFile" ]
+    def each_unit_items(self, unit, conf, properties = None):
+        """ only the requested properties (-p) are computed, each one
+            by its property_<Name> method in show_property_names order """
+        properties = properties or _property
+        self._active_pid_memo = {}
+        for name in self.show_property_names:
+            if properties and name not in properties:
+                continue
+            value = getattr(self, "property_" + name)(unit, conf)
+            if value is not None:
+                yield name, value
+    def memo_active_pid_from(self, conf): # -> pid?
+        """ MainPID/SubState/ActiveState do all need the pid (once) """
+        if id(conf) not in self._active_pid_memo:
+            self._active_pid_memo[id(conf)] = self.active_pid_from(conf)
+        return self._active_pid_memo[id(conf)]
+    def property_Id(self, unit, conf):
+        return unit
+    def property_Names(self, unit, conf):
+        return unit
+    def property_Description(self, unit, conf):
+        return self.get_description_from(conf)
+    def property_LoadState(self, unit, conf):
+        return conf.loaded() and "loaded" or "not-loaded"
+    def property_ActiveState(self, unit, conf):
+        if not conf.loaded(): return "inactive"
+        if self.is_oneshot_from(conf):
+            return self.read_status_from(conf).get("ActiveState", "inactive")
+        return self.memo_active_pid_from(conf) is not None and "active" or "dead"
+    def property_SubState(self, unit, conf):
+        if not conf.loaded(): return "dead"
+        if self.is_oneshot_from(conf):
+            return self.active_from(conf)
+        pid = self.memo_active_pid_from(conf)
+        if pid is None: return "dead"
+        return "PID %s" % pid
+    def property_MainPID(self, unit, conf):
+        if not conf.loaded(): return "0"
+        return self.memo_active_pid_from(conf) or "0"
+    def property_ExecMainPID(self, unit, conf):
+        if not conf.loaded(): return "0"
+        pid_file = self.get_pid_file_from(conf)
+        return self.read_pid_file(pid_file) or "0"
+    def property_ExecMainStatus(self, unit, conf):
+        if not conf.loaded(): return None
+        return self.read_status_from(conf).get("ExecMainStatus")
+    def property_ActiveEnterTimestamp(self, unit, conf):
+        if not conf.loaded(): return ""
+        pid = self.memo_active_pid_from(conf)
+        if pid:
+            started = self.pid_start_time(pid)
+        else: # a oneshot unit became active when its ExecStart was done
+            status = self.read_status_from(conf)
+            started = status.get("ActiveState") == "active" and status.get("ExecMainExitTimestamp")
+        if not started: return ""
+        return time.strftime("%a %Y-%m-%d %H:%M:%S %Z", time.localtime(float(started)))
+    def property_UnitFileState(self, unit, conf):
+        if not conf.loaded(): return ""
+        state = self.enabled_from(conf)
+        if state is True: return "enabled"
+        if state is False: return "disabled"
+        return state
+    def property_FragmentPath(self, unit, conf):
+        if self.is_sysv_file(conf.filename()): return ""
+        return conf.filename() or ""
+    def property_SourcePath(self, unit, conf):
+        if not self.is_sysv_file(conf.filename()): return None
+        return conf.filename()
+    def property_Type(self, unit, conf):
+        if self.get_unit_type(unit) not in [ None, ".service" ]: return None
+        return conf.get("Service", "Type", "simple")
+    def property_User(self, unit, conf):
+        return conf.get("Service", "User", "") or None
+    def property_Group(self, unit, conf):
+        return conf.get("Service", "Group", "") or None
+    def property_PIDFile(self, unit, conf):
+        if not conf.loaded(): return None
+        return self.get_pid_file_from(conf)
+    def property_Requires(self, unit, conf):
+        return " ".join(conf.getlist("Unit", "Requires", [])) or None
+    def property_Wants(self, unit, conf):
+        return " ".join(conf.getlist("Unit", "Wants", [])) or None
+    def property_After(self, unit, conf):
+        return " ".join(conf.getlist("Unit", "After", [])) or None
+    def property_Before(self, unit, conf):
+        return " ".join(conf.getlist("Unit", "Before", [])) or None
+    def property_WantedBy(self, unit, conf):
+        return " ".join(conf.getlist("Install", "WantedBy", [])) or None
+    def property_ExecStart(self, unit, conf):
+        return " ; ".join(conf.getlist("Service", "ExecStart", [])) or None
+    def property_ExecStop(self, unit, conf):
+        return " ; ".join(conf.getlist("Service", "ExecStop", [])) or None
+    def property_ExecReload(self, unit, conf):
+        return " ; ".join(conf.getlist("Service", "ExecReload", [])) or None
+    def property_Environment(self, unit, conf):
+        return " ".join(conf.getlist("Service", "Environment", [])) or None
+    def property_EnvironmentFile(self, unit, conf):
+        return " ".join(conf.getlist("Service", "EnvironmentFile", [])) or None
+    def pid_start_time(self, pid): # -> timestamp?
+        """ the start of a process (from /proc/pid/stat and the boot time) """
+        try:
+            stat = open("/proc/%s/stat" % pid).read()
+            ticks = int(stat[stat.rfind(")")+2:].split()[19])
+            for line in open("/proc/stat"):
+                if line.startswith("btime"):
+                    return int(line.split()[1]) + ticks / float(os.sysconf("SC_CLK_TCK"))
+        except Exception, e:
+            logg.debug("start time of %s: %s", pid, e)
+        return None
     #
     igno_centos = [ "netconsole", "network" ]
     igno_opensuse = [ "raw", "pppoe", "*.local", "boot.*", "rpmconf*" ]
@@ -1181,13 +2978,287 @@ class Systemctl:
                         continue # ignore
                 wants_services.append(service)
         return wants_services
-    def system_wants_services(self, sysv="S", default_target = "multi-user.target"):
-        igno = self.igno_centos + self.igno_opensuse + self.igno_ubuntu + self.igno_always
-        wants2_folder = os.path.join(_sysd_folder2, default_target + ".wants")
-        wants_services = []
-        for unit in sorted(os.listdir(wants2_folder)):
-            if unit.endswith(".service"):
-                wants_services.append(unit)
+    boot_targets = [ "sockets.target", "timers.target", "paths.target" ]
+    boot_types = [ ".service", ".socket", ".timer", ".path" ]
+    def timer_unit_from(self, conf): # -> name.service
+        """ Timer.Unit or the service with the same name as the timer """
+        unit = conf.name()
+        default = unit[:-len(".timer")] + ".service"
+        return conf.get("Timer", "Unit", default)
+    def start_timer_from(self, conf):
+        """ put a .timer unit on the schedule of the 'wait' loop """
+        unit = conf.name()
+        if unit in self._timers:
+            return True
+        self._timers[unit] = (conf, time.time())
+        return self.schedule_timer(unit)
+    def stop_timer_from(self, conf):
+        unit = conf.name()
+        self._timers.pop(unit, None)
+        self._timers_deadline.pop(unit, None)
+        return True
+    def next_timer_deadline(self, unit, now): # -> timestamp?
+        """ the earliest of the On*= settings that is still to come """
+        conf, activated = self._timers[unit]
+        elapsed = self._timers_elapsed.get(unit)
+        deadlines = []
+        for name, since in [ ("OnBootSec", self._boot_time),
+                             ("OnStartupSec", self._boot_time),
+                             ("OnActiveSec", activated) ]:
+            for text in conf.getlist("Timer", name, []):
+                seconds = time_to_seconds(text)
+                if seconds is None: continue
+                deadline = since + seconds
+                if elapsed is None or elapsed < deadline:
+                    deadlines.append(deadline)
+        triggered = self._timers_triggered.get(self.timer_unit_from(conf))
+        if triggered is not None:
+            for text in conf.getlist("Timer", "OnUnitActiveSec", []):
+                seconds = time_to_seconds(text)
+                if seconds is None: continue
+                deadlines.append(triggered + seconds)
+        for text in conf.getlist("Timer", "OnCalendar", []):
+            try:
+                deadline = next_calendar_time(parse_calendar(text), max(now, elapsed or 0))
+            except Exception, e:
+                logg.error("%s: bad OnCalendar=%s: %s", unit, text, e)
+                continue
+            if deadline is not None:
+                deadlines.append(deadline)
+        if not deadlines:
+            return None
+        return min(deadlines)
+    def schedule_timer(self, unit):
+        """ push the next deadline of the timer into the heap, where the
+            wakeup may be delayed by AccuracySec to coalesce timers """
+        if unit not in self._timers:
+            return False
+        conf, activated = self._timers[unit]
+        deadline = self.next_timer_deadline(unit, time.time())
+        if deadline is None:
+            logg.info("%s: timer has elapsed", unit)
+            self._timers_deadline.pop(unit, None)
+            return True
+        accuracy = time_to_seconds(conf.get("Timer", "AccuracySec", "0"), 0)
+        self._timers_deadline[unit] = deadline
+        heapq.heappush(self._timers_heap, (deadline + accuracy, deadline, unit))
+        logg.info("%s: next elapse %s", unit, time.ctime(deadline))
+        return True
+    def timers_timeout(self): # -> seconds?
+        """ how long the 'wait' loop may sleep (None when no timer is pending) """
+        while self._timers_heap:
+            wakeup, deadline, unit = self._timers_heap[0]
+            if self._timers_deadline.get(unit) == deadline:
+                return max(0, wakeup - time.time())
+            heapq.heappop(self._timers_heap) # stale
+        return None
+    def run_elapsed_timers(self):
+        """ start the units of all timers whose deadline has passed """
+        now = time.time()
+        elapsed = [ unit for unit, deadline in self._timers_deadline.items() if deadline <= now ]
+        for unit in elapsed:
+            del self._timers_deadline[unit]
+            if self.get_unit_type(unit) == ".path":
+                self.trigger_path(unit)
+                continue
+            self._timers_elapsed[unit] = now
+            conf, activated = self._timers[unit]
+            target = self.timer_unit_from(conf)
+            self._timers_triggered[target] = now
+            try:
+                target_conf = self.read_unit(target)
+                if self.is_active_from(target_conf):
+                    logg.info("%s: %s is still active", unit, target)
+                else:
+                    logg.info("%s: starting %s", unit, target)
+                    self.start_unit_from(target_conf)
+            except Exception, e:
+                logg.error("%s: failed to start %s: %s", unit, target, e)
+            self.schedule_timer(unit)
+    path_settings = { "PathExists": IN_CREATE | IN_MOVED_TO,
+        "DirectoryNotEmpty": IN_CREATE | IN_MOVED_TO,
+        "PathChanged": IN_ATTRIB | IN_CLOSE_WRITE | IN_CREATE | IN_DELETE | IN_MOVED_FROM
+                       | IN_MOVED_TO | IN_DELETE_SELF | IN_MOVE_SELF,
+        "PathModified": IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_CREATE | IN_DELETE
+                       | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE_SELF | IN_MOVE_SELF }
+    def path_unit_from(self, conf): # -> name.service
+        """ Path.Unit or the service with the same name as the path unit """
+        unit = conf.name()
+        return conf.get("Path", "Unit", unit[:-len(".path")] + ".service")
+    def start_path_from(self, conf):
+        """ the paths of a .path unit are watched by the inotify of the 'wait' loop """
+        unit = conf.name()
+        if unit in self._paths:
+            return True
+        if self._inotify is None:
+            try:
+                self._inotify = inotify_init()
+            except OSError, e:
+                logg.error("%s: no inotify: %s", unit, e)
+                return False
+            self._loop_readers[self._inotify] = self.read_inotify
+        if conf.get("Path", "MakeDirectory", "no").lower() in [ "yes", "true", "1", "on" ]:
+            mode = int(conf.get("Path", "DirectoryMode", "0755"), 8)
+            try:
+                for setting in self.path_settings:
+                    for path in conf.getlist("Path", setting, []):
+                        if not os.path.isdir(path) and setting == "DirectoryNotEmpty":
+                            os.makedirs(path, mode)
+                        elif not os.path.isdir(os.path.dirname(path)):
+                            os.makedirs(os.path.dirname(path), mode)
+            except OSError, e:
+                logg.error("%s: MakeDirectory: %s", unit, e)
+                return False
+        self._paths[unit] = conf
+        self._path_triggers.pop(unit, None)
+        self.watch_path_unit(unit)
+        if self.path_condition_from(conf):
+            self.schedule_path(unit)
+        return True
+    def stop_path_from(self, conf):
+        unit = conf.name()
+        self._paths.pop(unit, None)
+        self._timers_deadline.pop(unit, None)
+        self.unwatch_path_unit(unit)
+        return True
+    def watch_path_unit(self, unit):
+        """ a path is watched in its folder (so that a file replaced by a
+            rename is seen) - a missing folder by its nearest parent """
+        self.unwatch_path_unit(unit)
+        conf = self._paths[unit]
+        for setting, mask in self.path_settings.items():
+            for path in conf.getlist("Path", setting, []):
+                path = os.path.abspath(path)
+                folder, name = os.path.dirname(path), os.path.basename(path)
+                if setting in [ "DirectoryNotEmpty", "PathChanged", "PathModified" ] and os.path.isdir(path):
+                    folder, name = path, None
+                while not os.path.isdir(folder):
+                    # the rest is set up again when the next part has been created
+                    folder, name, setting, mask = os.path.dirname(folder), os.path.basename(folder), None, IN_CREATE | IN_MOVED_TO
+                try:
+                    wd = inotify_add_watch(self._inotify, folder, mask | IN_MASK_ADD)
+                except OSError, e:
+                    logg.error("%s: can not watch %s: %s", unit, folder, e)
+                    continue
+                logg.debug("%s: watch %s for %s", unit, folder, setting)
+                self._path_watches.setdefault(wd, []).append((unit, setting, path, name))
+    def unwatch_path_unit(self, unit):
+        for wd, watches in self._path_watches.items():
+            watches[:] = [ watch for watch in watches if watch[0] != unit ]
+            if not watches:
+                del self._path_watches[wd]
+                inotify_rm_watch(self._inotify, wd)
+    def read_inotify(self):
+        """ a burst of events does only schedule the trigger once """
+        try:
+            data = os.read(self._inotify, 65536)
+        except OSError, e:
+            if e.errno != errno.EAGAIN: raise
+            return
+        rewatch = set()
+        for wd, mask, name in inotify_events(data):
+            for unit, setting, path, watched in list(self._path_watches.get(wd, [])):
+                if watched and name != watched and not mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                    continue
+                if setting is None or mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                    rewatch.add(unit)
+                if setting is not None:
+                    logg.debug("%s: %s event %x on %s", unit, setting, mask, name or path)
+                    self.schedule_path(unit)
+            if mask & IN_IGNORED:
+                self._path_watches.pop(wd, None)
+        for unit in rewatch:
+            if unit in self._paths:
+                self.watch_path_unit(unit)
+                if self.path_condition_from(self._paths[unit]):
+                    self.schedule_path(unit)
+    def schedule_path(self, unit):
+        """ the trigger goes on the timer heap - the events that come in the
+            X-TriggerDelaySec= (default 100ms) are coalesced into one trigger """
+        if unit in self._timers_deadline:
+            return
+        conf = self._paths[unit]
+        delay = time_to_seconds(conf.get("Path", "X-TriggerDelaySec", ""), 0.1) or 0
+        deadline = time.time() + delay
+        self._timers_deadline[unit] = deadline
+        heapq.heappush(self._timers_heap, (deadline, deadline, unit))
+    def retrigger_paths(self, event):
+        """ like systemd a PathExists= or DirectoryNotEmpty= unit triggers its
+            unit again when that has stopped while the condition is still true
+            (but not after a failure, that would be a restart loop) """
+        if event.get("state") != "inactive":
+            return
+        for unit, conf in self._paths.items():
+            if self.path_unit_from(conf) == event.get("unit") and self.path_condition_from(conf):
+                logg.debug("%s: %s has stopped, the condition is still true", unit, event.get("unit"))
+                self.schedule_path(unit)
+    def path_condition_from(self, conf): # -> bool
+        """ PathExists= and DirectoryNotEmpty= do trigger while they are true """
+        for path in conf.getlist("Path", "PathExists", []):
+            if os.path.exists(path):
+                return True
+        for path in conf.getlist("Path", "DirectoryNotEmpty", []):
+            if os.path.isdir(path) and os.listdir(path):
+                return True
+        return False
+    def trigger_path(self, unit):
+        """ start the unit of the path - or reload it when it is active """
+        conf = self._paths.get(unit)
+        if not conf:
+            return
+        changes = [ setting for setting in [ "PathChanged", "PathModified" ] if conf.getlist("Path", setting, []) ]
+        if not changes and not self.path_condition_from(conf):
+            logg.debug("%s: condition is gone", unit)
+            return
+        if self.path_trigger_limit_hit(conf):
+            return
+        target = self.path_unit_from(conf)
+        try:
+            target_conf = self.read_unit(target)
+            if not self.is_active_from(target_conf):
+                logg.info("%s: starting %s", unit, target)
+                self.start_unit_from(target_conf)
+            elif target_conf.getlist("Service", "ExecReload", []):
+                logg.info("%s: reloading %s", unit, target)
+                self.reload_unit_from(target_conf)
+            else:
+                logg.info("%s: %s is still active", unit, target)
+        except Exception, e:
+            logg.error("%s: failed to trigger %s: %s", unit, target, e)
+    def path_trigger_limit_hit(self, conf): # -> bool
+        """ like systemd a path unit that triggers more than TriggerLimitBurst=
+            (200) times within TriggerLimitIntervalSec= (2s) is failed """
+        unit = conf.name()
+        interval = time_to_seconds(conf.get("Path", "TriggerLimitIntervalSec", ""), 2.0)
+        try:
+            burst = int(conf.get("Path", "TriggerLimitBurst", "200"))
+        except ValueError, e:
+            logg.warning("%s: TriggerLimitBurst: %s", unit, e)
+            burst = 200
+        if not interval or not burst:
+            return False
+        now = time.time()
+        window = self._path_triggers.setdefault(unit, [ now, 0 ])
+        if window[0] + interval <= now:
+            window[:] = [ now, 0 ]
+        window[1] += 1
+        if window[1] <= burst:
+            return False
+        logg.error("%s: trigger limit hit (%s triggers within %ss)", unit, burst, interval)
+        self.stop_path_from(conf)
+        self.publish_from(conf, "failed")
+        return True
+    def system_wants_services(self, sysv="S", default_target = "multi-user.target"):
+        igno = self.igno_centos + self.igno_opensuse + self.igno_ubuntu + self.igno_always
+        wants_services = []
+        for target in self.boot_targets + [ default_target ]:
+            wants2_folder = os.path.join(_sysd_folder2, target + ".wants")
+            if not os.path.isdir(wants2_folder):
+                continue
+            for unit in sorted(os.listdir(wants2_folder)):
+                if self.get_unit_type(unit) in self.boot_types:
+                    if unit not in wants_services:
+                        wants_services.append(unit)
         for unit in sorted(os.listdir(self.rc3_folder())):
             m = re.match(sysv+r"\d\d(.*)", unit)
             if m:
@@ -1196,36 +3267,1521 @@ class Systemctl:
                     if fnmatch.fnmatchcase(service, ignore):
                         continue # ignore
                 wants_services.append(service)
-        return wants_services
+        return self.without_socket_services(wants_services)
+    def without_socket_services(self, units): # -> [ units ]
+        """ the service of an enabled socket is started by the first connection
+            (it would fail with EADDRINUSE if it was started along with it) """
+        activated = set()
+        for unit in units:
+            if self.get_unit_type(unit) == ".socket":
+                try:
+                    activated.add(self.socket_service_from(self.read_unit(unit)))
+                except Exception, e:
+                    logg.debug("%s: %s", unit, e)
+        return [ unit for unit in units if unit not in activated ]
     def system_default(self, arg = True):
         """ start units for default system level """
         logg.info("system default requested - %s", arg)
         default_target = "multi-user.target"
         wants_services = self.system_wants_services("S", default_target)
-        self.start_of_units(*wants_services)
+        locks = [ self.lock("manager") ]
+        try:
+            self.start_units_by_history(self.match_units(wants_services))
+        finally:
+            self.unlock(*locks)
         logg.info("system is up")
+    def boot_jobs(self): # -> int
+        if str(self._jobs).lower() == "auto":
+            return max(2, len(available_cpus()))
+        return max(1, int(self._jobs or 1))
+    def start_units_by_history(self, units): # -> bool
+        """ start the units in parallel (up to --jobs) where each unit waits
+            for its After= units. Of the units that may start the one with the
+            longest remaining path (in the start durations of the last boots)
+            goes first - without a history, or with --jobs=1, it is the order
+            of the units. """
+        confs, after = self.after_of_units(units)
+        history = self.read_start_history()
+        jobs = self.boot_jobs()
+        priority = dict([ (unit, 0.0) for unit in units ])
+        if jobs > 1:
+            priority = self.critical_path_of(units, after, history)
+        order = dict([ (unit, n) for n, unit in enumerate(units) ])
+        waiting, running, finished, durations = list(units), {}, set(), {}
+        done = True
+        while waiting or running:
+            ready = [ unit for unit in waiting if after[unit] <= finished ]
+            if not ready and not running and waiting:
+                ready = [ min(waiting, key = order.get) ] # an ordering cycle
+            ready.sort(key = lambda unit: (- priority[unit], order[unit]))
+            for unit in ready[:max(0, jobs - len(running))]:
+                waiting.remove(unit)
+                conf = confs[unit]
+                if self.get_unit_type(conf.filename()) not in [ ".service", None ]:
+                    # sockets and timers are kept in the memory of this process
+                    if self.start_unit_from(conf) is False:
+                        done = False
+                    finished.add(unit)
+                    continue
+                logg.info("start %s (critical path %.3fs)", unit, priority[unit])
+                running[unit] = (self._proc.fork(lambda conf=conf: self.start_ready_from(conf), self.forked_worker), self._proc.time())
+            exited = [ unit for unit, (call, started) in running.items() if call.poll() is not None ]
+            for unit in exited:
+                call, started = running.pop(unit)
+                finished.add(unit)
+                if call.returncode:
+                    logg.error("start %s: failed (%s)", unit, call.returncode)
+                    done = False
+                    continue
+                durations[unit] = self._proc.time() - started
+                self.record_start_from(confs[unit], durations[unit])
+            if running and not exited:
+                self.boot_sleep(0.02)
+        self.write_start_history(history, durations)
+        return done
+    def boot_sleep(self, seconds):
+        """ the 'wait' loop does not run during the boot - the sockets of the
+            init process (like /dev/log) are drained here instead so that a
+            service does not block in syslog() while the others are started """
+        readers = dict(self._loop_readers)
+        if self._control_socket:
+            readers.pop(self._control_socket.fileno(), None)
+        if not readers:
+            self._proc.sleep(seconds)
+            return
+        try:
+            ready, _, _ = select.select(readers.keys(), [], [], seconds)
+        except select.error, e:
+            if e.args[0] != errno.EINTR: raise
+            return
+        for fileno in ready:
+            readers[fileno]()
+        self.write_syslog_queue()
+    def start_ready_from(self, conf): # -> bool
+        """ the start of a unit at boot - a Type=notify unit waits for READY=1 """
+        self.open_notify_socket_from(conf)
+        try:
+            if self.start_unit_from(conf) is False:
+                return False
+            if conf.name() in self._notify_sockets:
+                return not self.wait_ready_from([ conf ])
+            return True
+        finally:
+            self.close_notify_socket_from(conf)
+    def critical_path_of(self, units, after, history): # -> { unit : seconds }
+        """ the start duration of a unit plus the longest path of the units after it """
+        before = dict([ (unit, set()) for unit in units ])
+        for unit in units:
+            for other in after[unit]:
+                before[other].add(unit)
+        path = {}
+        def longest(unit, visiting):
+            if unit in path: return path[unit]
+            if unit in visiting: return 0.0 # cycle
+            visiting.add(unit)
+            path[unit] = history.get(unit, 0.0) + max([ longest(other, visiting) for other in before[unit] ] or [ 0.0 ])
+            return path[unit]
+        for unit in units:
+            longest(unit, set())
+        return path
+    def start_history_file(self): # -> path
+        return os.path.join(self._lib_folder, "start-durations")
+    def read_start_history(self): # -> { unit : seconds }
+        history = {}
+        history_file = self.start_history_file()
+        if not os.path.isfile(history_file):
+            return history
+        try:
+            for line in open(history_file):
+                parts = line.split()
+                if len(parts) == 2:
+                    history[parts[0]] = float(parts[1])
+        except (IOError, ValueError), e:
+            logg.warning("bad start history %s: %s", history_file, e)
+        return history
+    def write_start_history(self, history, durations):
+        """ a moving average of the start-to-ready duration per unit """
+        if not durations:
+            return
+        history = dict(history)
+        for unit, seconds in durations.items():
+            if unit in history:
+                history[unit] = (history[unit] + seconds) / 2
+            else:
+                history[unit] = seconds
+        history_file = self.start_history_file()
+        try:
+            if not os.path.isdir(self._lib_folder):
+                os.makedirs(self._lib_folder)
+            with open(history_file + ".tmp", "w") as f:
+                for unit in sorted(history):
+                    f.write("%s %.3f\n" % (unit, history[unit]))
+            os.rename(history_file + ".tmp", history_file)
+        except (IOError, OSError), e:
+            logg.warning("can not write %s: %s", history_file, e)
     def system_halt(self, arg = True):
         """ stop units from default system level """
         logg.info("system halt requested - %s", arg)
+        self.set_board_system("stopping")
         default_target = "multi-user.target"
         wants_services = self.system_wants_services("K", default_target)
-        self.stop_of_units(*wants_services)
+        for unit, service_conf in self._sockets_activated.items():
+            wants_services.append(service_conf.name())
+        locks = [ self.lock("manager") ]
+        try:
+            missed = self.stop_units_until(self.match_units(wants_services), self._stop_timeout)
+        finally:
+            self.unlock(*locks)
+        if missed:
+            logg.warning("units missed the stop deadline: %s", " ".join(missed))
         logg.info("system is down")
+    def after_of_units(self, units): # -> ({ unit : conf }, { unit : set(units before) })
+        """ the ordering by After=/Before= (and a socket before its service) """
+        confs = {}
+        for unit in units:
+            confs[unit] = self.try_read_unit(unit)
+        after = {}
+        for unit in units:
+            after.setdefault(unit, set())
+            conf = confs[unit]
+            for text in conf.getlist("Unit", "After", []):
+                for other in text.split():
+                    if other in confs and other != unit:
+                        after[unit].add(other)
+            for text in conf.getlist("Unit", "Before", []):
+                for other in text.split():
+                    if other in confs and other != unit:
+                        after.setdefault(other, set()).add(unit)
+        for socket_unit, service_conf in self._sockets_activated.items():
+            service = service_conf.name()
+            if service in after and socket_unit in confs:
+                after[service].add(socket_unit)
+        return confs, after
+    def stop_levels_of_units(self, units): # -> [ [ unit,.. ],.. ]
+        """ the reverse of the start order given by After=/Before= where
+            each level can be stopped in parallel """
+        confs, after = self.after_of_units(units)
+        level = {}
+        def start_level(unit, visiting):
+            if unit in level: return level[unit]
+            if unit in visiting: return 0 # cycle
+            visiting.add(unit)
+            level[unit] = 1 + max([ start_level(other, visiting) for other in after[unit] ] or [ -1 ])
+            return level[unit]
+        for unit in units:
+            start_level(unit, set())
+        levels = []
+        for n in reversed(sorted(set(level.values()))):
+            levels.append([ unit for unit in units if level[unit] == n ])
+        return levels
+    def begin_stop_unit_from(self, conf): # -> { "pids": [..], "procs": [..] }
+        """ send the stop request without waiting for it - either
+            by spawning the ExecStop commands or by a signal to the pid """
+        job = { "conf": conf, "pids": [], "groups": [], "procs": [] }
+        runs = conf.get("Service", "Type", "simple").lower()
+        if self.get_unit_type(conf.filename()) in [ ".socket", ".timer", ".path" ]:
+            self.stop_unit_from(conf)
+            return job
+        sudo = self.sudo_from(conf)
+        env = self.get_env(conf)
+        for cmd in conf.getlist("Service", "ExecStopPre", []):
+            check, cmd = checkstatus(cmd)
+            job["procs"].append(self._proc.spawn(cmd, env))
+        if runs in [ "sysv" ]:
+            cmd = "'%s' stop" % conf.filename()
+            env["SYSTEMCTL_SKIP_REDIRECT"] = "yes"
+            logg.info("(stop) %s", cmd)
+            job["procs"].append(self._proc.spawn(cmd, env))
+            return job
+        pid = self.active_pid_from(conf)
+        if pid:
+            job["pids"].append(pid)
+            if self.pid_group_leader(pid):
+                job["groups"].append(pid)
+        if conf.getlist("Service", "ExecStop", []):
+            env["MAINPID"] = str(pid or "")
+            for cmd in conf.getlist("Service", "ExecStop", []):
+                check, cmd = checkstatus(cmd)
+                logg.info("[stop] %s", sudo+cmd)
+                job["procs"].append(self._proc.spawn(sudo+cmd, env))
+        elif pid:
+            signame = conf.get("Service", "KillSignal", "SIGTERM")
+            signum = getattr(signal, signame.upper(), signal.SIGTERM)
+            logg.info("(stop) kill -%s %s", signame, pid)
+            try:
+                if job["groups"]: self._proc.killpg(pid, signum)
+                else: self._proc.kill(pid, signum)
+            except OSError, e: logg.debug("kill %s: %s", pid, e)
+        return job
+    def stop_units_until(self, units, timeout = None): # -> [ missed units ]
+        """ stop all units level by level within one overall deadline, where
+            the processes still running at the end of a level get a SIGKILL """
+        timeout = timeout or self._stop_timeout
+        deadline = self._proc.time() + timeout
+        levels = self.stop_levels_of_units(units)
+        missed = []
+        for n, level in enumerate(levels):
+            # leave some time for the levels to come
+            reserve = min(0.5 * (len(levels) - n - 1), timeout / 2.0)
+            level_deadline = max(deadline - reserve, self._proc.time() + 0.1)
+            jobs = {}
+            for unit in level:
+                try:
+                    jobs[unit] = self.begin_stop_unit_from(self.read_unit(unit))
+                except Exception, e:
+                    logg.error("stop %s: %s", unit, e)
+            while True:
+                self.reap_children()
+                running = [ unit for unit, job in jobs.items() if self.stop_job_running(job) ]
+                if not running:
+                    break
+                if self._proc.time() > level_deadline:
+                    for unit in running:
+                        logg.warning("stop %s: deadline has passed, sending SIGKILL", unit)
+                        self.kill_stop_job(jobs[unit])
+                        missed.append(unit)
+                    self.reap_children()
+                    break
+                self._proc.sleep(0.05)
+            for unit, job in jobs.items():
+                conf = job["conf"]
+                pid_file = self.get_pid_file_from(conf)
+                if job["pids"] and pid_file and os.path.isfile(pid_file):
+                    os.remove(pid_file)
+                if self.is_oneshot_from(conf) and self.is_active_from(conf):
+                    self.write_status_from(conf, "inactive")
+                env = self.get_env(conf)
+                for cmd in conf.getlist("Service", "ExecStopPost", []):
+                    check, cmd = checkstatus(cmd)
+                    logg.info("ExecStopPost:%s:%s", check, cmd)
+                    self._proc.spawn(cmd, env)
+        return missed
+    def stop_job_running(self, job): # -> bool
+        for proc in job["procs"]:
+            if proc.poll() is None:
+                return True
+        for pid in job["pids"]:
+            if self.pid_exists(pid) and not self.pid_zombie(pid):
+                return True
+        for pgid in job["groups"]:
+            if self.group_running(pgid):
+                return True
+        return False
+    def group_running(self, pgid): # -> bool
+        return self._proc.group_running(pgid)
+    def kill_stop_job(self, job):
+        for proc in job["procs"]:
+            if proc.poll() is None:
+                try: proc.kill()
+                except OSError: pass
+        for pid in job["pids"]:
+            try: self._proc.kill(pid, signal.SIGKILL)
+            except OSError: pass
+        for pgid in job["groups"]:
+            try: self._proc.killpg(pgid, signal.SIGKILL)
+            except OSError: pass
+    def pid_group_leader(self, pid): # -> bool
+        return self._proc.group_leader(pid)
+    def pid_zombie(self, pid): # -> bool
+        return self._proc.zombie(pid)
+    def reap_children(self):
+        """ waitpid() for any child that has exited """
+        self._proc.reap()
+    job_types = [ "start", "stop", "restart" ]
+    def job_folder(self): # -> path
+        """ the --no-block jobs are files NNNNNNNN.job in the order of their ids """
+        return os.path.join(self._lock_folder, "jobs")
+    def read_job(self, job_file): # -> { name : value }?
+        job = {}
+        try:
+            for line in open(job_file):
+                if "=" in line:
+                    name, value = line.strip().split("=", 1)
+                    job[name] = value
+        except IOError, e:
+            logg.debug("job %s: %s", job_file, e)
+            return None
+        job["Id"] = int(job.get("Id", 0))
+        return job
+    def write_job(self, job):
+        job_file = os.path.join(self.job_folder(), "%08i.job" % job["Id"])
+        with open(job_file + ".tmp", "w") as f:
+            for name in [ "Id", "Unit", "Type", "State", "Created" ]:
+                f.write("%s=%s\n" % (name, job[name]))
+        os.rename(job_file + ".tmp", job_file)
+    def remove_job(self, job):
+        job_file = os.path.join(self.job_folder(), "%08i.job" % job["Id"])
+        if os.path.exists(job_file):
+            os.remove(job_file)
+    def queued_jobs(self): # -> [ job ] (ordered by id)
+        folder = self.job_folder()
+        if not os.path.isdir(folder):
+            return []
+        jobs = []
+        for name in sorted(os.listdir(folder)):
+            if name.endswith(".job"):
+                job = self.read_job(os.path.join(folder, name))
+                if job:
+                    jobs.append(job)
+        return jobs
+    def next_job_id(self): # -> int
+        id_file = os.path.join(self.job_folder(), "last-id")
+        job_id = (self.read_pid_file(id_file) or 0) + 1
+        self.write_pid_file(id_file, job_id)
+        return job_id
+    def enqueue_jobs(self, kind, modules): # -> [ job ids ]
+        """ --no-block returns the job ids at once, while the init loop
+            (or a detached 'run-jobs' helper) does the actual work """
+        result = []
+        self.lock("jobs")
+        try:
+            if not os.path.isdir(self.job_folder()):
+                os.makedirs(self.job_folder())
+            for unit in self.match_units(modules):
+                result.append(str(self.enqueue_job(kind, unit)))
+            self.wakeup_job_worker()
+        finally:
+            self.unlock("jobs")
+        return result
+    def enqueue_job(self, kind, unit): # -> job id
+        """ a new job is merged into a waiting job of the same type (and a
+            start into a waiting restart) - any other waiting job of that
+            unit is cancelled, so that a start followed by a stop is a stop """
+        for job in self.queued_jobs():
+            if job["Unit"] != unit or job["State"] != "waiting":
+                continue
+            if job["Type"] == kind or (kind == "start" and job["Type"] == "restart"):
+                logg.info("job %s %s %s: merged %s", job["Id"], job["Type"], unit, kind)
+                return job["Id"]
+            logg.info("job %s %s %s: cancelled by %s", job["Id"], job["Type"], unit, kind)
+            self.remove_job(job)
+        job = { "Id": self.next_job_id(), "Unit": unit, "Type": kind,
+                "State": "waiting", "Created": int(self._proc.time()) }
+        self.write_job(job)
+        logg.info("job %s %s %s: queued", job["Id"], kind, unit)
+        return job["Id"]
+    def wakeup_job_worker(self):
+        """ SIGUSR1 to the init loop, or else a detached helper is spawned
+            if there is none - a helper only exits on an empty queue """
+        loop_file = os.path.join(self.job_folder(), "worker.pid")
+        pid = self.read_pid_file(loop_file)
+        if pid and self.pid_exists(pid) and not self.pid_zombie(pid):
+            try:
+                self._proc.kill(pid, signal.SIGUSR1)
+                return
+            except OSError, e:
+                logg.debug("job worker %s: %s", pid, e)
+        helper_file = os.path.join(self.job_folder(), "helper.pid")
+        pid = self.read_pid_file(helper_file)
+        if pid and self.pid_exists(pid) and not self.pid_zombie(pid):
+            return
+        cmd = "exec '%s' '%s' run-jobs </dev/null >/dev/null 2>&1"
+        run = self._proc.spawn(cmd % (sys.executable, os.path.realpath(sys.argv[0])), None, os.setsid)
+        self.write_pid_file(helper_file, run.pid)
+    def run_queued_jobs(self): # -> number of jobs started
+        """ the waiting jobs are run in forked workers - up to --jobs at the
+            same time and one job per unit. The sockets, timers and path units
+            are kept in the memory of this process, so their jobs are done
+            here. A job is removed when its worker has exited. """
+        self.poll_job_workers()
+        busy = set([ job["Unit"] for job, call in self._job_workers.values() ])
+        ready = []
+        self.lock("jobs")
+        try:
+            for job in self.queued_jobs():
+                if job["State"] != "waiting" or job["Unit"] in busy:
+                    continue
+                if len(self._job_workers) + len(ready) >= self.boot_jobs():
+                    break
+                busy.add(job["Unit"])
+                job["State"] = "running"
+                self.write_job(job)
+                ready.append(job)
+        finally:
+            self.unlock("jobs")
+        for job in ready:
+            if self.get_unit_type(job["Unit"]) not in [ ".service", None ]:
+                self.run_job(job)
+                self.remove_job(job)
+                continue
+            self._job_workers[job["Id"]] = (job, self._proc.fork(lambda job=job: self.run_job(job), self.forked_worker))
+        return len(ready)
+    def poll_job_workers(self): # -> number of jobs done
+        done = 0
+        for job_id, (job, call) in self._job_workers.items():
+            if call.poll() is None:
+                continue
+            del self._job_workers[job_id]
+            self.remove_job(job)
+            done += 1
+        return done
+    def job_worker_pids(self): # -> [ pid ]
+        return [ call.pid for job, call in self._job_workers.values() ]
+    def queue_is_done(self): # -> bool
+        """ a helper process forgets its pid file along with the last job """
+        self.lock("jobs")
+        try:
+            if [ job for job in self.queued_jobs() if job["State"] == "waiting" ]:
+                return False
+            helper_file = os.path.join(self.job_folder(), "helper.pid")
+            if os.path.exists(helper_file):
+                os.remove(helper_file)
+            return True
+        finally:
+            self.unlock("jobs")
+    def run_job(self, job): # -> bool
+        unit, kind = job["Unit"], job["Type"]
+        if kind not in self.job_types:
+            logg.error("job %s %s %s: unknown job type", job["Id"], kind, unit)
+            return False
+        started = self._proc.time()
+        try:
+            done = getattr(self, kind + "_unit")(unit)
+        except Exception, e:
+            logg.error("job %s %s %s: %s", job["Id"], kind, unit, e)
+            done = False
+        logg.info("job %s %s %s: %s after %.3fs", job["Id"], kind, unit,
+                  done is False and "failed" or "done", self._proc.time() - started)
+        return done
+    def requeue_running_jobs(self):
+        """ a job that was running when its worker was killed is done again """
+        self.lock("jobs")
+        try:
+            for job in self.queued_jobs():
+                if job["State"] == "running":
+                    logg.warning("job %s %s %s: requeued", job["Id"], job["Type"], job["Unit"])
+                    job["State"] = "waiting"
+                    self.write_job(job)
+        finally:
+            self.unlock("jobs")
+    def system_run_jobs(self):
+        """ the detached worker for the --no-block jobs (if the init process
+            is not systemctl.py) - it exits when the queue is empty """
+        self.requeue_running_jobs()
+        while True:
+            self.run_queued_jobs()
+            if not self._job_workers and self.queue_is_done():
+                return True
+            self._proc.sleep(0.05)
+    def start_job_worker(self):
+        """ the init loop takes over the queue and is woken up by SIGUSR1 """
+        self.lock("jobs")
+        try:
+            if not os.path.isdir(self.job_folder()):
+                os.makedirs(self.job_folder())
+            self.write_pid_file(os.path.join(self.job_folder(), "worker.pid"), os.getpid())
+        finally:
+            self.unlock("jobs")
+        self._job_worker = True
+        self.requeue_running_jobs()
+    def stop_job_worker(self):
+        if not self._job_worker:
+            return
+        self._job_worker = False
+        loop_file = os.path.join(self.job_folder(), "worker.pid")
+        if os.path.exists(loop_file):
+            os.remove(loop_file)
+    def show_list_jobs(self, *modules): # -> [ (id, unit, type, state) ]
+        """ the pending and running --no-block jobs (optionally by unit pattern) """
+        result = []
+        for job in self.queued_jobs():
+            if modules and not [ pattern for pattern in modules if fnmatch.fnmatchcase(job["Unit"], pattern) ]:
+                continue
+            result.append((str(job["Id"]), job["Unit"], job["Type"], job["State"]))
+        if self._output == "json":
+            return json_list([ [ ("job", int(job_id)), ("unit", unit), ("type", kind), ("state", state) ]
+                               for job_id, unit, kind, state in result ])
+        return result
+    def events_path(self): # -> path
+        return os.path.join(self._lock_folder, "events.sock")
+    def monitor_path(self): # -> path
+        return os.path.join(self._lock_folder, "monitor.sock")
+    def board_path(self): # -> path
+        return os.path.join(self._lock_folder, "status.board")
+    def start_board(self, state = "starting"):
+        """ the init process keeps the state of each unit in a fixed record of
+            a shared file - it is renamed into place when the header is done,
+            and the forked children of the boot do write into the same map """
+        if self._board is not None:
+            self.set_board_system(state)
+            return
+        path = self.board_path()
+        size = _board_header.size + _board_slots * _board_record.size
+        try:
+            if not os.path.isdir(self._lock_folder):
+                os.makedirs(self._lock_folder)
+            fd = os.open(path + ".tmp", os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0644)
+            try:
+                os.ftruncate(fd, size)
+                board = mmap.mmap(fd, size, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+            finally:
+                os.close(fd)
+            board[0:_board_header.size] = _board_header.pack(_board_magic, _board_slots, _board_record.size,
+                                                             os.getpid(), time.time(), _board_system.index(state))
+            os.rename(path + ".tmp", path)
+        except (OSError, IOError, mmap.error), e:
+            logg.error("board %s: %s", path, e)
+            return
+        self._board = board
+    def set_board_system(self, state):
+        if self._board is None:
+            return
+        header = list(_board_header.unpack_from(self._board, 0))
+        header[5] = _board_system.index(state)
+        self._board[0:_board_header.size] = _board_header.pack(*header)
+    def update_board(self, event):
+        """ the record of the unit is written between an odd and an even seq -
+            the init process and its forked children are writers of the same
+            board, so a record is only written under the board lock """
+        if self._board is None:
+            return
+        unit, state = str(event.get("unit", "")), event.get("state")
+        if state == "starting":
+            state = "activating"
+        if not unit or state not in _board_states:
+            return
+        locks = [ self.lock("board") ]
+        try:
+            pos = board_slot(self._board, unit, insert = True)
+            if pos is None:
+                logg.warning("board is full, no record for %s", unit)
+                return
+            self.write_board(pos, unit, state, event)
+        finally:
+            self.unlock(*locks)
+    def write_board(self, pos, unit, state, event):
+        seq, = _board_seq.unpack_from(self._board, pos)
+        seq = (seq | 1) + 2
+        self._board[pos:pos+_board_seq.size] = _board_seq.pack(seq)
+        record = _board_record.pack(seq, board_hash(unit), _board_states.index(state), int(event.get("pid", 0)),
+                                    float(event.get("time", 0)), int(event.get("status", 0)), unit[:_board_name])
+        self._board[pos+_board_seq.size:pos+_board_record.size] = record[_board_seq.size:]
+        self._board[pos:pos+_board_seq.size] = _board_seq.pack(seq + 1)
+    def publish_from(self, conf, state, pid = None, status = None):
+        """ a state change as one json line - the init process sends it to
+            its subscribers, any other process passes it to the init process """
+        if not self._events_socket and not os.path.exists(self.events_path()):
+            return
+        event = { "unit": conf.name(), "state": state, "time": round(self._proc.time(), 3) }
+        if pid is None and state in [ "active", "reloading", "deactivating" ]:
+            pid = self.active_pid_from(conf)
+        if pid:
+            event["pid"] = int(pid)
+        if status is None and self.is_oneshot_from(conf) and state in [ "active", "inactive", "failed" ]:
+            status = self.read_status_from(conf).get("ExecMainStatus")
+        if status is not None:
+            event["status"] = int(status)
+        self.publish_event(event)
+    def publish_event(self, event):
+        text = json.dumps(event, sort_keys = True) + "\n"
+        if self._events_socket:
+            self.manager_event(event, text)
+            return
+        path = self.events_path()
+        try:
+            if not self._events_client:
+                self._events_client = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+                self._events_client.setblocking(0)
+            self._events_client.sendto(text, path)
+        except socket.error, e:
+            logg.debug("event %s: %s", path, e)
+    def control_path(self): # -> path
+        return os.path.join(self._lock_folder, "control.sock")
+    def start_control(self):
+        """ the init process runs the command lines sent to control.sock (see -H/-M),
+            each one in a forked child so that the loop is never blocked (except
+            for the units that live in the init process, see control_in_manager) """
+        if self._control_socket:
+            return
+        path = self.control_path()
+        try:
+            if not os.path.isdir(self._lock_folder):
+                os.makedirs(self._lock_folder)
+            if os.path.exists(path):
+                os.unlink(path)
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.bind(path)
+            os.chmod(path, 0600)
+            sock.listen(32)
+            sock.setblocking(0)
+            fcntl.fcntl(sock.fileno(), fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+        except socket.error, e:
+            logg.error("control %s: %s", path, e)
+            return
+        self._control_socket = sock
+        self._loop_readers[sock.fileno()] = self.accept_control
+    control_commands = [ "start", "stop", "restart", "reload", "try-restart",
+                         "reload-or-restart", "reload-or-try-restart" ]
+    def accept_control(self):
+        """ the command line is read by the 'wait' loop as it arrives - a
+            client that does not send it within a few seconds is dropped """
+        try:
+            conn, addr = self._control_socket.accept()
+        except socket.error:
+            return
+        conn.setblocking(0)
+        fcntl.fcntl(conn.fileno(), fcntl.F_SETFD, fcntl.FD_CLOEXEC) # not for a started service
+        now = time.time()
+        for fileno, (other, text, accepted) in self._control_conns.items():
+            if accepted + 5 < now:
+                logg.error("control: no command line within 5 seconds")
+                self.drop_control(fileno)
+        self._control_conns[conn.fileno()] = [ conn, "", now ]
+        self._loop_readers[conn.fileno()] = lambda fileno=conn.fileno(): self.read_control(fileno)
+    def drop_control(self, fileno):
+        conn, text, accepted = self._control_conns.pop(fileno)
+        self._loop_readers.pop(fileno, None)
+        conn.close()
+    def read_control(self, fileno):
+        conn, text, accepted = self._control_conns[fileno]
+        try:
+            data = conn.recv(4096)
+        except socket.error, e:
+            if e.args[0] == errno.EAGAIN: return
+            data = ""
+        if not data:
+            self.drop_control(fileno)
+            return
+        text += data
+        if "\n" not in text and len(text) < 65536:
+            self._control_conns[fileno][1] = text
+            return
+        del self._control_conns[fileno]
+        del self._loop_readers[fileno]
+        conn.setblocking(1)
+        self.run_control(conn, text.split("\n", 1)[0].strip())
+    def run_control(self, conn, line):
+        if self.control_in_manager(line):
+            try:
+                self.serve_control(conn, line)
+            finally:
+                set_options(_o.parse_args(sys.argv[1:])[0], self)
+            return
+        try:
+            self._proc.fork(lambda: self.serve_control(conn, line), self.forked_worker)
+        except OSError, e:
+            logg.error("control: %s", e)
+        conn.close()
+    def forked_worker(self):
+        """ a forked boot, job or control child does not own the sockets and
+            the board of the init process - its events go to events.sock
+            like the ones of any other systemctl call """
+        for conn in [ entry[0] for entry in self._monitor_conns.values() + self._control_conns.values() ]:
+            conn.close() # so the init process alone keeps the clients waiting
+        self._events_socket = None
+        self._monitor_socket = None
+        self._monitor_conns = {}
+        self._control_conns = {}
+        self._board = None
+        self._init_loop = False
+    def control_in_manager(self, line): # -> bool
+        """ the sockets, timers and path units are kept in the memory of the
+            init process - a start/stop that names only such units is done
+            here. Anything else (like a pattern) is run in a forked child,
+            which does again send the sockets, timers and paths it finds
+            back to the init process (see lives_in_manager) """
+        try:
+            opt, args = _o.parse_args(shlex.split(line))
+        except (ValueError, SystemExit):
+            return False
+        if not args or args[0] not in self.control_commands or not args[1:]:
+            return False
+        for unit in args[1:]:
+            if self.get_unit_type(unit) not in [ ".socket", ".timer", ".path" ]:
+                return False
+            if re.search(r"[*?\[{]", unit):
+                return False
+        return True
+    def serve_control(self, conn, line):
+        """ one command line (as in --batch) is answered by a json line
+            { "exitcode": n, "output": text } before the connection is closed """
+        logg.info("control: %s", line)
+        output = StringIO.StringIO()
+        stdout, sys.stdout = sys.stdout, output
+        exitcode = 1
+        try:
+            opt, args = _o.parse_args(shlex.split(line))
+            set_options(opt, self)
+            found, result = run_command(self, args and args[0] or "list-units", args[1:])
+            if not found:
+                logg.error("no method for '%s'", args[0])
+            else:
+                exitcode = print_result(self, result)
+        except SystemExit, e:
+            exitcode = e.code or 0
+        except Exception, e:
+            logg.error("control %s: %s", line, e)
+        finally:
+            sys.stdout = stdout
+        try:
+            conn.sendall(json.dumps({ "exitcode": exitcode, "output": output.getvalue() }) + "\n")
+        except socket.error, e:
+            logg.error("control %s: %s", line, e)
+        conn.close()
+    def start_monitor(self):
+        """ the init process receives the events of all systemctl calls on
+            events.sock and subscribers connect to monitor.sock - they send
+            a line of unit patterns first (an empty line for all units) """
+        if self._events_socket:
+            return
+        try:
+            if not os.path.isdir(self._lock_folder):
+                os.makedirs(self._lock_folder)
+            for path in (self.events_path(), self.monitor_path()):
+                if os.path.exists(path):
+                    os.unlink(path)
+            events = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            events.bind(self.events_path())
+            monitor = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            monitor.bind(self.monitor_path())
+            monitor.listen(32)
+            for sock in (events, monitor):
+                sock.setblocking(0)
+                fcntl.fcntl(sock.fileno(), fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+        except socket.error, e:
+            logg.error("monitor %s: %s", self._lock_folder, e)
+            return
+        self._events_socket = events
+        self._monitor_socket = monitor
+        self._loop_readers[events.fileno()] = self.read_events
+        self._loop_readers[monitor.fileno()] = self.accept_monitor
+    def read_events(self):
+        while True:
+            try:
+                text = self._events_socket.recv(65536)
+            except socket.error:
+                return
+            try:
+                event = json.loads(text)
+                unit = event["unit"]
+            except (ValueError, KeyError, TypeError), e:
+                logg.debug("bad event %s: %s", repr(text), e)
+                continue
+            if event.get("pid") and event.get("state") == "active":
+                self._pid_units[event["pid"]] = unit
+            self.manager_event(event, text)
+    def manager_event(self, event, text):
+        """ an event of this process or of any other call (on events.sock) """
+        self._unit_states[event["unit"]] = event.get("state")
+        if event.get("pid") and event.get("state") == "deactivating":
+            if len(self._stopping_pids) > 1000:
+                self._stopping_pids = {}
+            self._stopping_pids[event["pid"]] = event["unit"]
+        self.update_board(event)
+        self.retrigger_paths(event)
+        self.send_monitor_event(event["unit"], text)
+    def accept_monitor(self):
+        try:
+            conn, addr = self._monitor_socket.accept()
+        except socket.error:
+            return
+        conn.setblocking(0)
+        fcntl.fcntl(conn.fileno(), fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+        self._monitor_conns[conn.fileno()] = [ conn, None, "" ]
+        self._loop_readers[conn.fileno()] = lambda fileno=conn.fileno(): self.read_monitor(fileno)
+    def read_monitor(self, fileno):
+        """ the subscription line - or the subscriber has gone away """
+        conn, patterns, text = self._monitor_conns[fileno]
+        try:
+            data = conn.recv(4096)
+        except socket.error, e:
+            if e.args[0] == errno.EAGAIN: return
+            data = ""
+        if not data:
+            self.drop_monitor(fileno)
+            return
+        if patterns is None:
+            text += data
+            if "\n" in text:
+                line, text = text.split("\n", 1)
+                patterns = line.split()
+                logg.info("monitor subscriber %s: %s", fileno, " ".join(patterns) or "*")
+            self._monitor_conns[fileno] = [ conn, patterns, text ]
+    def drop_monitor(self, fileno):
+        conn = self._monitor_conns.pop(fileno)[0]
+        self._loop_readers.pop(fileno, None)
+        try: conn.close()
+        except socket.error: pass
+    def send_monitor_event(self, unit, text):
+        """ the patterns are matched here, so a subscriber gets only its units -
+            a subscriber that does not read its events is dropped """
+        for fileno, (conn, patterns, pending) in self._monitor_conns.items():
+            if patterns is None:
+                continue
+            if patterns and not [ pattern for pattern in patterns if fnmatch.fnmatchcase(unit, pattern) ]:
+                continue
+            try:
+                sent = conn.send(text)
+            except socket.error, e:
+                sent = 0
+            if sent < len(text):
+                logg.warning("monitor subscriber %s does not read its events", fileno)
+                self.drop_monitor(fileno)
+    def monitor_of_units(self, *modules): # -> generate[ json line ]
+        """ the state changes of the units (by fnmatch patterns) as they happen """
+        try:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(self.monitor_path())
+        except socket.error, e:
+            logg.error("no init process to subscribe to (%s): %s", self.monitor_path(), e)
+            return False
+        sock.sendall(" ".join(modules) + "\n")
+        self._follow = True
+        return self.each_monitor_event(sock)
+    def each_monitor_event(self, sock):
+        reader = sock.makefile("r", 0)
+        while True:
+            line = reader.readline()
+            if not line:
+                break
+            yield line
     def system_0(self):
         self.system_default("init 0")
         return self.system_wait("init 1")
     def system_1(self):
+        self._init_loop = True
+        self.start_syslog()
+        self.start_monitor()
+        self.start_control()
+        self.start_board("starting")
         self.system_default("init 1")
+        self.set_board_system("running")
+        self.system_compact()
         return self.system_wait("init 1")
+    def system_compact(self):
+        """ the init process keeps a small runtime record per started unit
+            and drops all the parsed configs - they are read again lazily """
+        rss1, peak1 = self.proc_memory()
+        for unit in self._unit_stats:
+            try:
+                conf = self.read_unit(unit)
+                pid_file = self.get_pid_file_from(conf)
+                self._runtime[unit] = { "pid_file": pid_file, "pid": self.read_pid_file(pid_file) }
+            except Exception, e:
+                logg.debug("runtime %s: %s", unit, e)
+        self.system_daemon_reload()
+        gc.collect()
+        rss2, peak2 = self.proc_memory()
+        logg.info("compacted %s units: rss %s -> %s kB (peak %s kB)",
+                  len(self._runtime), rss1 / 1024, rss2 / 1024, peak2 / 1024)
+        return True
+    def runtime_pid_from(self, unit): # -> pid?
+        """ the active pid of a started unit without parsing its config """
+        if unit in self._runtime:
+            pid = self.read_pid_file(self._runtime[unit]["pid_file"])
+            if pid and self.pid_exists(pid):
+                self._runtime[unit]["pid"] = pid
+                return pid
+            return None
+        return self.active_pid_from(self.read_unit(unit))
+    def loop_readers(self): # -> { fileno: handler }
+        readers = dict(self._loop_readers)
+        for fileno, unit in self.listening_sockets().items():
+            readers[fileno] = lambda unit=unit: self.activate_socket(unit)
+        return readers
+    def loop_timeout(self): # -> seconds?
+        """ the 'wait' loop sleeps until the next timer or periodic job """
+        timeouts = []
+        timeout = self.timers_timeout()
+        if timeout is not None:
+            timeouts.append(timeout)
+        if self._metrics_next is not None:
+            timeouts.append(max(0, self._metrics_next - time.time()))
+        if not timeouts:
+            return None
+        return min(timeouts)
+    def run_loop_jobs(self):
+        """ the periodic jobs of the 'wait' loop that are due """
+        self.run_elapsed_timers()
+        self.write_syslog_queue()
+        if self._metrics_next is not None and self._metrics_next <= time.time():
+            self.write_metrics()
+        if self._job_worker:
+            self.run_queued_jobs()
+    def start_metrics(self):
+        """ --metrics=FILE writes a prometheus text file every --metrics-interval,
+            --metrics=unix:PATH serves the last sample on a unix socket """
+        if not self._metrics:
+            return
+        if self._metrics.startswith("unix:"):
+            path = self._metrics[len("unix:"):]
+            if os.path.exists(path):
+                os.unlink(path)
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.bind(path)
+            sock.listen(8)
+            sock.setblocking(0)
+            fcntl.fcntl(sock.fileno(), fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+            self._metrics_socket = sock
+            self._loop_readers[sock.fileno()] = self.serve_metrics
+        self._metrics_next = time.time()
+    def serve_metrics(self):
+        try:
+            conn, addr = self._metrics_socket.accept()
+        except socket.error:
+            return
+        try:
+            conn.setblocking(1)
+            conn.settimeout(1)
+            conn.sendall(self._metrics_text)
+        except socket.error, e:
+            logg.debug("metrics: %s", e)
+        conn.close()
+    def write_metrics(self):
+        started = time.time()
+        self._metrics_text = "".join(self.each_metrics_line())
+        if not self._metrics.startswith("unix:"):
+            tmp = self._metrics + ".tmp"
+            with open(tmp, "w") as f:
+                f.write(self._metrics_text)
+            os.rename(tmp, self._metrics)
+        self._loop_stats["sample_seconds"] = time.time() - started
+        self._metrics_next = started + self._metrics_interval
+    def proc_group_usage(self): # -> { pgid: (cpu_seconds, rss_bytes) }
+        """ one pass over /proc/*/stat summing up per process group """
+        ticks = float(os.sysconf("SC_CLK_TCK"))
+        pagesize = resource.getpagesize()
+        usage = {}
+        for pid in os.listdir("/proc"):
+            if not pid.isdigit(): continue
+            try:
+                stat = open("/proc/%s/stat" % pid).read()
+            except IOError:
+                continue
+            fields = stat[stat.rfind(")")+2:].split()
+            pgid = int(fields[2])
+            cpu, rss = usage.get(pgid, (0.0, 0))
+            usage[pgid] = (cpu + (int(fields[11]) + int(fields[12])) / ticks,
+                           rss + int(fields[21]) * pagesize)
+        return usage
+    def proc_memory(self, pid = "self"): # -> (rss_bytes, peak_bytes)
+        rss, peak = 0, 0
+        for line in open("/proc/%s/status" % pid):
+            if line.startswith("VmRSS:"):
+                rss = int(line.split()[1]) * 1024
+            if line.startswith("VmHWM:"):
+                peak = int(line.split()[1]) * 1024
+        return rss, peak
+    def start_syslog(self):
+        """ --syslog=/dev/log binds a datagram socket (like rsyslog does),
+            --syslog=stream:/dev/log a stream socket for the services """
+        if not self._syslog or self._syslog_socket:
+            return
+        kind, path = socket.SOCK_DGRAM, self._syslog
+        if path.startswith("stream:"):
+            kind, path = socket.SOCK_STREAM, path[len("stream:"):]
+        elif path.startswith("dgram:"):
+            path = path[len("dgram:"):]
+        try:
+            if os.path.exists(path):
+                os.unlink(path)
+            sock = socket.socket(socket.AF_UNIX, kind)
+            sock.bind(path)
+            os.chmod(path, 0666)
+            if kind == socket.SOCK_STREAM:
+                sock.listen(32)
+            sock.setblocking(0)
+            fcntl.fcntl(sock.fileno(), fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+        except socket.error, e:
+            logg.error("syslog %s: %s", path, e)
+            return
+        self._syslog_socket = sock
+        if kind == socket.SOCK_STREAM:
+            self._loop_readers[sock.fileno()] = self.accept_syslog
+        else:
+            self._loop_readers[sock.fileno()] = self.read_syslog_dgram
+    def read_syslog_dgram(self):
+        """ drain the socket buffer so that a service never blocks in syslog() """
+        while True:
+            try:
+                text = self._syslog_socket.recv(65536)
+            except socket.error:
+                return
+            self.queue_syslog(None, text)
+    def accept_syslog(self):
+        try:
+            conn, addr = self._syslog_socket.accept()
+        except socket.error:
+            return
+        conn.setblocking(0)
+        fcntl.fcntl(conn.fileno(), fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+        pid = None
+        try:
+            creds = conn.getsockopt(socket.SOL_SOCKET, getattr(socket, "SO_PEERCRED", 17), struct.calcsize("3i"))
+            pid = struct.unpack("3i", creds)[0]
+        except socket.error, e:
+            logg.debug("syslog peer: %s", e)
+        self._syslog_conns[conn.fileno()] = (conn, pid, "")
+        self._loop_readers[conn.fileno()] = lambda fileno=conn.fileno(): self.read_syslog_stream(fileno)
+    def read_syslog_stream(self, fileno):
+        """ messages on a stream are terminated by a newline or a nul byte """
+        conn, pid, text = self._syslog_conns[fileno]
+        try:
+            data = conn.recv(65536)
+        except socket.error, e:
+            if e.args[0] == errno.EAGAIN: return
+            data = ""
+        lines = re.split(r"[\n\0]", text + data)
+        for line in lines[:-1]:
+            if line: self.queue_syslog(pid, line)
+        if data:
+            self._syslog_conns[fileno] = (conn, pid, lines[-1][-65536:])
+            return
+        if lines[-1]:
+            self.queue_syslog(pid, lines[-1])
+        del self._syslog_conns[fileno]
+        del self._loop_readers[fileno]
+        conn.close()
+    def queue_syslog(self, pid, text):
+        if len(self._syslog_queue) == self._syslog_queue.maxlen:
+            self._syslog_dropped += 1
+        self._syslog_queue.append((time.time(), pid, text))
+    def write_syslog_queue(self):
+        """ the queued messages go to /var/log/journal/UNIT.log of the sending
+            unit - or to the console (stderr) if the unit is not known """
+        if self._syslog_dropped:
+            logg.warning("syslog queue full: dropped %s messages", self._syslog_dropped)
+            self._syslog_dropped = 0
+        files = {}
+        while self._syslog_queue:
+            when, peer, text = self._syslog_queue.popleft()
+            priority, tag, pid, message = parse_syslog(text.rstrip("\n"))
+            unit = self.unit_of_pid(peer or pid) or self.unit_of_tag(tag)
+            line = "%s %s[%s]: %s\n" % (journal_stamp(when), tag or "-", peer or pid or "", message)
+            if unit not in files:
+                files[unit] = sys.stderr
+                if unit:
+                    try:
+                        if not os.path.isdir(self._log_folder):
+                            os.makedirs(self._log_folder)
+                        files[unit] = open(os.path.join(self._log_folder, unit + ".log"), "a")
+                        files[unit].seek(0, os.SEEK_END)
+                    except IOError, e:
+                        logg.debug("syslog %s: %s", unit, e)
+            try:
+                if files[unit] is not sys.stderr:
+                    self.index_journal(unit, when, files[unit].tell())
+                    files[unit].write(line)
+                else:
+                    files[unit].write(journal_local(line))
+            except IOError, e:
+                logg.debug("syslog %s: %s", unit, e)
+        for unit, f in files.items():
+            if f is sys.stderr: f.flush()
+            else: f.close()
+    def index_journal(self, unit, when, offset):
+        """ a UNIT.idx entry (time, offset) every _journal_block bytes of UNIT.log """
+        if unit not in self._journal_index:
+            self._journal_index[unit] = None
+            index = self.read_journal_index(unit)
+            if index[1]:
+                self._journal_index[unit] = index[1][-1]
+        last = self._journal_index[unit]
+        if last is not None and offset - last < _journal_block:
+            return
+        with open(os.path.join(self._log_folder, unit + ".idx"), "ab") as f:
+            f.write(_journal_index.pack(when, offset))
+        self._journal_index[unit] = offset
+    def read_journal_index(self, unit): # -> ([ times ], [ offsets ])
+        times, offsets = [], []
+        path = os.path.join(self._log_folder, unit + ".idx")
+        try:
+            data = open(path, "rb").read()
+        except IOError:
+            return times, offsets
+        for n in xrange(len(data) / _journal_index.size):
+            when, offset = _journal_index.unpack_from(data, n * _journal_index.size)
+            times.append(when)
+            offsets.append(offset)
+        return times, offsets
+    def journal_units(self, modules): # -> [ name.service ]
+        """ the units with a UNIT.log (by -u and the arguments, or all) """
+        if not os.path.isdir(self._log_folder):
+            return []
+        logs = sorted([ name[:-len(".log")] for name in os.listdir(self._log_folder) if name.endswith(".log") ])
+        patterns = list(self._journal_units or []) + list(modules)
+        if not patterns:
+            return logs
+        units = []
+        for pattern in patterns:
+            if not self.get_unit_type(pattern) and not pattern.endswith("*"):
+                pattern += ".service"
+            for unit in logs:
+                if fnmatch.fnmatchcase(unit, pattern) and unit not in units:
+                    units.append(unit)
+        return units
+    def journal_of_units(self, *modules): # -> generate[ line ]
+        """ the lines of UNIT.log files (-u UNIT) within --since and --until,
+            the last -n lines of them, and with -f the lines to come """
+        since = self._since and parse_journal_time(self._since)
+        until = self._until and parse_journal_time(self._until)
+        if self._since and since is None or self._until and until is None:
+            logg.error("bad time in --since=%s --until=%s", self._since, self._until)
+            return False
+        lines = self._lines and int(self._lines) or None
+        if lines is None and since is None and self._journal_follow:
+            lines = 10
+        units = self.journal_units(modules)
+        if not units:
+            logg.error("no journal for %s", " ".join(list(self._journal_units or []) + list(modules)) or "any unit")
+            return False
+        self._follow = self._journal_follow
+        return self.each_journal_line(units, since, until, lines)
+    def each_journal_line(self, units, since, until, lines):
+        ends = {}
+        merged = heapq.merge(*[ self.each_journal_entry(unit, since, until, lines, ends) for unit in units ])
+        if lines:
+            merged = collections.deque(merged, maxlen = lines)
+        cache = {}
+        for when, line in merged:
+            yield journal_local(line, cache)
+        if not self._journal_follow:
+            return
+        try:
+            while True:
+                for unit in units:
+                    for line in self.read_journal_from(unit, ends):
+                        yield journal_local(line, cache)
+                self._proc.sleep(0.2)
+        except KeyboardInterrupt:
+            return
+    def each_journal_entry(self, unit, since, until, lines, ends): # -> generate[ (time, line) ]
+        """ the index is bisected for the --since offset, and the end of the
+            mmap'ed log is searched backwards for the last -n lines. The
+            times are compared as numbers (the lines have a UTC time). """
+        path = os.path.join(self._log_folder, unit + ".log")
+        ends[unit] = 0
+        try:
+            f = open(path, "rb")
+        except IOError, e:
+            logg.debug("journal %s: %s", unit, e)
+            return
+        size = os.fstat(f.fileno()).st_size
+        if not size:
+            f.close()
+            return
+        data = mmap.mmap(f.fileno(), size, access = mmap.ACCESS_READ)
+        times, offsets = self.read_journal_index(unit)
+        cache = {}
+        end = data.rfind("\n") + 1 # a partial line is still being written
+        ends[unit] = end
+        if until is not None:
+            n = bisect.bisect_left(times, until)
+            if n < len(offsets):
+                end = offsets[n]
+            # the exact end is within the index block before
+            pos = n > 0 and offsets[n-1] or 0
+            while pos < end:
+                if journal_time(data[pos:pos+27], cache) >= until:
+                    end = pos
+                    break
+                pos = data.find("\n", pos, end) + 1
+        start = 0
+        if since is not None:
+            n = bisect.bisect_left(times, since) - 1
+            if n >= 0:
+                start = offsets[n]
+        if lines:
+            last = end
+            for x in xrange(lines):
+                if last <= start: break
+                last = data.rfind("\n", 0, last - 1) + 1
+            start = max(start, last)
+        pos = start
+        when = 0.0
+        try:
+            while pos < end:
+                eol = data.find("\n", pos, end)
+                line = data[pos:eol+1]
+                pos = eol + 1
+                when = journal_time(line, cache) or when
+                if since is None or when >= since:
+                    yield when, line
+        finally:
+            data.close()
+            f.close()
+    def read_journal_from(self, unit, ends): # -> [ line ]
+        """ the lines appended since the last read (for -f) """
+        path = os.path.join(self._log_folder, unit + ".log")
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return []
+        if size < ends.get(unit, 0):
+            ends[unit] = 0 # truncated
+        if size == ends.get(unit, 0):
+            return []
+        with open(path, "rb") as f:
+            f.seek(ends.get(unit, 0))
+            text = f.read(size - ends.get(unit, 0))
+        complete = text.rfind("\n") + 1
+        ends[unit] = ends.get(unit, 0) + complete
+        return text[:complete].splitlines(True)
+    def unit_of_pid(self, pid): # -> name.service?
+        """ the started unit whose main process is the sender (or the
+            leader of its session / process group) """
+        if not pid:
+            return None
+        if pid in self._pid_units:
+            return self._pid_units[pid]
+        try:
+            leaders = set([ pid, os.getpgid(pid), os.getsid(pid) ])
+        except OSError:
+            return None
+        found = None
+        for unit in self._unit_stats:
+            try:
+                main = self.runtime_pid_from(unit)
+            except Exception, e:
+                continue
+            if main and int(main) in leaders:
+                found = unit
+                break
+        if len(self._pid_units) > 1000:
+            self._pid_units = {}
+        self._pid_units[pid] = found
+        return found
+    def unit_of_exited(self, pid): # -> name.service?
+        """ the unit whose pid file does still name the reaped process """
+        unit = self._pid_units.get(pid) or self._unit_pids.get(pid)
+        if unit:
+            return unit
+        for unit in self._unit_stats:
+            try:
+                if unit in self._runtime:
+                    pid_file = self._runtime[unit]["pid_file"]
+                else:
+                    pid_file = self.get_pid_file_from(self.read_unit(unit))
+            except Exception, e:
+                continue
+            if self.read_pid_file(pid_file) == pid:
+                return unit
+        return None
+    def unit_of_tag(self, tag): # -> name.service?
+        if tag and tag + ".service" in self._unit_stats:
+            return tag + ".service"
+        return None
+    def start_memory_pressure(self):
+        """ --memory-pressure=60% registers a PSI trigger on the memory.pressure
+            of the container cgroup (or /proc/pressure/memory) that wakes up
+            the 'wait' loop (as a POLLPRI) when some task was stalled on
+            memory for more than that part of a two seconds window (which
+            is the granularity allowed without CAP_SYS_RESOURCE as in docker) """
+        if not self._memory_pressure or self._pressure_file:
+            return
+        limit = float(self._memory_pressure.rstrip("%")) / 100.0
+        window = 2000000
+        trigger = "some %i %i" % (max(1, min(window - 1, int(limit * window))), window)
+        candidates = [ "/proc/pressure/memory" ]
+        try:
+            candidates.insert(0, os.path.join(self.manager_cgroup(), "memory.pressure"))
+        except IOError, e:
+            logg.debug("no cgroup: %s", e)
+        for path in candidates:
+            try:
+                fd = os.open(path, os.O_RDWR | os.O_NONBLOCK)
+            except OSError, e:
+                logg.debug("memory pressure %s: %s", path, e)
+                continue
+            try:
+                os.write(fd, trigger + "\0")
+            except OSError, e:
+                logg.debug("memory pressure trigger %s: %s", path, e)
+                os.close(fd)
+                continue
+            fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+            logg.info("memory pressure trigger '%s' on %s", trigger, path)
+            self._pressure_file = path
+            self._loop_exceptions[fd] = self.memory_pressure
+            return
+        logg.error("no PSI memory pressure available - ignoring --memory-pressure")
+    def read_memory_pressure(self): # -> { "some": { "avg10": .. }, "full": .. }
+        result = {}
+        for line in open(self._pressure_file):
+            values = line.split()
+            if values:
+                result[values[0]] = dict(item.split("=", 1) for item in values[1:])
+        return result
+    def memory_pressure(self):
+        """ shed one unit according to its ManagedOOM* policy (in a 10s cooldown):
+            ManagedOOMMemoryPressure=kill makes it a candidate for being stopped,
+            ManagedOOMPreference=avoid takes it last and =omit never.
+            X-MemoryPressureAction=stop|restart|signal (X-MemoryPressureSignal=)
+            may choose another action than the stop - a stop or restart is
+            queued as a job for a forked worker, so the init loop goes on.
+            The units that are not candidates get their oom_score_adj
+            lowered by their preference. """
+        try:
+            psi = self.read_memory_pressure().get("some", {})
+        except IOError, e:
+            psi = {}
+        numbers = "some avg10=%s avg60=%s total=%s" % (psi.get("avg10"), psi.get("avg60"), psi.get("total"))
+        now = self._proc.time()
+        if now < self._pressure_next:
+            logg.debug("memory pressure %s (cooldown)", numbers)
+            return
+        self._pressure_next = now + 10
+        usage = self.proc_group_usage()
+        candidates = []
+        for unit in sorted(self._unit_stats):
+            try:
+                conf = self.read_unit(unit)
+                pid = self.runtime_pid_from(unit)
+            except Exception, e:
+                continue
+            if not pid:
+                continue
+            preference = conf.get("Service", "ManagedOOMPreference", "none").lower()
+            if preference in [ "avoid", "omit" ]:
+                self.adjust_oom_score(unit, int(pid), preference == "omit" and -1000 or -500, numbers)
+            if conf.get("Service", "ManagedOOMMemoryPressure", "auto").lower() != "kill":
+                continue
+            if preference == "omit":
+                continue
+            try:
+                rss = usage.get(os.getpgid(int(pid)), (0.0, 0))[1]
+            except OSError:
+                continue
+            candidates.append((preference == "avoid", -rss, unit, conf, int(pid)))
+        if not candidates:
+            logg.warning("memory pressure %s: no unit to act on", numbers)
+            return
+        avoid, rss, unit, conf, pid = sorted(candidates)[0]
+        action = conf.get("Service", "X-MemoryPressureAction", "stop").lower()
+        logg.warning("memory pressure %s: %s %s (rss %s kB)", numbers, action, unit, -rss / 1024)
+        try:
+            if action == "signal":
+                signame = conf.get("Service", "X-MemoryPressureSignal", "SIGUSR1")
+                signum = getattr(signal, signame.upper(), signal.SIGUSR1)
+                if self.pid_group_leader(pid): self._proc.killpg(pid, signum)
+                else: self._proc.kill(pid, signum)
+            elif action != "none":
+                self.enqueue_jobs(action == "restart" and "restart" or "stop", [ unit ])
+        except Exception, e:
+            logg.error("memory pressure: %s %s: %s", action, unit, e)
+    def adjust_oom_score(self, unit, pid, score, numbers):
+        """ protect the process group of a preferred unit from the oom killer """
+        try:
+            pids = [ pid ]
+            if self.pid_group_leader(pid):
+                pids = [ int(p) for p in os.listdir("/proc") if p.isdigit() and self.pgid_of(int(p)) == pid ]
+            changed = False
+            for member in pids:
+                path = "/proc/%s/oom_score_adj" % member
+                if int(open(path).read().strip() or 0) > score:
+                    with open(path, "w") as f:
+                        f.write(str(score))
+                    changed = True
+            if changed:
+                logg.warning("memory pressure %s: oom_score_adj %s for %s", numbers, score, unit)
+        except (IOError, OSError, ValueError), e:
+            logg.debug("oom_score_adj %s: %s", unit, e)
+    def pgid_of(self, pid): # -> pgid?
+        try:
+            return os.getpgid(pid)
+        except OSError:
+            return None
+    def each_metrics_line(self): # -> generate[ text ]
+        usage = self.proc_group_usage()
+        self._unit_pids = {}
+        yield "# TYPE systemctl_unit_active gauge\n"
+        samples = []
+        for unit in sorted(self._unit_stats):
+            stats = self._unit_stats[unit]
+            pid = None
+            try:
+                pid = self.runtime_pid_from(unit)
+            except Exception, e:
+                logg.debug("metrics %s: %s", unit, e)
+            cpu, rss = 0.0, 0
+            if pid:
+                self._unit_pids[pid] = unit
+                try:
+                    cpu, rss = usage.get(os.getpgid(pid), (0.0, 0))
+                except OSError:
+                    pass
+            label = metrics_label(unit)
+            samples.append((label, stats, pid, cpu, rss))
+            yield 'systemctl_unit_active{unit="%s"} %i\n' % (label, pid and 1 or 0)
+        yield "# TYPE systemctl_unit_cpu_seconds_total counter\n"
+        for label, stats, pid, cpu, rss in samples:
+            yield 'systemctl_unit_cpu_seconds_total{unit="%s"} %.2f\n' % (label, cpu + stats["reaped_cpu_seconds"])
+        yield "# TYPE systemctl_unit_memory_rss_bytes gauge\n"
+        for label, stats, pid, cpu, rss in samples:
+            yield 'systemctl_unit_memory_rss_bytes{unit="%s"} %i\n' % (label, rss)
+        yield "# TYPE systemctl_unit_restarts_total counter\n"
+        for label, stats, pid, cpu, rss in samples:
+            yield 'systemctl_unit_restarts_total{unit="%s"} %i\n' % (label, max(0, stats["starts"] - 1))
+        yield "# TYPE systemctl_unit_start_seconds gauge\n"
+        for label, stats, pid, cpu, rss in samples:
+            yield 'systemctl_unit_start_seconds{unit="%s"} %.3f\n' % (label, stats.get("start_seconds", 0))
+        rss, peak = self.proc_memory()
+        yield "# TYPE systemctl_manager_memory_rss_bytes gauge\n"
+        yield "systemctl_manager_memory_rss_bytes %i\n" % rss
+        yield "# TYPE systemctl_manager_memory_peak_bytes gauge\n"
+        yield "systemctl_manager_memory_peak_bytes %i\n" % peak
+        yield "# TYPE systemctl_manager_wakeups_total counter\n"
+        yield "systemctl_manager_wakeups_total %i\n" % self._loop_stats["wakeups"]
+        yield "# TYPE systemctl_manager_loop_seconds gauge\n"
+        yield "systemctl_manager_loop_seconds %.6f\n" % self._loop_stats["loop_seconds"]
+        yield "# TYPE systemctl_manager_loop_seconds_max gauge\n"
+        yield "systemctl_manager_loop_seconds_max %.6f\n" % self._loop_stats["loop_seconds_max"]
+        yield "# TYPE systemctl_manager_sample_seconds gauge\n"
+        yield "systemctl_manager_sample_seconds %.6f\n" % self._loop_stats.get("sample_seconds", 0)
     def system_wait(self, arg = True):
         """ wait and reap children """
+        self._init_loop = True
         signal.signal(signal.SIGTERM, lambda signum, frame: ignore_signals_and_raise_keyboard_interrupt('SIGTERM'))
         signal.signal(signal.SIGINT, lambda signum, frame: ignore_signals_and_raise_keyboard_interrupt('SIGINT'))
+        # a SIGCHLD does wake up the select() for reaping zombies
+        wakeup_read, wakeup_write = os.pipe()
+        for fd in (wakeup_read, wakeup_write):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+            fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+        signal.set_wakeup_fd(wakeup_write)
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        signal.siginterrupt(signal.SIGCHLD, False)
+        signal.signal(signal.SIGUSR1, lambda signum, frame: None)
+        signal.siginterrupt(signal.SIGUSR1, False)
+        self.start_metrics()
+        self.start_syslog()
+        self.start_monitor()
+        self.start_control()
+        self.start_board("running")
+        self.start_memory_pressure()
+        self.start_job_worker()
         while True:
             try:
-                time.sleep(10)
-                self.system_reap_zombies()
+                readers = self.loop_readers()
+                timeout = self.loop_timeout()
+                try:
+                    ready, _, urgent = select.select(readers.keys() + [ wakeup_read ], [],
+                                                     self._loop_exceptions.keys(), timeout)
+                except select.error, e:
+                    if e.args[0] != errno.EINTR: raise
+                    ready, urgent = [ wakeup_read ], []
+                awake = time.time()
+                for fileno in ready:
+                    if fileno in readers:
+                        readers[fileno]()
+                for fileno in urgent:
+                    if fileno in self._loop_exceptions:
+                        self._loop_exceptions[fileno]()
+                if wakeup_read in ready:
+                    try:
+                        while os.read(wakeup_read, 512): pass
+                    except OSError, e:
+                        if e.errno != errno.EAGAIN: raise
+                    self.system_reap_zombies()
+                self.run_loop_jobs()
+                busy = time.time() - awake
+                self._loop_stats["wakeups"] += 1
+                self._loop_stats["loop_seconds"] = busy
+                self._loop_stats["loop_seconds_max"] = max(busy, self._loop_stats["loop_seconds_max"])
             except KeyboardInterrupt:
+                self.stop_job_worker()
+                signal.set_wakeup_fd(-1)
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
                 signal.signal(signal.SIGTERM, signal.SIG_DFL)
                 signal.signal(signal.SIGINT, signal.SIG_DFL)
                 self.system_halt(arg)
@@ -1244,78 +4800,93 @@ class Systemctl:
 		    if m: zombie = True
 		    m = re.match(r"PPid:\s*(\d+)", line)
 		    if m: ppid = int(m.group(1))
-		if zombie and ppid == os.getpid():
+		if zombie and ppid == os.getpid() and pid not in self.job_worker_pids():
 		    logg.info("reap zombie %s", pid)
-		    try: os.waitpid(pid, os.WNOHANG)
+		    try: self.reaped(*os.wait4(pid, os.WNOHANG))
 		    except OSError, e: 
-			logg.warning("reap zombie %s: %s", e.strerror)
+			logg.warning("reap zombie %s: %s", pid, e.strerror)
+    def reaped(self, pid, status, rusage):
+        """ the cpu time of a reaped main process is kept for the metrics
+            and its exit is published as the end of the unit - a SIGTERM or
+            SIGKILL of a unit that is being stopped (or of the process of an
+            earlier run, after a restart) is not a failure """
+        exited = self.unit_of_exited(pid)
+        if exited:
+            state = self._unit_states.get(exited)
+            if os.WIFSIGNALED(status):
+                code = - os.WTERMSIG(status)
+            else:
+                code = os.WEXITSTATUS(status)
+            stopped = code in [ - signal.SIGTERM, - signal.SIGKILL ] and (
+                state in [ "deactivating", "inactive" ] or pid in self._stopping_pids)
+            if stopped and state != "deactivating":
+                logg.debug("reaped %s of %s (%s)", pid, exited, state)
+            else:
+                self.publish_event({ "unit": exited, "state": code and not stopped and "failed" or "inactive",
+                                     "pid": pid, "status": code, "time": round(self._proc.time(), 3) })
+        self._pid_units.pop(pid, None)
+        self._stopping_pids.pop(pid, None)
+        unit = self._unit_pids.get(pid)
+        if unit and unit in self._unit_stats:
+            self._unit_stats[unit]["reaped_cpu_seconds"] += rusage.ru_utime + rusage.ru_stime
+    def system_is_system_running(self): # -> (exitcode, state)
+        """ the system state on the status board of the init process -
+            'offline' when there is no init process writing it """
+        board = board_open(self._lock_folder)
+        if board is None:
+            return (1, "offline")
+        state = board_system_state(board)
+        return (int(state != "running"), state)
     def system_version(self):
         return [ ("Version", __version__), ("Copyright", __copyright__) ]
 
-if __name__ == "__main__":
-    import optparse
-    _o = optparse.OptionParser("%prog [options] command [name...]")
-    _o.add_option("-t","--type", metavar="NAMES")
-    _o.add_option("--state", metavar="STATES")
-    _o.add_option("-p", "--property", metavar="PROPERTIES")
-    _o.add_option("-a", "--all", action="store_true")
-    _o.add_option("--reverse", action="store_true")
-    _o.add_option("--after", action="store_true")
-    _o.add_option("--before", action="store_true")
-    _o.add_option("-l","--full", action="store_true", default=_full)
-    _o.add_option("--show-types", action="store_true")
-    _o.add_option("--job-mode", metavar="JOBTYPE")    
-    _o.add_option("-i","--ignore-inhibitors", action="store_true")
-    _o.add_option("-q","--quiet", action="store_true", default=_quiet)
-    _o.add_option("--no-block", action="store_true")
-    _o.add_option("--no-legend", action="store_true")
-    _o.add_option("--user", action="store_true")
-    _o.add_option("--system", action="store_true")
-    _o.add_option("--no-wall", action="store_true")
-    _o.add_option("--global", action="store_true")
-    _o.add_option("--no-reload", action="store_true")
-    _o.add_option("--no-ask-password", action="store_true")
-    _o.add_option("--kill-who", metavar="ALL")
-    _o.add_option("-s", "--signal", metavar="KILLSIG")
-    _o.add_option("--force", action="store_true", default=_force)
-    _o.add_option("--root", metavar="PATH")
-    _o.add_option("--runtime", metavar="PROPERTY")
-    _o.add_option("-n","--lines", metavar="NUMBER")
-    _o.add_option("-o","--output", metavar="SHORT")
-    _o.add_option("--plain", action="store_true")
-    _o.add_option("-H","--host", metavar="NAME")
-    _o.add_option("-M","--machine", metavar="CONTAINER")
-    _o.add_option("--no-pager", action="store_true")
-    _o.add_option("--version", action="store_true")
-    _o.add_option("-v","--verbose", action="count", default=0)
-    opt, args = _o.parse_args()
-    logging.basicConfig(level = max(0, logging.FATAL - 10 * opt.verbose))
-    logg.setLevel(max(0, logging.ERROR - 10 * opt.verbose))
-    if os.path.exists("/var/log/systemctl.log"):
-       loggfile = logging.FileHandler("/var/log/systemctl.log")
-       loggfile.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
-       logg.addHandler(loggfile)
-       logg.setLevel(max(0, logging.INFO - 10 * opt.verbose))
-       logg.info("EXEC BEGIN %s %s", os.path.realpath(sys.argv[0]), " ".join(args))
-    if opt.version:
-       args = [ "version" ]
-    #
+def set_options(opt, systemctl = None):
+    """ the commandline options are global defaults (and may be
+        reset on an existing instance in --batch mode) """
+    global _force, _stop_timeout, _quiet, _full, _property, _output
+    global _metrics, _metrics_interval, _instances, _syslog, _memory_pressure, _no_block
+    global _max_unavailable, _jobs, _connect_timeout, _reply_timeout
+    global _journal_units, _journal_follow, _since, _until, _lines
     _force = opt.force
+    _stop_timeout = float(opt.stop_timeout)
     _quiet = opt.quiet
     _full = opt.full
-    _property = getattr(opt, "property")
-    #
-    if not args: 
-        args = [ "list-units" ]
-        if os.getpid() == 0:
-            args = [ "0" ]
-        if os.getpid() == 1:
-            args = [ "1" ]
-            logg.setLevel(logging.INFO)
-    command = args[0]
-    modules = args[1:]
-    systemctl = Systemctl()
-    found = False
+    _property = [ name.strip() for names in (opt.property or []) for name in names.split(",") if name.strip() ]
+    _output = opt.output
+    _metrics = opt.metrics
+    _metrics_interval = float(opt.metrics_interval)
+    _instances = opt.instances
+    _syslog = opt.syslog
+    _memory_pressure = opt.memory_pressure
+    _no_block = opt.no_block
+    _max_unavailable = opt.max_unavailable
+    _jobs = opt.jobs
+    _connect_timeout = float(opt.connect_timeout)
+    _reply_timeout = float(opt.reply_timeout)
+    _journal_units = opt.unit
+    _journal_follow = opt.follow
+    _since = opt.since
+    _until = opt.until
+    _lines = opt.lines
+    if systemctl:
+        systemctl._journal_units = _journal_units
+        systemctl._journal_follow = _journal_follow
+        systemctl._since = _since
+        systemctl._until = _until
+        systemctl._lines = _lines
+        systemctl._max_unavailable = _max_unavailable
+        systemctl._no_block = _no_block
+        systemctl._force = _force
+        systemctl._instances = _instances
+        systemctl._stop_timeout = _stop_timeout
+        systemctl._quiet = _quiet
+        systemctl._full = _full
+        systemctl._output = _output
+
+def run_command(systemctl, command, modules): # -> (found, result)
+    """ dispatch to a *_of_unit, *_of_units, show_* or system_* method """
+    found, result = False, None
+    systemctl._exitcode = 0 # a streamed result does not inherit the last one
     # command NAME
     command_name = command.replace("-","_").replace(".","_")+"_of_unit"
     command_func = getattr(systemctl, command_name, None)
@@ -1343,25 +4914,26 @@ if __name__ == "__main__":
             if callable(comm_func):
                 found = True
                 result = comm_func()
-    if not found:
-        logg.error("EXEC END no method for '%s'", command)
-        sys.exit(1)
+    return found, result
+
+def print_result(systemctl, result): # -> exitcode
+    """ print the result of a command and map it to an exitcode """
     if result is None:
         logg.info("EXEC END None")
-        sys.exit(0)
+        return 0
     elif result is True:
         logg.info("EXEC END True")
-        sys.exit(0)
+        return 0
     elif result is False:
         logg.info("EXEC END False")
-        sys.exit(1)
+        return 1
     elif isinstance(result, tuple) and len(result) == 2:
         exitcode, status = result
         print status
         logg.info("EXEC END %s '%s'", exitcode, status)
         if exitcode is True: exitcode = 0
         if exitcode is False: exitcode = 1
-        sys.exit(exitcode)
+        return exitcode
     elif isinstance(result, basestring):
         print result
         logg.info("EXEC END '%s'", result)
@@ -1372,6 +4944,16 @@ if __name__ == "__main__":
             else:
                 print element
         logg.info("EXEC END %s", result)
+    elif hasattr(result, "next"):
+        try:
+            for text in result:
+                sys.stdout.write(text)
+                if systemctl._follow:
+                    sys.stdout.flush()
+        except IOError, e:
+            if e.errno != errno.EPIPE: raise
+        logg.info("EXEC END %s", systemctl._exitcode)
+        return systemctl._exitcode
     elif hasattr(result, "keys"):
         for key in sorted(result.keys()):
             element = result[key]
@@ -1382,3 +4964,258 @@ if __name__ == "__main__":
         logg.info("EXEC END %s", result)
     else:
         logg.warning("EXEC END Unknown result type %s", str(type(result)))
+    return 0
+
+def control_sockets(targets): # -> [ (machine, path) ]
+    """ the -H/-M arguments are control.sock paths or globs of them - the
+        machine name is the part of the path that differs between them """
+    paths = []
+    for target in targets:
+        found = sorted(glob.glob(target)) or [ target ]
+        for path in found:
+            if path not in paths:
+                paths.append(path)
+    if len(paths) < 2:
+        return [ (path, path) for path in paths ]
+    parts = [ path.split("/") for path in paths ]
+    def same(index): # path component in all the paths
+        return len(set([ part[index] for part in parts ])) == 1
+    shortest = min([ len(part) for part in parts ])
+    prefix = 0
+    while prefix < shortest - 1 and same(prefix):
+        prefix += 1
+    suffix = 0
+    while prefix + suffix < shortest - 1 and same(-1 - suffix):
+        suffix += 1
+    return [ ("/".join(part[prefix:len(part)-suffix]), path) for part, path in zip(parts, paths) ]
+
+def remote_command_line(argv): # -> text
+    """ the commandline without the -H/-M options (and their arguments) """
+    local = [ "-H", "--host", "-M", "--machine", "--connect-timeout", "--reply-timeout" ]
+    args = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg in local:
+            skip = True
+        elif [ name for name in local if arg.startswith(name + "=") ]:
+            pass
+        elif [ name for name in local if len(name) == 2 and arg.startswith(name) ]:
+            pass
+        else:
+            args.append(arg)
+    return " ".join([ pipes.quote(arg) for arg in args ])
+
+def run_remote(targets, line, timeout, output = None, reply_timeout = None): # -> exitcode
+    """ send the command line to all the control sockets at once and print
+        the answers with a 'machine: ' prefix (or as a json list) """
+    machines = control_sockets(targets)
+    conns = {} # socket => [ machine, received text ]
+    results = {} # machine => (exitcode, output)
+    for machine, path in machines:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.setblocking(0)
+        try:
+            sock.connect(path)
+        except socket.error, e:
+            if e.args[0] not in [ errno.EAGAIN, errno.EINPROGRESS ]:
+                results[machine] = (1, None)
+                logg.error("%s: %s", machine, e)
+                continue
+        conns[sock] = [ machine, "", False ]
+    deadline = time.time() + timeout
+    reply_deadline = time.time() + (reply_timeout or _reply_timeout)
+    while conns:
+        sending = [ sock for sock, conn in conns.items() if not conn[2] ]
+        if sending:
+            wait = max(0, min(deadline, reply_deadline) - time.time())
+        else:
+            wait = max(0, reply_deadline - time.time())
+        readable, writable, _ = select.select(conns.keys(), sending, [], wait)
+        if not readable and not writable:
+            for sock, (machine, text, sent) in conns.items():
+                if sent and time.time() < reply_deadline:
+                    continue
+                logg.error("%s: %s timeout", machine, sent and "reply" or "connection")
+                results[machine] = (1, None)
+                del conns[sock]
+                sock.close()
+            continue
+        for sock in writable:
+            sock.setblocking(1)
+            try:
+                sock.sendall(line + "\n")
+                conns[sock][2] = True
+            except socket.error, e:
+                logg.error("%s: %s", conns[sock][0], e)
+                results[conns.pop(sock)[0]] = (1, None)
+                sock.close()
+        for sock in readable:
+            if sock not in conns:
+                continue
+            try:
+                data = sock.recv(65536)
+            except socket.error, e:
+                logg.error("%s: %s", conns[sock][0], e)
+                data = ""
+            if data:
+                conns[sock][1] += data
+                continue
+            machine, text, sent = conns.pop(sock)
+            sock.close()
+            try:
+                answer = json.loads(text)
+                results[machine] = (answer["exitcode"], answer["output"])
+            except (ValueError, KeyError, TypeError), e:
+                logg.error("%s: bad answer (%s)", machine, e)
+                results[machine] = (1, None)
+    worst = 0
+    records = []
+    for machine, path in machines:
+        exitcode, text = results[machine]
+        worst = max(worst, exitcode)
+        if output == "json":
+            record = [ ("machine", machine), ("exitcode", exitcode) ]
+            try:
+                record.append(("result", json.loads(text)))
+            except (ValueError, TypeError):
+                record.append(("output", text))
+            records.append(record)
+        elif text:
+            for line in text.splitlines():
+                print "%s: %s" % (machine, line)
+    if output == "json":
+        for text in json_list(records):
+            sys.stdout.write(text)
+    return worst
+
+def run_batch(systemctl, filename): # -> exitcode
+    """ run one command per line on the same Systemctl instance so that the
+        unit files are scanned and parsed only once. The exitcode of each
+        line is reported on stderr - the worst one is returned. """
+    worst = 0
+    batch = filename == "-" and sys.stdin or open(filename)
+    for lineno, line in enumerate(batch):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        exitcode = 1
+        try:
+            opt, args = _o.parse_args(shlex.split(line))
+            set_options(opt, systemctl)
+            found, result = run_command(systemctl, args[0], args[1:])
+            if not found:
+                logg.error("no method for '%s'", args[0])
+            else:
+                exitcode = print_result(systemctl, result)
+        except SystemExit, e:
+            exitcode = e.code or 0
+        except Exception, e:
+            logg.error("%s: %s", line, e)
+        sys.stdout.flush()
+        sys.stderr.write("#%s exit %s: %s\n" % (lineno + 1, exitcode, line))
+        worst = max(worst, exitcode)
+    return worst
+
+if __name__ == "__main__":
+    import optparse
+    _o = optparse.OptionParser("%prog [options] command [name...]")
+    _o.add_option("-t","--type", metavar="NAMES")
+    _o.add_option("--state", metavar="STATES")
+    _o.add_option("-p", "--property", metavar="PROPERTIES", action="append",
+        help="show only these properties (comma-separated, repeatable)")
+    _o.add_option("-a", "--all", action="store_true")
+    _o.add_option("--reverse", action="store_true")
+    _o.add_option("--after", action="store_true")
+    _o.add_option("--before", action="store_true")
+    _o.add_option("-l","--full", action="store_true", default=_full)
+    _o.add_option("--show-types", action="store_true")
+    _o.add_option("--job-mode", metavar="JOBTYPE")    
+    _o.add_option("-i","--ignore-inhibitors", action="store_true")
+    _o.add_option("-q","--quiet", action="store_true", default=_quiet)
+    _o.add_option("--no-block", action="store_true", default=_no_block,
+        help="start/stop/restart enqueue a job and print its id (see list-jobs)")
+    _o.add_option("--no-legend", action="store_true")
+    _o.add_option("--user", action="store_true")
+    _o.add_option("--system", action="store_true")
+    _o.add_option("--no-wall", action="store_true")
+    _o.add_option("--global", action="store_true")
+    _o.add_option("--no-reload", action="store_true")
+    _o.add_option("--no-ask-password", action="store_true")
+    _o.add_option("--kill-who", metavar="ALL")
+    _o.add_option("-s", "--signal", metavar="KILLSIG")
+    _o.add_option("--force", action="store_true", default=_force)
+    _o.add_option("--stop-timeout", metavar="SECONDS", default=_stop_timeout,
+        help="overall deadline for the init halt (default %default)")
+    _o.add_option("--root", metavar="PATH")
+    _o.add_option("--runtime", metavar="PROPERTY")
+    _o.add_option("-n","--lines", metavar="NUMBER")
+    _o.add_option("-u","--unit", metavar="UNIT", action="append",
+        help="the journal of UNIT (repeatable)")
+    _o.add_option("--since", metavar="TIME", help="journal from TIME (like '2024-01-31 12:00' or '-1h')")
+    _o.add_option("--until", metavar="TIME", help="journal before TIME")
+    _o.add_option("-f","--follow", action="store_true", help="journal lines as they are written")
+    _o.add_option("-o","--output", metavar="SHORT")
+    _o.add_option("--plain", action="store_true")
+    _o.add_option("-H","--host", metavar="SOCKET", action="append",
+        help="run the command on the init process of a control.sock (path or glob)")
+    _o.add_option("-M","--machine", metavar="SOCKET", action="append",
+        help="the same as --host")
+    _o.add_option("--connect-timeout", metavar="SECONDS", default=_connect_timeout)
+    _o.add_option("--reply-timeout", metavar="SECONDS", default=_reply_timeout,
+        help="the time for the answers of -H/-M (default %default)")
+    _o.add_option("--no-pager", action="store_true")
+    _o.add_option("--version", action="store_true")
+    _o.add_option("-v","--verbose", action="count", default=0)
+    _o.add_option("--metrics", metavar="FILE", default=_metrics,
+        help="init loop writes prometheus metrics to FILE (or unix:PATH socket)")
+    _o.add_option("--metrics-interval", metavar="SECONDS", default=_metrics_interval)
+    _o.add_option("--instances", metavar="N",
+        help="the instances of a template unit 'name@' as 1..N (or 'auto' for the cpus)")
+    _o.add_option("--syslog", metavar="PATH", default=_syslog,
+        help="init process receives syslog messages on PATH (e.g. /dev/log or stream:/dev/log)")
+    _o.add_option("--memory-pressure", metavar="LIMIT", default=_memory_pressure,
+        help="init process acts on the units' ManagedOOM* policy above the PSI LIMIT (e.g. 60%)")
+    _o.add_option("--max-unavailable", metavar="N", default=_max_unavailable,
+        help="units restarted at the same time by rolling-restart (or a percentage)")
+    _o.add_option("--jobs", metavar="N", default=_jobs,
+        help="units started in parallel at boot (default 1, 'auto' by the number of cpus)")
+    _o.add_option("--batch", metavar="FILE",
+        help="run the commands from FILE line by line ('-' for stdin)")
+    opt, args = _o.parse_args()
+    logging.basicConfig(level = max(0, logging.FATAL - 10 * opt.verbose))
+    logg.setLevel(max(0, logging.ERROR - 10 * opt.verbose))
+    if os.path.exists("/var/log/systemctl.log"):
+       loggfile = logging.FileHandler("/var/log/systemctl.log")
+       loggfile.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+       logg.addHandler(loggfile)
+       logg.setLevel(max(0, logging.INFO - 10 * opt.verbose))
+       logg.info("EXEC BEGIN %s %s", os.path.realpath(sys.argv[0]), " ".join(args))
+    if opt.version:
+       args = [ "version" ]
+    if os.path.basename(sys.argv[0]) in [ "journalctl", "journalctl.py" ]:
+       args = [ "journal" ] + args
+    #
+    set_options(opt)
+    #
+    if not args: 
+        args = [ "list-units" ]
+        if os.getpid() == 0:
+            args = [ "0" ]
+        if os.getpid() == 1:
+            args = [ "1" ]
+            logg.setLevel(logging.INFO)
+    if opt.host or opt.machine:
+        line = remote_command_line(sys.argv[1:])
+        sys.exit(run_remote((opt.host or []) + (opt.machine or []), line, _connect_timeout, opt.output, _reply_timeout))
+    command = args[0]
+    modules = args[1:]
+    systemctl = Systemctl()
+    if opt.batch or command == "-":
+        sys.exit(run_batch(systemctl, opt.batch or "-"))
+    found, result = run_command(systemctl, command, modules)
+    if not found:
+        logg.error("EXEC END no method for '%s'", command)
+        sys.exit(1)
+    sys.exit(print_result(systemctl, result))
@@ -0,0 +1,445 @@
+#! /usr/bin/python
+""" the start/stop/halt timing of systemctl.py on the virtual clock of
+    SimulatedProcesses - all unit, pid, lock and status files are kept
+    in a temporary folder, so it runs without docker and without root:
+
+        python tests/simulatedtiming.py [-v]
+"""
+__copyright__ = "(C) 2017 Guido U. Draheim, for free use (CC-BY,GPL,BSD)"
+__version__ = "1.0"
+
+import imp
+import os
+import resource
+import shutil
+import signal
+import tempfile
+import time
+import unittest
+import logging
+
+logg = logging.getLogger("simulatedtiming")
+
+SYSTEMCTL = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "files", "docker", "systemctl.py")
+systemctl = imp.load_source("systemctl", SYSTEMCTL)
+
+class SimulatedTestCase(unittest.TestCase):
+    """ a temporary root folder for the unit, pid, lock and status files """
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix = "simulatedtiming.")
+        for folder in [ "etc/systemd/system", "run", "run/systemctl", "lib", "log" ]:
+            os.makedirs(os.path.join(self.root, folder))
+    def tearDown(self):
+        shutil.rmtree(self.root)
+    def unit(self, name, text):
+        with open(os.path.join(self.root, "etc/systemd/system", name), "w") as f:
+            f.write(text)
+    def pid_file(self, name):
+        return os.path.join(self.root, "run", name + ".pid")
+    def systemctl(self, behaviors):
+        """ a Systemctl on the virtual clock that does not touch /etc or /var """
+        sim = systemctl.SimulatedProcesses(behaviors)
+        ctl = systemctl.Systemctl(sim)
+        ctl._sysd_folder1 = os.path.join(self.root, "usr/lib/systemd/system")
+        ctl._sysd_folder2 = os.path.join(self.root, "etc/systemd/system")
+        ctl._sysv_folder1 = os.path.join(self.root, "etc/init.d")
+        ctl._sysv_folder2 = os.path.join(self.root, "run/init.d")
+        ctl._lock_folder = os.path.join(self.root, "run/systemctl")
+        ctl._lib_folder = os.path.join(self.root, "lib")
+        ctl._log_folder = os.path.join(self.root, "log")
+        ctl.default_pid_file = self.pid_file
+        return sim, ctl
+    def kills(self, sim, signum):
+        return [ when for when, what, pid, detail in sim.events if what == "kill" and detail == signum ]
+
+class SimulatedTimingTest(SimulatedTestCase):
+    def test_001_start_simple(self):
+        """ a simple service is started without any waiting """
+        self.unit("a.service", "[Service]\nExecStart=/usr/bin/adaemon\n")
+        sim, ctl = self.systemctl([ ("*adaemon*", { "runtime": None }) ])
+        self.assertTrue(ctl.start_of_units("a"))
+        self.assertEqual(sim.time(), 0.0)
+        self.assertTrue(ctl.is_active_of_units("a"))
+    def test_002_start_forking_waits_for_the_daemon(self):
+        """ a forking service is active when its daemon has written the pid file """
+        self.unit("f.service", "[Service]\nType=forking\nPIDFile=%s\nExecStart=/usr/bin/fdaemon\n"
+                  % self.pid_file("f.service"))
+        sim, ctl = self.systemctl([ ("*fdaemon*", { "runtime": 2.0, "pid_file": self.pid_file("f.service"),
+                                                   "daemon": { "runtime": None } }) ])
+        self.assertTrue(ctl.start_of_units("f"))
+        self.assertEqual(sim.time(), 2.0)
+        self.assertTrue(ctl.is_active_of_units("f"))
+    def test_003_stop_quick(self):
+        """ a service that exits on SIGTERM is stopped within a second """
+        self.unit("a.service", "[Service]\nExecStart=/usr/bin/adaemon\n")
+        sim, ctl = self.systemctl([ ("*adaemon*", { "runtime": None, "term": 0.2 }) ])
+        ctl.start_of_units("a")
+        ctl.stop_of_units("a")
+        self.assertLessEqual(sim.time(), 1.0)
+        self.assertEqual(self.kills(sim, signal.SIGKILL), [])
+        self.assertFalse(ctl.is_active_of_units("a"))
+    def test_004_stop_stubborn(self):
+        """ a service that ignores SIGTERM gets the SIGKILL after the kill wait """
+        self.unit("s.service", "[Service]\nExecStart=/usr/bin/sdaemon\n")
+        sim, ctl = self.systemctl([ ("*sdaemon*", { "runtime": None, "term": None }) ])
+        ctl.start_of_units("s")
+        ctl.stop_of_units("s")
+        sigkill = self.kills(sim, signal.SIGKILL)
+        self.assertEqual(len(sigkill), 1)
+        self.assertEqual(sigkill[0], float(ctl._waitkillproc))
+        self.assertFalse(ctl.is_active_of_units("s"))
+    def test_005_halt_within_the_stop_timeout(self):
+        """ the units are stopped in parallel - a stubborn one does not
+            delay the others and it is killed at the overall deadline """
+        for name in [ "a", "b", "s" ]:
+            self.unit("%s.service" % name, "[Service]\nExecStart=/usr/bin/%sdaemon\n"
+                      "[Install]\nWantedBy=multi-user.target\n" % name)
+        sim, ctl = self.systemctl([ ("*/adaemon*", { "runtime": None, "term": 0.5 }),
+                                    ("*/bdaemon*", { "runtime": None, "term": 1.5 }),
+                                    ("*/sdaemon*", { "runtime": None, "term": None }) ])
+        ctl.start_of_units("a", "b", "s")
+        started = sim.time()
+        missed = ctl.stop_units_until([ "a.service", "b.service", "s.service" ], 8.0)
+        self.assertEqual(missed, [ "s.service" ])
+        self.assertGreaterEqual(sim.time() - started, 8.0)
+        self.assertLess(sim.time() - started, 8.5)
+        self.assertEqual(len(self.kills(sim, signal.SIGKILL)), 1)
+        for name in [ "a", "b", "s" ]:
+            self.assertFalse(ctl.is_active_of_units(name))
+    def test_006_no_files_outside(self):
+        """ the lock and status files are written to the temporary folder """
+        self.unit("o.service", "[Service]\nType=oneshot\nRemainAfterExit=yes\nExecStart=/usr/bin/setup\n")
+        sim, ctl = self.systemctl([ ("*setup*", { "runtime": 3.0 }) ])
+        self.assertTrue(ctl.start_of_units("o"))
+        self.assertEqual(sim.time(), 3.0)
+        self.assertTrue(os.path.isfile(os.path.join(self.root, "run/systemctl/o.service.status")))
+        self.assertTrue(ctl.is_active_of_units("o"))
+
+class BootOrderTest(SimulatedTestCase):
+    """ the start order at boot by the start durations of the last boots """
+    def started(self, jobs):
+        for name in [ "a", "b", "c" ]:
+            self.unit("%s.service" % name, "[Service]\nExecStart=/usr/bin/%sdaemon\n" % name)
+        with open(os.path.join(self.root, "lib/start-durations"), "w") as f:
+            f.write("a.service 1.0\nb.service 5.0\nc.service 3.0\n")
+        sim, ctl = self.systemctl([ ("*daemon*", { "runtime": None }) ])
+        ctl._jobs = jobs
+        self.assertTrue(ctl.start_units_by_history([ "a.service", "b.service", "c.service" ]))
+        return [ cmd.split("/")[-1] for when, what, pid, cmd in sim.events if what == "spawn" and "daemon" in cmd ]
+    def test_061_critical_path(self):
+        """ a unit's path is its own duration plus the longest path after it """
+        sim, ctl = self.systemctl([])
+        after = { "a": set(), "b": set([ "a" ]), "c": set([ "b" ]), "d": set() }
+        history = { "a": 1.0, "b": 2.0, "c": 0.5, "d": 3.0 }
+        path = ctl.critical_path_of([ "a", "b", "c", "d" ], after, history)
+        self.assertEqual(path, { "a": 3.5, "b": 2.5, "c": 0.5, "d": 3.0 })
+    def test_062_sequential_by_default(self):
+        """ with --jobs=1 (the default) the units are started in their order """
+        self.assertEqual(self.started(None), [ "adaemon", "bdaemon", "cdaemon" ])
+        self.assertEqual(self.started(1), [ "adaemon", "bdaemon", "cdaemon" ])
+    def test_063_longest_first_in_parallel(self):
+        """ with --jobs=N the unit with the longest path goes first """
+        self.assertEqual(self.started(3), [ "bdaemon", "cdaemon", "adaemon" ])
+
+class UnitFileTest(SimulatedTestCase):
+    """ the parsing of the unit files """
+    def test_051_drop_in(self):
+        """ a drop-in does not change the unit's file, name and type """
+        self.unit("d.service", "[Service]\nExecStart=/usr/bin/ddaemon\n")
+        os.makedirs(os.path.join(self.root, "etc/systemd/system/d.service.d"))
+        self.unit("d.service.d/extra.conf", "[Service]\nX-MemoryPressureAction=restart\n")
+        sim, ctl = self.systemctl([ ("*ddaemon*", { "runtime": None }) ])
+        conf = ctl.read_unit("d.service")
+        self.assertEqual(conf.filename(), os.path.join(self.root, "etc/systemd/system/d.service"))
+        self.assertEqual(conf.name(), "d.service")
+        self.assertEqual(conf.get("Service", "X-MemoryPressureAction", ""), "restart")
+        self.assertTrue(ctl.start_of_units("d"))
+        self.assertTrue(ctl.is_active_of_units("d"))
+
+class PathUnitTest(SimulatedTestCase):
+    """ the .path units in the memory of the init process """
+    def test_071_trigger_limit(self):
+        """ more than TriggerLimitBurst= triggers in the interval fail the path unit """
+        flag = os.path.join(self.root, "run", "flag")
+        open(flag, "w").close()
+        self.unit("f.path", "[Path]\nPathExists=%s\nTriggerLimitBurst=3\nTriggerLimitIntervalSec=1h\n" % flag)
+        self.unit("f.service", "[Service]\nType=oneshot\nExecStart=/usr/bin/fjob\n")
+        sim, ctl = self.systemctl([ ("*fjob*", { "runtime": 0.5 }) ])
+        conf = ctl.read_unit("f.path")
+        self.assertTrue(ctl.start_path_from(conf))
+        for n in range(3):
+            ctl.trigger_path("f.path")
+            self.assertIn("f.path", ctl._paths)
+        self.assertEqual(len([ event for event in sim.events if event[1] == "spawn" and "fjob" in event[3] ]), 3)
+        ctl.trigger_path("f.path")
+        self.assertNotIn("f.path", ctl._paths)
+        self.assertEqual(len([ event for event in sim.events if event[1] == "spawn" and "fjob" in event[3] ]), 3)
+        self.assertTrue(ctl.start_path_from(conf))
+        ctl.trigger_path("f.path")
+        self.assertIn("f.path", ctl._paths)
+    def test_072_make_directory_fails(self):
+        """ a MakeDirectory= that can not be done fails the start """
+        blocker = os.path.join(self.root, "run", "file")
+        open(blocker, "w").close()
+        self.unit("d.path", "[Path]\nDirectoryNotEmpty=%s/spool\nMakeDirectory=yes\n" % blocker)
+        sim, ctl = self.systemctl([])
+        self.assertFalse(ctl.start_path_from(ctl.read_unit("d.path")))
+        self.assertNotIn("d.path", ctl._paths)
+
+class BatchTest(SimulatedTestCase):
+    """ many commands on the same Systemctl instance """
+    def test_401_streamed_exitcode(self):
+        """ a streamed listing after a failed status has its own exitcode """
+        self.unit("a.service", "[Service]\nExecStart=/usr/bin/adaemon\n")
+        sim, ctl = self.systemctl([])
+        found, result = systemctl.run_command(ctl, "status", [ "a.service" ])
+        self.assertEqual("".join(result) and ctl._exitcode, 3)
+        found, result = systemctl.run_command(ctl, "list-units", [])
+        self.assertTrue("".join(result))
+        self.assertEqual(ctl._exitcode, 0)
+
+class ReapedTest(SimulatedTestCase):
+    """ the exit of a main process as seen by the init process """
+    def reaped(self, ctl, events, pid, signum):
+        published = []
+        ctl.publish_event = published.append
+        for event in events:
+            ctl.manager_event(event, "")
+        ctl._pid_units[pid] = "a.service"
+        ctl.reaped(pid, signum, resource.getrusage(resource.RUSAGE_SELF))
+        return [ event["state"] for event in published ]
+    def test_501_stopped_is_not_failed(self):
+        """ a SIGTERM/SIGKILL of a unit that is stopped is not a failure """
+        sim, ctl = self.systemctl([])
+        deactivating = { "unit": "a.service", "state": "deactivating", "pid": 100 }
+        inactive = { "unit": "a.service", "state": "inactive" }
+        self.assertEqual(self.reaped(ctl, [ deactivating ], 100, signal.SIGTERM), [ "inactive" ])
+        self.assertEqual(self.reaped(ctl, [ deactivating, inactive ], 100, signal.SIGKILL), [])
+    def test_502_restarted_is_not_failed(self):
+        """ the old main process is reaped while the new one is starting """
+        sim, ctl = self.systemctl([])
+        events = [ { "unit": "a.service", "state": "deactivating", "pid": 100 },
+                   { "unit": "a.service", "state": "inactive" },
+                   { "unit": "a.service", "state": "starting" } ]
+        self.assertEqual(self.reaped(ctl, events, 100, signal.SIGTERM), [])
+    def test_503_killed_is_failed(self):
+        """ the main process of an active unit was killed by someone else """
+        sim, ctl = self.systemctl([])
+        events = [ { "unit": "a.service", "state": "active", "pid": 100 } ]
+        self.assertEqual(self.reaped(ctl, events, 100, signal.SIGKILL), [ "failed" ])
+
+class ResourceSettingsTest(SimulatedTestCase):
+    """ the values of the Limit*= and cgroup settings """
+    def cgroup_root(self):
+        """ a fake cgroup v2 where the manager's cgroup has a memory.max of 1G """
+        root = os.path.join(self.root, "cgroup")
+        parent = root
+        for line in open("/proc/self/cgroup"):
+            if line.startswith("0::"):
+                parent = os.path.join(root, line[3:].strip().lstrip("/"))
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        for name, text in [ ("cgroup.controllers", "cpu io memory"), ("cgroup.subtree_control", "memory"),
+                            ("cgroup.procs", ""), ("memory.max", "1073741824") ]:
+            open(os.path.join(root, name), "w").write(text)
+            open(os.path.join(parent, name), "w").write(text)
+        return root, parent
+    def test_201_sizes_and_time_spans(self):
+        self.assertEqual(systemctl.size_to_bytes("512M"), 512 * 1024 * 1024)
+        self.assertEqual(systemctl.size_to_bytes("infinity"), None)
+        self.assertEqual(systemctl.size_to_bytes("50%", 1000), 500)
+        self.assertRaises(ValueError, systemctl.size_to_bytes, "50%")
+        self.assertEqual(systemctl.rlimit_value("LimitCPU", "1h"), 3600)
+        self.assertEqual(systemctl.rlimit_value("LimitCPU", "30"), 30)
+        self.assertEqual(systemctl.rlimit_value("LimitRTTIME", "200ms"), 200000)
+        self.assertEqual(systemctl.rlimit_value("LimitRTTIME", "infinity"), None)
+        self.assertEqual(systemctl.rlimit_value("LimitNOFILE", "4K"), 4096)
+        self.assertRaises(ValueError, systemctl.rlimit_value, "LimitCPU", "1 fortnight")
+    def test_202_bad_settings_are_ignored(self):
+        """ a setting that can not be parsed is skipped with a warning """
+        self.unit("r.service", "[Service]\nLimitCPU=1 fortnight\nLimitNOFILE=one\nExecStart=/usr/bin/rdaemon\n")
+        sim, ctl = self.systemctl([ ("*rdaemon*", { "runtime": None }) ])
+        ctl._cgroup_root = os.path.join(self.root, "nocgroup")
+        conf = ctl.read_unit("r.service")
+        self.assertEqual(ctl.exec_settings_from(conf), None)
+        self.assertTrue(ctl.start_of_units("r"))
+    def test_203_memory_max_percentage(self):
+        """ MemoryMax=50% is half of the memory.max of the manager's cgroup """
+        root, parent = self.cgroup_root()
+        self.unit("m.service", "[Service]\nMemoryMax=50%\nExecStart=/usr/bin/mdaemon\n")
+        sim, ctl = self.systemctl([])
+        ctl._cgroup_root = root
+        folder = ctl.cgroup_from(ctl.read_unit("m.service"))
+        self.assertEqual(folder, os.path.join(parent, "m.service"))
+        self.assertEqual(open(os.path.join(folder, "memory.max")).read(), str(512 * 1024 * 1024))
+
+class MetricsTest(SimulatedTestCase):
+    """ the prometheus text format of the init loop's metrics """
+    def test_301_types_and_labels(self):
+        self.unit("a.service", "[Service]\nExecStart=/usr/bin/adaemon\n")
+        sim, ctl = self.systemctl([ ("*adaemon*", { "runtime": None }) ])
+        ctl.start_of_units("a")
+        ctl._unit_stats['we"ird\\name\n.service'] = { "starts": 2, "reaped_cpu_seconds": 0.0 }
+        lines = "".join(ctl.each_metrics_line()).splitlines()
+        names = set([ line.split("{")[0].split()[0] for line in lines if not line.startswith("#") ])
+        types = set([ line.split()[2] for line in lines if line.startswith("# TYPE ") ])
+        self.assertEqual(names, types)
+        self.assertIn('systemctl_unit_restarts_total{unit="we\\"ird\\\\name\\n.service"} 1', lines)
+        self.assertIn('systemctl_unit_active{unit="a.service"} 1', lines)
+
+class JournalTest(SimulatedTestCase):
+    """ the UNIT.log files of the syslog listener over the end of the
+        daylight saving time - 2026-10-25 02:00..02:59 does come twice """
+    def setUp(self):
+        SimulatedTestCase.setUp(self)
+        self.tz = os.environ.get("TZ")
+        os.environ["TZ"] = "Europe/Berlin"
+        time.tzset()
+        self.block = systemctl._journal_block
+        systemctl._journal_block = 256 # many index entries
+    def tearDown(self):
+        systemctl._journal_block = self.block
+        if self.tz is None:
+            del os.environ["TZ"]
+        else:
+            os.environ["TZ"] = self.tz
+        time.tzset()
+        SimulatedTestCase.tearDown(self)
+    def journal(self, ctl, unit, times):
+        """ one line per minute like the syslog listener writes them """
+        with open(os.path.join(self.root, "log", unit + ".log"), "a") as f:
+            for n, when in enumerate(times):
+                ctl.index_journal(unit, when, f.tell())
+                f.write("%s tag[1]: %s %i\n" % (systemctl.journal_stamp(when), unit, n))
+    def lines(self, ctl, since = None, until = None, lines = None, units = [ "a.service" ]):
+        ctl._since, ctl._until, ctl._lines = since, until, lines
+        ctl._journal_units, ctl._journal_follow = units, False
+        return list(ctl.journal_of_units())
+    def test_601_last_lines(self):
+        sim, ctl = self.systemctl([])
+        start = time.mktime((2026, 10, 25, 0, 0, 0, 0, 0, -1))
+        self.journal(ctl, "a.service", [ start + 60 * n for n in range(300) ])
+        self.assertEqual([ line.split()[-1] for line in self.lines(ctl, lines = 3) ], [ "297", "298", "299" ])
+        self.assertEqual(len(self.lines(ctl)), 300)
+    def test_602_since_in_the_repeated_hour(self):
+        """ --since compares the times, not the local time texts """
+        sim, ctl = self.systemctl([])
+        start = time.mktime((2026, 10, 25, 0, 0, 0, 0, 0, -1))
+        times = [ start + 60 * n for n in range(300) ]
+        self.journal(ctl, "a.service", times)
+        since = time.mktime((2026, 10, 25, 2, 30, 0, 0, 0, -1))
+        found = self.lines(ctl, since = "2026-10-25 02:30")
+        self.assertEqual(len(found), len([ when for when in times if when >= since ]))
+        self.assertEqual(found[-1].split()[-1], "299")
+    def test_603_until(self):
+        sim, ctl = self.systemctl([])
+        start = time.mktime((2026, 10, 25, 0, 0, 0, 0, 0, -1))
+        self.journal(ctl, "a.service", [ start + 60 * n for n in range(300) ])
+        found = self.lines(ctl, since = "2026-10-25 01:00", until = "2026-10-25 03:30")
+        self.assertEqual(found[0].split()[-1], "60")
+        self.assertEqual(found[-1].split()[-1], "269")
+        self.assertEqual(len(found), 210)
+    def test_604_merged_in_local_time(self):
+        """ the lines of two units are merged by time and shown in local time """
+        sim, ctl = self.systemctl([])
+        start = time.mktime((2026, 10, 25, 1, 50, 0, 0, 0, -1))
+        self.journal(ctl, "a.service", [ start + 600 * n for n in range(10) ])
+        self.journal(ctl, "b.service", [ start + 300 + 600 * n for n in range(10) ])
+        found = self.lines(ctl, units = [ "a.service", "b.service" ])
+        self.assertEqual([ line.split()[-2][0] for line in found ], [ "a", "b" ] * 10)
+        self.assertEqual([ line[11:16] for line in found[:4] ], [ "01:50", "01:55", "02:00", "02:05" ])
+        self.assertEqual([ line[11:16] for line in found[14:18] ], [ "02:00", "02:05", "02:10", "02:15" ])
+
+class CalendarTest(unittest.TestCase):
+    """ OnCalendar= and the *Sec= time spans - the calendar is checked in
+        a zone with daylight saving time, so that the DST switches of
+        2026 (Mar 29 and Oct 25) are run through as well """
+    def setUp(self):
+        self.tz = os.environ.get("TZ")
+        os.environ["TZ"] = "Europe/Berlin"
+        time.tzset()
+    def tearDown(self):
+        if self.tz is None:
+            del os.environ["TZ"]
+        else:
+            os.environ["TZ"] = self.tz
+        time.tzset()
+    def local(self, *clock):
+        return time.mktime(tuple(clock) + (0,) * (6 - len(clock)) + (0, 0, -1))
+    def next(self, spec, after):
+        return systemctl.next_calendar_time(systemctl.parse_calendar(spec), after)
+    def clock(self, ts):
+        return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(ts))
+    def test_101_time_to_seconds(self):
+        """ the time spans of the *Sec= settings """
+        self.assertEqual(systemctl.time_to_seconds("90"), 90.0)
+        self.assertEqual(systemctl.time_to_seconds("5min"), 300.0)
+        self.assertEqual(systemctl.time_to_seconds("1h 30min"), 5400.0)
+        self.assertEqual(systemctl.time_to_seconds("2d3h"), 2 * 86400.0 + 3 * 3600.0)
+        self.assertAlmostEqual(systemctl.time_to_seconds("100ms"), 0.1)
+        self.assertAlmostEqual(systemctl.time_to_seconds("1.5s"), 1.5)
+        self.assertEqual(systemctl.time_to_seconds("infinity", 5), None)
+        self.assertEqual(systemctl.time_to_seconds("", 7), 7)
+        self.assertEqual(systemctl.time_to_seconds("3 parsecs", 7), 7)
+    def test_102_parse_calendar(self):
+        """ the fields are parsed into sorted lists, "*" is None """
+        weekdays, years, months, days, hours, minutes, seconds = systemctl.parse_calendar("Mon..Fri 08:00")
+        self.assertEqual(weekdays, [ 0, 1, 2, 3, 4 ])
+        self.assertEqual((years, months, days), (None, None, None))
+        self.assertEqual((hours, minutes, seconds), ([ 8 ], [ 0 ], [ 0 ]))
+        spec = systemctl.parse_calendar("quarterly")
+        self.assertEqual(spec[2], [ 1, 4, 7, 10 ])
+        self.assertEqual(spec[3], [ 1 ])
+        spec = systemctl.parse_calendar("Sat,Sun *-12-24..26 *:0/20")
+        self.assertEqual(spec[0], [ 5, 6 ])
+        self.assertEqual(spec[3], [ 24, 25, 26 ])
+        self.assertEqual(spec[5], [ 0, 20, 40 ])
+        self.assertRaises(ValueError, systemctl.parse_calendar, "2026-01-01-01")
+        self.assertRaises(ValueError, systemctl.parse_calendar, "1:2:3:4")
+    def test_103_next_calendar_time(self):
+        """ the next elapse is strictly after the given time """
+        after = self.local(2026, 10, 16, 9, 0)
+        self.assertEqual(self.clock(self.next("Mon..Fri 08:00", after)), "2026-10-19 08:00:00")
+        self.assertEqual(self.clock(self.next("*-*-* *:*/15", self.local(2026, 10, 18, 10, 7))), "2026-10-18 10:15:00")
+        at = self.local(2026, 10, 18, 10, 15)
+        self.assertEqual(self.clock(self.next("*-*-* *:*/15", at)), "2026-10-18 10:30:00")
+        self.assertEqual(self.clock(self.next("weekly", self.local(2026, 10, 18, 0, 0))), "2026-10-19 00:00:00")
+        self.assertEqual(self.clock(self.next("monthly", self.local(2026, 12, 15))), "2027-01-01 00:00:00")
+        self.assertEqual(self.clock(self.next("Fri *-*-13", self.local(2026, 1, 1))), "2026-02-13 00:00:00")
+        self.assertEqual(self.next("1999-01-01", self.local(2026, 1, 1)), None)
+    def test_104_month_lengths(self):
+        """ the short months are skipped for day 31 and Feb 29 waits for a leap year """
+        self.assertEqual(self.clock(self.next("*-*-31 00:00", self.local(2026, 4, 1))), "2026-05-31 00:00:00")
+        self.assertEqual(self.clock(self.next("*-*-31 00:00", self.local(2026, 5, 31))), "2026-07-31 00:00:00")
+        self.assertEqual(self.clock(self.next("*-02-29 12:00", self.local(2026, 1, 1))), "2028-02-29 12:00:00")
+        self.assertEqual(self.clock(self.next("*-*-30", self.local(2027, 1, 30))), "2027-03-30 00:00:00")
+    def test_105_dst_spring_forward(self):
+        """ a clock time in the skipped hour elapses once, at the end of the gap """
+        first = self.next("*-*-* 02:30:00", self.local(2026, 3, 29, 1, 0))
+        self.assertEqual(self.clock(first), "2026-03-29 03:30:00")
+        second = self.next("*-*-* 02:30:00", first)
+        self.assertEqual(self.clock(second), "2026-03-30 02:30:00")
+        self.assertEqual(second - first, 23 * 3600)
+        hourly = [ self.next("hourly", self.local(2026, 3, 29, 1, 30)) ]
+        hourly.append(self.next("hourly", hourly[-1]))
+        self.assertEqual([ self.clock(ts) for ts in hourly ], [ "2026-03-29 03:00:00", "2026-03-29 04:00:00" ])
+    def test_106_dst_fall_back(self):
+        """ a clock time in the repeated hour elapses once, not twice """
+        first = self.next("*-*-* 02:30:00", self.local(2026, 10, 25, 1, 0))
+        self.assertEqual(self.clock(first), "2026-10-25 02:30:00")
+        second = self.next("*-*-* 02:30:00", first)
+        self.assertEqual(self.clock(second), "2026-10-26 02:30:00")
+        self.assertEqual(second - first, 25 * 3600)
+        after = self.local(2026, 10, 25, 1, 30)
+        hourly = []
+        for n in range(3):
+            after = self.next("hourly", after)
+            hourly.append(after)
+        self.assertEqual([ self.clock(ts) for ts in hourly ],
+                         [ "2026-10-25 02:00:00", "2026-10-25 03:00:00", "2026-10-25 04:00:00" ])
+        self.assertEqual(hourly[1] - hourly[0], 7200)
+
+if __name__ == "__main__":
+    import sys
+    logging.basicConfig(level = "-v" in sys.argv and logging.INFO or logging.ERROR)
+    unittest.main()